@@ -67,7 +67,8 @@ fn1 = processing.covid_test.ValidateCovidTestResultsFacVersion1PreHCTFix(hct, tc
                                                                          )
                                                          # show_debug=True)
 print('performing validation test')
-utils.iterate_over_patient_assessments(ds.fields_, filter_status1, fn1)
+utils.iterate_over_patient_assessments(ds.fields_, filter_status1, fn1,
+                                       ds.field_to_index('patient_id'))
 
 print('checking results')
 results1 = [[0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0]]
@@ -88,7 +89,8 @@ fn1f = processing.covid_test.ValidateCovidTestResultsFacVersion1(hct, tcp, filte
                                                                  )
                                                                  # show_debug=True)
 print('performing validation test')
-utils.iterate_over_patient_assessments(ds.fields_, filter_status1f, fn1f)
+utils.iterate_over_patient_assessments(ds.fields_, filter_status1f, fn1f,
+                                       ds.field_to_index('patient_id'))
 
 print('checking results')
 results1f = [[0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0]]
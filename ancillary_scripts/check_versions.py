@@ -9,6 +9,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from collections import defaultdict
+
 import dataset
 import pipeline
 import utils
@@ -16,14 +18,22 @@ import utils
 patients_filename = '/home/ben/covid/patients_export_geocodes_20200423050002.csv'
 assessments_filename = '/home/ben/covid/assessments_export_20200423050002.csv'
 #fn = '/home/ben/covid/assessments_short.csv'
-print(f'loading {patients_filename}')
-with open(patients_filename) as f:
-    ds = dataset.Dataset(f, progress=True)
+batch_rows = 1 << 20
 
-print(utils.build_histogram(ds.field_by_name('version')))
 
-print(f'loading {assessments_filename}')
-with open(assessments_filename) as f:
-    ds = dataset.Dataset(f, progress=True)
+def version_histogram(filename):
+    # the versions are counted a batch at a time so that the file isn't held in memory
+    histogram = defaultdict(int)
+    with open(filename) as f:
+        for batch in dataset.Dataset.iter_batches(f, batch_rows, keys=('version',),
+                                                  progress=True):
+            for value, count in utils.build_histogram(batch.field_by_name('version')):
+                histogram[str(value)] += count
+    return list(histogram.items())
+
 
-print(utils.build_histogram(ds.field_by_name('version')))
\ No newline at end of file
+print(f'loading {patients_filename}')
+print(version_histogram(patients_filename))
+
+print(f'loading {assessments_filename}')
+print(version_histogram(assessments_filename))
@@ -0,0 +1,357 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import dictionary_field
+import hex_id_field
+import numeric_field
+import numpy_buffer
+import timestamp_field
+
+# The cache for a csv export is a directory holding one file per column plus a json manifest:
+#  * numeric / categorical columns are stored as .npy files and memory-mapped on load
+#  * string columns are stored as an int64 offsets .npy file plus a raw utf-8 .bytes file
+#  * dictionary encoded columns are stored as a .npy file of codes plus their table of values,
+#    which is stored in the same way as a string column
+#  * packed hex id columns are stored as a .npy file of their packed ids and memory-mapped on load
+#  * numeric columns are stored as a .npy file of values and a .npy file of their missing value
+#    mask, both memory-mapped on load
+#  * timestamp columns are stored as a .npy file of datetime64 values and a .npy file of their
+#    day numbers, both memory-mapped on load
+# The manifest records the fingerprint of the source file, the load options that change the kind
+# of the cached fields, and the field descriptor used for each column; a cache is only used if
+# all of them still match. A load that asks for columns that the cache doesn't hold adds them to
+# it, and files that the manifest no longer refers to are removed. A cache written by incremental ingest
+# (see incremental_cache) also records a digest of the whole content of the source file, so that
+# a later export can be checked for starting with the same bytes; other caches don't, as that
+# means reading the whole file again. A cache whose rows have been sorted
+# (see external_sort) also holds the source row of each row and the keys it is sorted by.
+
+CACHE_FORMAT_VERSION = 2
+MANIFEST_NAME = 'manifest.json'
+INDEX_NAME = 'index.npy'
+DIGEST_SAMPLE_SIZE = 1 << 20
+DIGEST_BLOCK_SIZE = 1 << 22
+
+
+class MappedStringField(numpy_buffer.StringArena):
+    """
+    A read-only string column whose offsets array and utf-8 byte buffer are typically
+    memory-mapped from a cache directory. Rows taken or copied from it are gathered into a
+    StringArena in memory
+    """
+
+
+def source_path(source):
+    """
+    Get the path of the file that 'source' reads from, or None if it isn't a file on disk
+    """
+    name = getattr(source, 'name', None)
+    if isinstance(name, str) and os.path.isfile(name):
+        return os.path.abspath(name)
+    return None
+
+
+def cache_path_for(cache_dir, path):
+    """
+    The cache directory for the source file 'path'. It is named by the file name and a digest
+    of the absolute path, so that exports with the same name in different directories have
+    separate caches
+    """
+    path = os.path.abspath(path)
+    path_digest = hashlib.blake2b(path.encode('utf-8'), digest_size=8).hexdigest()
+    return os.path.join(cache_dir, f'{os.path.basename(path)}.{path_digest}.cache')
+
+
+def fingerprint(path):
+    """
+    Identify the state of a source file by size, modification time and a digest of its first
+    and last DIGEST_SAMPLE_SIZE bytes, so that validating a cache doesn't mean rereading the file
+    """
+    stat = os.stat(path)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        digest.update(f.read(DIGEST_SAMPLE_SIZE))
+        if stat.st_size > DIGEST_SAMPLE_SIZE:
+            f.seek(max(DIGEST_SAMPLE_SIZE, stat.st_size - DIGEST_SAMPLE_SIZE))
+            digest.update(f.read())
+    return {'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime,
+            'digest': digest.hexdigest()}
+
+
+def descriptor_signature(descriptor):
+    """
+    A json-compatible description of a field descriptor, used to check that a cached column
+    was built with the same transform as the one being requested
+    """
+    if descriptor is None:
+        return None
+    signature = {'type': type(descriptor).__name__}
+    for k, v in sorted(vars(descriptor).items()):
+        if isinstance(v, type) or isinstance(v, np.dtype):
+            v = np.dtype(v).name if v is not str else 'str'
+        elif isinstance(v, dict):
+            v = sorted([str(dk), str(dv)] for dk, dv in v.items())
+        elif isinstance(v, (list, tuple)):
+            v = [str(x) for x in v]
+        elif v is not None and not isinstance(v, (bool, int, float, str)):
+            v = str(v)
+        signature[k] = v
+    return signature
+
+
+def load_options(auto_dictionary=False):
+    """
+    The Dataset load options that change the kind of the fields that are cached. The csv reader
+    backend isn't among them, as each backend's string fields are cached in the same way
+    """
+    return {'auto_dictionary': bool(auto_dictionary)}
+
+
+def read_manifest(cache_path):
+    manifest_path = os.path.join(cache_path, MANIFEST_NAME)
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        try:
+            return json.load(f)
+        except ValueError:
+            return None
+
+
+def content_digest(path, size=None):
+    """
+    A digest of the first 'size' bytes of 'path', or of all of it if 'size' isn't given
+    """
+    file_size = os.path.getsize(path)
+    size = file_size if size is None else min(size, file_size)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        remaining = size
+        while remaining > 0:
+            block = f.read(min(remaining, DIGEST_BLOCK_SIZE))
+            digest.update(block)
+            remaining -= len(block)
+    return {'size': size, 'digest': digest.hexdigest()}
+
+
+def is_valid_for(manifest, source_fingerprint, keys, signatures, options):
+    """
+    Check whether a manifest was written for the current state of the source file with the load
+    options 'options' (see load_options) and holds all of 'keys' built with the descriptors
+    described by 'signatures'
+    """
+    if manifest is None or manifest.get('format') != CACHE_FORMAT_VERSION:
+        return False
+    if manifest['source'] != source_fingerprint or manifest.get('options') != options:
+        return False
+    columns = {c['name']: c for c in manifest['columns']}
+    for k in keys:
+        if k not in columns or columns[k]['descriptor'] != signatures.get(k):
+            return False
+    return True
+
+
+def _read_strings(cache_path, file_stem):
+    offsets = np.load(os.path.join(cache_path, file_stem + '.offsets.npy'), mmap_mode='r')
+    data_path = os.path.join(cache_path, file_stem + '.bytes')
+    if os.path.getsize(data_path) > 0:
+        data = np.memmap(data_path, dtype=np.uint8, mode='r')
+    else:
+        data = np.zeros(0, dtype=np.uint8)
+    return MappedStringField(offsets, data)
+
+
+def read_columns(cache_path, manifest, keys):
+    columns = {c['name']: c for c in manifest['columns']}
+    fields = list()
+    for k in keys:
+        column = columns[k]
+        if column['kind'] == 'array':
+            fields.append(np.load(os.path.join(cache_path, column['file'] + '.npy'),
+                                  mmap_mode='r'))
+        elif column['kind'] == 'dictionary':
+            codes = np.load(os.path.join(cache_path, column['file'] + '.npy'), mmap_mode='r')
+            values = list(_read_strings(cache_path, column['file'] + '.values'))
+            fields.append(dictionary_field.DictionaryField(codes, values))
+        elif column['kind'] == 'hexid':
+            fields.append(hex_id_field.HexIdField(
+                np.load(os.path.join(cache_path, column['file'] + '.npy'), mmap_mode='r')))
+        elif column['kind'] == 'numeric':
+            fields.append(numeric_field.NumericField(
+                np.load(os.path.join(cache_path, column['file'] + '.npy'), mmap_mode='r'),
+                np.load(os.path.join(cache_path, column['file'] + '.missing.npy'),
+                        mmap_mode='r')))
+        elif column['kind'] == 'timestamp':
+            fields.append(timestamp_field.TimestampField(
+                np.load(os.path.join(cache_path, column['file'] + '.npy'), mmap_mode='r'),
+                np.load(os.path.join(cache_path, column['file'] + '.days.npy'), mmap_mode='r')))
+        else:
+            fields.append(_read_strings(cache_path, column['file']))
+    return fields
+
+
+def write_strings(cache_path, file_stem, field):
+    if isinstance(field, numpy_buffer.StringArena):
+        offsets, data = field.encoded()
+        np.save(os.path.join(cache_path, file_stem + '.offsets.npy'), offsets)
+        with open(os.path.join(cache_path, file_stem + '.bytes'), 'wb') as f:
+            f.write(memoryview(np.ascontiguousarray(data)))
+        return
+    encoded = [s.encode('utf-8') for s in field]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter((len(e) for e in encoded), dtype=np.int64, count=len(encoded)),
+              out=offsets[1:])
+    np.save(os.path.join(cache_path, file_stem + '.offsets.npy'), offsets)
+    with open(os.path.join(cache_path, file_stem + '.bytes'), 'wb') as f:
+        f.write(b''.join(encoded))
+
+
+def begin_write(cache_path):
+    """
+    Prepare 'cache_path' for writing. The manifest is removed first and written last so that an
+    interrupted write never leaves a cache that appears valid
+    """
+    os.makedirs(cache_path, exist_ok=True)
+    manifest_path = os.path.join(cache_path, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+
+def _save_manifest(cache_path, manifest):
+    with open(os.path.join(cache_path, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f)
+    # remove the files of columns that have been replaced or dropped
+    referenced = {c['file'] for c in manifest['columns']}
+    for name in os.listdir(cache_path):
+        if (name.startswith('col_') and name.split('.', 1)[0] not in referenced) or\
+                (name == INDEX_NAME and 'index' not in manifest):
+            os.remove(os.path.join(cache_path, name))
+
+
+def write_manifest(cache_path, source_fingerprint, fieldnames, row_count, columns,
+                   index=None, sorted_by=None, content=None, options=None):
+    """
+    Write the manifest for columns that have already been written to 'cache_path'. If the rows
+    have been reordered, 'index' is the source row of each row and 'sorted_by' the keys that
+    they are ordered by. 'content' is the content digest of the source file, if it is known,
+    and 'options' the load options that the columns were built with (see load_options)
+    """
+    manifest = {'format': CACHE_FORMAT_VERSION,
+                'source': source_fingerprint,
+                'options': options,
+                'fieldnames': list(fieldnames),
+                'row_count': row_count,
+                'columns': columns}
+    if index is not None:
+        np.save(os.path.join(cache_path, INDEX_NAME), index)
+        manifest['index'] = INDEX_NAME
+    if sorted_by is not None:
+        manifest['sorted_by'] = list(sorted_by)
+    if content is not None:
+        manifest['content'] = content
+    _save_manifest(cache_path, manifest)
+
+
+def read_index(cache_path, manifest):
+    """
+    The source row of each cached row, or None if the rows are in source order
+    """
+    if 'index' not in manifest:
+        return None
+    return np.load(os.path.join(cache_path, manifest['index']), mmap_mode='r')
+
+
+def column_entry(name, kind, file_stem, signature):
+    return {'name': name, 'kind': kind, 'file': file_stem, 'descriptor': signature}
+
+
+def _take(field, rows):
+    if isinstance(field, list):
+        return [field[r] for r in rows.tolist()]
+    if isinstance(field, np.ndarray):
+        return field[rows]
+    return field.take(rows)
+
+
+def _free_file_stems(cache_path, count):
+    """
+    'count' column file stems that no file in 'cache_path' has, so that writing a column never
+    overwrites the file of a column that may still be mapped
+    """
+    used = {n.split('.', 1)[0] for n in os.listdir(cache_path)}
+    stems = list()
+    i = 0
+    while len(stems) < count:
+        if f'col_{i:04d}' not in used:
+            stems.append(f'col_{i:04d}')
+        i += 1
+    return stems
+
+
+def write(cache_path, source_fingerprint, fieldnames, names, fields, signatures,
+          index=None, sorted_by=None, content=None, options=None, previous=None):
+    """
+    Write 'fields' to 'cache_path'. If 'previous' is the manifest of the cache already at
+    'cache_path', and it is valid for the same source and options, the fields, which are in
+    source order, are added to its columns in the order of its rows, replacing any columns of the
+    same name, and the other columns that it holds are kept. Otherwise the cache is replaced
+    """
+    begin_write(cache_path)
+
+    columns = list()
+    previous_index = None
+    if previous is not None:
+        columns = list(previous['columns'])
+        previous_index = read_index(cache_path, previous)
+    for name, field, file_stem in zip(names, fields, _free_file_stems(cache_path, len(names))):
+        if previous_index is not None:
+            field = _take(field, np.asarray(previous_index, dtype=np.int64))
+        if isinstance(field, np.ndarray):
+            np.save(os.path.join(cache_path, file_stem + '.npy'), field)
+            kind = 'array'
+        elif isinstance(field, dictionary_field.DictionaryField):
+            np.save(os.path.join(cache_path, file_stem + '.npy'), field.codes)
+            write_strings(cache_path, file_stem + '.values', field.values)
+            kind = 'dictionary'
+        elif isinstance(field, hex_id_field.HexIdField):
+            np.save(os.path.join(cache_path, file_stem + '.npy'), field.ids)
+            kind = 'hexid'
+        elif isinstance(field, numeric_field.NumericField):
+            np.save(os.path.join(cache_path, file_stem + '.npy'), field.values)
+            np.save(os.path.join(cache_path, file_stem + '.missing.npy'), field.missing)
+            kind = 'numeric'
+        elif isinstance(field, timestamp_field.TimestampField):
+            np.save(os.path.join(cache_path, file_stem + '.npy'), field.timestamps)
+            np.save(os.path.join(cache_path, file_stem + '.days.npy'), field.days)
+            kind = 'timestamp'
+        else:
+            write_strings(cache_path, file_stem, field)
+            kind = 'strings'
+        entry = column_entry(name, kind, file_stem, signatures.get(name))
+        replaced = [i_c for i_c, c in enumerate(columns) if c['name'] == name]
+        if replaced:
+            columns[replaced[0]] = entry
+        else:
+            columns.append(entry)
+
+    if previous is not None:
+        # the index, sort order and content digest of the cache still hold for its rows
+        _save_manifest(cache_path, dict(previous, columns=columns))
+        return
+    write_manifest(cache_path, source_fingerprint, fieldnames,
+                   len(fields[0]) if len(fields) > 0 else 0, columns, index, sorted_by, content,
+                   options)
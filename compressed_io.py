@@ -0,0 +1,209 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import concurrent.futures
+import io
+import os
+import queue
+import shutil
+import threading
+import zlib
+
+# Files whose names end in '.gz' are read and written as gzip streams:
+#  * reads decompress on a background thread, a block at a time, into a bounded queue that the
+#    parser takes from, so decompression overlaps with parsing. zlib releases the GIL while it
+#    works, so the two run in parallel
+#  * writes are split into blocks that are compressed in parallel by a pool of threads, each
+#    into a complete gzip member. A sequence of gzip members is a valid gzip file, and gzip,
+#    zcat and this module read it as one stream
+# Other files are opened as they would be by open().
+# Compressed files can only be read from start to end, so the loaders that seek to byte
+# offsets (parallel and preallocated loads, row indices) don't apply to them.
+
+GZIP_EXTENSION = '.gz'
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+READ_BLOCK_SIZE = 1 << 20
+READ_QUEUE_BLOCKS = 16
+WRITE_BLOCK_SIZE = 1 << 22
+BUFFER_SIZE = 1 << 16
+
+
+def is_compressed(path):
+    return path.endswith(GZIP_EXTENSION)
+
+
+def csv_stem(path):
+    """
+    'path' without its '.csv' or '.csv.gz' extension
+    """
+    if is_compressed(path):
+        path = path[:-len(GZIP_EXTENSION)]
+    return path[:-4] if path.endswith('.csv') else path
+
+
+class GzipReader(io.RawIOBase):
+    """
+    Read the decompressed contents of a gzip file, which may have several members, while a
+    background thread decompresses the blocks that follow
+    """
+    def __init__(self, path, block_size=READ_BLOCK_SIZE, queue_blocks=READ_QUEUE_BLOCKS):
+        super().__init__()
+        self.name = path
+        self.block_size_ = block_size
+        self.queue_ = queue.Queue(queue_blocks)
+        self.stopping_ = threading.Event()
+        self.chunk_ = memoryview(b'')
+        self.finished_ = False
+        self.thread_ = threading.Thread(target=self._decompress, daemon=True)
+        self.thread_.start()
+
+    def _put(self, item):
+        # give up if the reader is closed before the file is read to the end
+        while not self.stopping_.is_set():
+            try:
+                self.queue_.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _decompress(self):
+        try:
+            with open(self.name, 'rb') as f:
+                decompressor = zlib.decompressobj(GZIP_WBITS)
+                in_member = False
+                while not self.stopping_.is_set():
+                    data = f.read(self.block_size_)
+                    if not data:
+                        break
+                    while data:
+                        in_member = True
+                        chunk = decompressor.decompress(data)
+                        if chunk and not self._put(chunk):
+                            return
+                        data = b''
+                        if decompressor.eof:
+                            # the end of a member; anything left over starts the next one
+                            data = decompressor.unused_data
+                            decompressor = zlib.decompressobj(GZIP_WBITS)
+                            in_member = False
+                if in_member:
+                    raise EOFError(f"'{self.name}' ended before the end of its last gzip member")
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while len(self.chunk_) == 0:
+            if self.finished_:
+                return 0
+            item = self.queue_.get()
+            if item is None:
+                self.finished_ = True
+            elif isinstance(item, Exception):
+                self.finished_ = True
+                raise item
+            else:
+                self.chunk_ = memoryview(item)
+        count = min(len(b), len(self.chunk_))
+        b[:count] = self.chunk_[:count]
+        self.chunk_ = self.chunk_[count:]
+        return count
+
+    def close(self):
+        if not self.closed:
+            self.stopping_.set()
+            self.thread_.join()
+        super().close()
+
+
+def _compress_member(block, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(block) + compressor.flush()
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    """
+    Write a gzip file as a sequence of members, each compressed from a block of 'block_size'
+    bytes by one of 'workers' threads. The members are written in order as they complete
+    """
+    def __init__(self, path, level=6, block_size=WRITE_BLOCK_SIZE, workers=None):
+        super().__init__()
+        self.name = path
+        self.level_ = level
+        self.block_size_ = block_size
+        self.workers_ = workers or os.cpu_count() or 1
+        self.file_ = open(path, 'wb')
+        self.executor_ = concurrent.futures.ThreadPoolExecutor(self.workers_)
+        self.pending_ = collections.deque()
+        self.buffer_ = bytearray()
+        self.members_ = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.buffer_ += b
+        while len(self.buffer_) >= self.block_size_:
+            self._submit(bytes(self.buffer_[:self.block_size_]))
+            del self.buffer_[:self.block_size_]
+        return len(b)
+
+    def _submit(self, block):
+        self.pending_.append(self.executor_.submit(_compress_member, block, self.level_))
+        self.members_ += 1
+        # write completed members, and limit the blocks held in memory
+        while len(self.pending_) > 0 and\
+                (self.pending_[0].done() or len(self.pending_) > 2 * self.workers_):
+            self.file_.write(self.pending_.popleft().result())
+
+    def close(self):
+        if not self.closed:
+            try:
+                # an empty file is still written as a valid gzip file
+                if len(self.buffer_) > 0 or self.members_ == 0:
+                    self._submit(bytes(self.buffer_))
+                    self.buffer_ = bytearray()
+                while len(self.pending_) > 0:
+                    self.file_.write(self.pending_.popleft().result())
+            finally:
+                self.executor_.shutdown()
+                self.file_.close()
+        super().close()
+
+
+def decompress(path, destination):
+    """
+    Write the decompressed contents of the gzip file 'path' to 'destination'
+    """
+    with io.BufferedReader(GzipReader(path), BUFFER_SIZE) as f_i:
+        with open(destination, 'wb') as f_o:
+            shutil.copyfileobj(f_i, f_o, READ_BLOCK_SIZE)
+
+
+def open_text(path, mode='r', encoding=None, newline=None):
+    """
+    Open 'path' as a text file for reading ('r') or writing ('w'), compressing or decompressing
+    it if it is a gzip file
+    """
+    if not is_compressed(path):
+        return open(path, mode, encoding=encoding, newline=newline)
+    if mode == 'r':
+        return io.TextIOWrapper(io.BufferedReader(GzipReader(path), BUFFER_SIZE),
+                                encoding=encoding, newline=newline)
+    if mode == 'w':
+        return io.TextIOWrapper(io.BufferedWriter(ParallelGzipWriter(path), BUFFER_SIZE),
+                                encoding=encoding, newline=newline)
+    raise ValueError(f"mode must be 'r' or 'w', not '{mode}'")
@@ -0,0 +1,166 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mmap
+import os
+
+import numpy as np
+
+# Helpers for working on a csv file as raw bytes. A newline only ends a row if it is outside a
+# quoted field; as escaped quotes are doubled, a newline is outside a quoted field exactly when
+# an even number of quote characters precede it in the file.
+
+READ_BLOCK_SIZE = 1 << 22
+QUOTE = ord('"')
+NEWLINE = ord('\n')
+
+
+def _quote_count(f, start, end):
+    count = 0
+    f.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        block = f.read(min(READ_BLOCK_SIZE, remaining))
+        if not block:
+            break
+        count += block.count(b'"')
+        remaining -= len(block)
+    return count
+
+
+def _next_row_start(f, offset, in_quotes, end):
+    """
+    Find the offset of the first row that starts at or after 'offset', given whether 'offset'
+    is inside a quoted field
+    """
+    f.seek(offset)
+    position = offset
+    while position < end:
+        block = f.read(min(READ_BLOCK_SIZE, end - position))
+        if not block:
+            break
+        start = 0
+        while True:
+            newline = block.find(b'\n', start)
+            if newline == -1:
+                if block.count(b'"', start) % 2 == 1:
+                    in_quotes = not in_quotes
+                break
+            if block.count(b'"', start, newline) % 2 == 1:
+                in_quotes = not in_quotes
+            if not in_quotes:
+                return position + newline + 1
+            start = newline + 1
+        position += len(block)
+    return end
+
+
+def header_end(path):
+    """
+    The offset of the first byte after the header row
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        return _next_row_start(f, 0, False, size)
+
+
+def row_aligned_ranges(path, start, range_count):
+    """
+    Split the bytes of 'path' from 'start' to the end of the file into at most 'range_count'
+    ranges of roughly equal size, each of which starts and ends on a row boundary. 'start'
+    must itself be a row boundary
+    """
+    size = os.path.getsize(path)
+    boundaries = [start]
+    with open(path, 'rb') as f:
+        in_quotes = False
+        counted_to = start
+        for r in range(1, range_count):
+            candidate = start + (size - start) * r // range_count
+            if candidate <= boundaries[-1]:
+                continue
+            in_quotes ^= _quote_count(f, counted_to, candidate) % 2 == 1
+            boundary = _next_row_start(f, candidate, in_quotes, size)
+            in_quotes = False
+            counted_to = boundary
+            if boundary >= size:
+                break
+            boundaries.append(boundary)
+    boundaries.append(size)
+    return [(boundaries[i], boundaries[i+1]) for i in range(len(boundaries) - 1)
+            if boundaries[i+1] > boundaries[i]]
+
+
+def count_rows(path, start=0):
+    """
+    Count the rows in 'path' from 'start', which must be a row boundary. If there are no quote
+    characters in the file, this is a count of the newlines over a memory map of the file;
+    otherwise, only newlines outside of quoted fields are counted
+    """
+    size = os.path.getsize(path)
+    if size <= start:
+        return 0
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            data = np.frombuffer(mm, dtype=np.uint8)
+            has_quotes = mm.find(b'"', start) != -1
+            rows = 0
+            in_quotes = 0
+            for block_start in range(start, size, READ_BLOCK_SIZE):
+                block = data[block_start:block_start + READ_BLOCK_SIZE]
+                newlines = block == NEWLINE
+                if has_quotes:
+                    # quote parity at each byte, carried over from the previous block
+                    parity = (np.cumsum(block == QUOTE) + in_quotes) & 1
+                    in_quotes = parity[-1]
+                    newlines &= parity == 0
+                    del parity
+                rows += np.count_nonzero(newlines)
+            last_byte = data[size - 1]
+            del block
+            del data
+    # a final row without a trailing newline
+    if last_byte != NEWLINE:
+        rows += 1
+    return rows
+
+
+def row_offsets(path, start=0):
+    """
+    The offset of the start of each row in 'path' from 'start', which must be a row boundary,
+    followed by the size of the file, so that row 'r' is the bytes from offsets[r] to
+    offsets[r+1]
+    """
+    size = os.path.getsize(path)
+    if size <= start:
+        return np.asarray([start], dtype=np.int64)
+    starts = [np.asarray([start], dtype=np.int64)]
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            data = np.frombuffer(mm, dtype=np.uint8)
+            has_quotes = mm.find(b'"', start) != -1
+            in_quotes = 0
+            for block_start in range(start, size, READ_BLOCK_SIZE):
+                block = data[block_start:block_start + READ_BLOCK_SIZE]
+                newlines = block == NEWLINE
+                if has_quotes:
+                    parity = (np.cumsum(block == QUOTE) + in_quotes) & 1
+                    in_quotes = parity[-1]
+                    newlines &= parity == 0
+                    del parity
+                starts.append(np.flatnonzero(newlines).astype(np.int64) + block_start + 1)
+            del block
+            del data
+    offsets = np.concatenate(starts)
+    # a final row without a trailing newline ends at the end of the file
+    if offsets[-1] != size:
+        offsets = np.append(offsets, size)
+    return offsets
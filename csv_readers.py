@@ -0,0 +1,338 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import csv
+import locale
+import time
+
+import numpy as np
+
+import compressed_io
+import dictionary_field
+import numeric_field
+import numpy_buffer
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.csv
+except ImportError:
+    pyarrow = None
+
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+# Reader backends parse the rows of a csv file, after its header, into batches of columns. A
+# batch is a list holding, for each column requested, the batch's values as strings, with empty
+# values as ''. The python backend gives each column as a list; the accelerated backends give
+# a StringColumn over their own arrays, so that Dataset can convert a whole column at a time
+# (into codes, packed ids, timestamps, numbers or a StringArena) without a python object per
+# value. Newlines within quoted values are translated as they are when the file is read in
+# text mode, so every backend gives the values that the stdlib csv module does and Dataset
+# builds the same fields whichever backend parsed the file, except that the arrow backend
+# builds plain string fields as StringArenas straight from its buffers.
+# The accelerated backends use the C tokenisers of pyarrow or pandas, and are only available
+# if those packages are installed. All of the backends read gzip compressed files, which
+# pyarrow and pandas recognise by their '.gz' extension.
+# 'auto' times each installed backend on the first AUTO_SAMPLE_ROWS rows of the file being
+# loaded and only picks an accelerated one if it loads them at least AUTO_MIN_SPEEDUP times as
+# fast as the python backend (see choose_reader).
+
+DEFAULT_BATCH_ROWS = 1 << 16
+AUTO_SAMPLE_ROWS = 1 << 16
+AUTO_MIN_SPEEDUP = 1.25
+AUTO_TIMING_RUNS = 2
+
+
+def _encoding(encoding):
+    return encoding or locale.getpreferredencoding(False)
+
+
+class StringColumn:
+    """
+    A column of a batch as a list of strings. Dataset converts columns through these methods,
+    which the accelerated backends override to work on their own arrays
+    """
+    def __init__(self, values):
+        self.values_ = values
+
+    def __len__(self):
+        return len(self.values_)
+
+    def strings(self):
+        return self.values_
+
+    def take(self, rows):
+        values = self.strings()
+        return StringColumn([values[r] for r in rows.tolist()])
+
+    def dictionary(self):
+        """
+        The column as a dictionary_field.DictionaryField
+        """
+        table = dict()
+        codes = np.fromiter((table.setdefault(v, len(table)) for v in self.strings()),
+                            dtype=np.int64, count=len(self))
+        return dictionary_field.from_codes(list(table.keys()), codes)
+
+    def arena(self):
+        """
+        The column as a numpy_buffer.StringArena
+        """
+        buffer = numpy_buffer.StringBuffer(len(self))
+        buffer.extend(self.strings())
+        return buffer.finalise()
+
+    def numbers(self, dtype):
+        """
+        The column converted as numeric_field.to_numeric converts it
+        """
+        return numeric_field.to_numeric(self.strings(), dtype)
+
+
+def as_column(values):
+    return values if isinstance(values, StringColumn) else StringColumn(values)
+
+
+class ArrowColumn(StringColumn):
+    """
+    A column of a batch as a pyarrow string array
+    """
+    def __init__(self, array):
+        super().__init__(None)
+        self.array_ = array
+
+    def __len__(self):
+        return len(self.array_)
+
+    def strings(self):
+        if self.values_ is None:
+            self.values_ = self.array_.to_pylist()
+        return self.values_
+
+    def take(self, rows):
+        return ArrowColumn(self.array_.take(pyarrow.array(rows)))
+
+    def dictionary(self):
+        encoded = self.array_.dictionary_encode()
+        return dictionary_field.from_codes(encoded.dictionary.to_pylist(),
+                                           encoded.indices.to_numpy(zero_copy_only=False))
+
+    def arena(self):
+        # the offsets and bytes are read from the array's buffers without decoding the strings
+        array = self.array_
+        _, offsets, data = array.buffers()
+        offset_dtype = np.int64 if pyarrow.types.is_large_string(array.type) else np.int32
+        offsets = np.frombuffer(offsets, dtype=offset_dtype)[array.offset:
+                                                            array.offset + len(array) + 1]
+        data = np.frombuffer(data, dtype=np.uint8) if data is not None\
+            else np.zeros(0, dtype=np.uint8)
+        return numpy_buffer.StringArena(offsets.astype(np.int64), data)
+
+    def numbers(self, dtype):
+        present = pyarrow.compute.not_equal(self.array_, '')
+        try:
+            present_values = pyarrow.compute.cast(self.array_.filter(present), pyarrow.float64())
+        except pyarrow.ArrowInvalid:
+            # report the value as the python backend would
+            return super().numbers(dtype)
+        present = present.to_numpy(zero_copy_only=False)
+        values = np.full(len(present), np.nan, dtype=dtype)
+        values[present] = present_values.to_numpy(zero_copy_only=False)
+        return values, ~present
+
+
+class PandasColumn(StringColumn):
+    """
+    A column of a batch as a pandas Series of strings
+    """
+    def __init__(self, series):
+        super().__init__(None)
+        self.series_ = series
+
+    def __len__(self):
+        return len(self.series_)
+
+    def strings(self):
+        if self.values_ is None:
+            self.values_ = self.series_.tolist()
+        return self.values_
+
+    def take(self, rows):
+        return PandasColumn(self.series_.iloc[rows])
+
+    def dictionary(self):
+        codes, values = pandas.factorize(self.series_, sort=True)
+        return dictionary_field.from_codes(list(values), codes)
+
+    def numbers(self, dtype):
+        return numeric_field.to_numeric(self.series_.to_numpy(dtype=np.str_), dtype)
+
+
+class PythonReader:
+    """
+    Parse with the stdlib csv module
+    """
+    name = 'python'
+    string_arenas = False
+
+    @staticmethod
+    def available():
+        return True
+
+    def batches(self, path, encoding, columns, batch_rows=DEFAULT_BATCH_ROWS, max_rows=None):
+        with compressed_io.open_text(path, encoding=_encoding(encoding)) as f:
+            csvr = csv.reader(f, delimiter=',', quotechar='"')
+            next(csvr, None)
+            batch = [list() for _ in columns]
+            for i_r, row in enumerate(csvr):
+                if max_rows is not None and i_r == max_rows:
+                    break
+                for values, i_c in zip(batch, columns):
+                    values.append(row[i_c])
+                if len(batch[0]) == batch_rows:
+                    yield batch
+                    batch = [list() for _ in columns]
+            if len(batch[0]) > 0:
+                yield batch
+
+
+class ArrowReader:
+    """
+    Parse with pyarrow.csv. 'batch_rows' is approximate, as pyarrow reads blocks of bytes
+    """
+    name = 'arrow'
+    string_arenas = True
+
+    @staticmethod
+    def available():
+        return pyarrow is not None
+
+    @staticmethod
+    def _column(array):
+        if pyarrow.compute.any(pyarrow.compute.match_substring(array, '\r')).as_py():
+            array = pyarrow.compute.replace_substring(array, '\r\n', '\n')
+            array = pyarrow.compute.replace_substring(array, '\r', '\n')
+        return ArrowColumn(array)
+
+    def batches(self, path, encoding, columns, batch_rows=DEFAULT_BATCH_ROWS, max_rows=None):
+        # columns are named by position, as the names in the header needn't be unique
+        with compressed_io.open_text(path, encoding=_encoding(encoding)) as f:
+            column_count = len(next(csv.reader(f, delimiter=',', quotechar='"')))
+        names = [f'f{i}' for i in range(column_count)]
+        distinct = list(dict.fromkeys(columns))
+        read_options = pyarrow.csv.ReadOptions(column_names=names, skip_rows=1,
+                                               encoding=_encoding(encoding),
+                                               block_size=batch_rows * 256)
+        parse_options = pyarrow.csv.ParseOptions(delimiter=',', quote_char='"',
+                                                 newlines_in_values=True)
+        convert_options = pyarrow.csv.ConvertOptions(
+            include_columns=[names[i] for i in distinct],
+            column_types={names[i]: pyarrow.string() for i in distinct},
+            strings_can_be_null=False, quoted_strings_can_be_null=False)
+        reader = pyarrow.csv.open_csv(path, read_options, parse_options, convert_options)
+        rows_read = 0
+        for record_batch in reader:
+            if max_rows is not None and rows_read + record_batch.num_rows > max_rows:
+                record_batch = record_batch.slice(0, max_rows - rows_read)
+            if record_batch.num_rows > 0:
+                values = {i: self._column(record_batch.column(i_d))
+                          for i_d, i in enumerate(distinct)}
+                yield [values[i] for i in columns]
+            rows_read += record_batch.num_rows
+            if max_rows is not None and rows_read == max_rows:
+                break
+
+
+class PandasReader:
+    """
+    Parse with the C parser of pandas.read_csv
+    """
+    name = 'pandas'
+    string_arenas = False
+
+    @staticmethod
+    def available():
+        return pandas is not None
+
+    @staticmethod
+    def _column(series):
+        if series.str.contains('\r', regex=False).any():
+            series = series.str.replace('\r\n', '\n', regex=False)
+            series = series.str.replace('\r', '\n', regex=False)
+        return PandasColumn(series)
+
+    def batches(self, path, encoding, columns, batch_rows=DEFAULT_BATCH_ROWS, max_rows=None):
+        # pandas gives the columns in file order, whatever order they are asked for in
+        distinct = sorted(set(columns))
+        chunks = pandas.read_csv(path, encoding=_encoding(encoding), usecols=distinct,
+                                 dtype=str, na_filter=False, keep_default_na=False,
+                                 engine='c', chunksize=batch_rows, nrows=max_rows)
+        for chunk in chunks:
+            if len(chunk) == 0:
+                continue
+            values = {i: self._column(chunk.iloc[:, i_d]) for i_d, i in enumerate(distinct)}
+            yield [values[i] for i in columns]
+
+
+READERS = {r.name: r for r in (PythonReader, ArrowReader, PandasReader)}
+# the order in which readers are preferred when the fastest available one is asked for
+PREFERRED_READERS = ('arrow', 'pandas', 'python')
+
+
+def available_readers():
+    return [n for n, r in READERS.items() if r.available()]
+
+
+def get_reader(name):
+    """
+    The reader backend called 'name', or the first installed one in PREFERRED_READERS if 'name'
+    is 'auto'. Dataset instead times the installed backends for 'auto' (see choose_reader)
+    """
+    if name == 'auto':
+        name = next(n for n in PREFERRED_READERS if READERS[n].available())
+    if name not in READERS:
+        raise ValueError(f"'{name}' is not a csv reader; expected one of "
+                         f"{list(READERS.keys()) + ['auto']}")
+    if not READERS[name].available():
+        raise ImportError(f"the '{name}' csv reader requires a package that isn't installed")
+    return READERS[name]()
+
+
+def choose_reader(load, sample_rows=AUTO_SAMPLE_ROWS, min_speedup=AUTO_MIN_SPEEDUP,
+                  progress=False):
+    """
+    Time 'load(reader, sample_rows)', which should load the first 'sample_rows' rows of a file
+    with 'reader', for each installed reader, taking the best of AUTO_TIMING_RUNS runs. The
+    fastest accelerated reader is returned if it is at least 'min_speedup' times as fast as the
+    python reader, and the python reader otherwise
+    """
+    if available_readers() == [PythonReader.name]:
+        return PythonReader()
+    timings = dict()
+    for name in available_readers():
+        reader = READERS[name]()
+        for _ in range(AUTO_TIMING_RUNS):
+            tstart = time.time()
+            load(reader, sample_rows)
+            elapsed = time.time() - tstart
+            timings[name] = min(elapsed, timings.get(name, elapsed))
+    fastest = min((n for n in timings if n != PythonReader.name), key=timings.get, default=None)
+    if progress:
+        print('csv reader timings:',
+              ', '.join(f'{n}: {t:.3f}s ({timings[PythonReader.name] / max(t, 1e-9):.1f}x)'
+                        for n, t in timings.items()))
+    if fastest is not None and\
+            timings[PythonReader.name] >= min_speedup * timings[fastest]:
+        return READERS[fastest]()
+    return PythonReader()
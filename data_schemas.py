@@ -27,6 +27,51 @@ class FieldDesc:
         return self.__str__()
 
 
+class DictionaryFieldDesc(FieldDesc):
+    """
+    Describes a string field that should be loaded as a dictionary_field.DictionaryField
+    """
+    def __init__(self, field):
+        super().__init__(field, None, None, str)
+
+    def __str__(self):
+        return 'DictionaryFieldDesc(field={})'.format(self.field)
+
+
+class HexIdFieldDesc(FieldDesc):
+    """
+    Describes a field of 32 character hex ids that should be loaded as a hex_id_field.HexIdField
+    """
+    def __init__(self, field):
+        super().__init__(field, None, None, str)
+
+    def __str__(self):
+        return 'HexIdFieldDesc(field={})'.format(self.field)
+
+
+class NumericFieldDesc(FieldDesc):
+    """
+    Describes a numeric field that should be loaded as a numeric_field.NumericField of 'dtype'
+    """
+    def __init__(self, field, dtype=np.float64):
+        super().__init__(field, None, None, dtype)
+
+    def __str__(self):
+        return 'NumericFieldDesc(field={}, dtype={})'.format(self.field,
+                                                             np.dtype(self.to_datatype).name)
+
+
+class TimestampFieldDesc(FieldDesc):
+    """
+    Describes a timestamp field that should be loaded as a timestamp_field.TimestampField
+    """
+    def __init__(self, field):
+        super().__init__(field, None, None, 'datetime64[us]')
+
+    def __str__(self):
+        return 'TimestampFieldDesc(field={})'.format(self.field)
+
+
 class FieldEntry:
     def __init__(self, field_desc, version_from, version_to=None):
         self.field_desc = field_desc
@@ -96,6 +141,15 @@ class DataSchema:
         ('tested_covid_positive_clean', [na_value_to, 'waiting', 'no', 'yes'], None, np.uint8, 1, None)
     ]
 
+    # fields holding 32 character hex ids, which are loaded packed (see hex_id_field.HexIdField)
+    patient_id_fields = ['id']
+    assessment_id_fields = ['id', 'patient_id']
+    # numeric fields, which are parsed when loaded (see numeric_field.NumericField). Patient
+    # fields are written back out as they were read, so only assessment fields are parsed
+    assessment_numeric_fields = {'temperature': np.float64}
+    # timestamp fields, which are parsed when loaded (see timestamp_field.TimestampField)
+    assessment_timestamp_fields = ['created_at', 'updated_at']
+
     field_entries = dict()
 
     for cf in categorical_fields:
@@ -111,6 +165,12 @@ class DataSchema:
         # TODO: field entries for patients!
         self.patient_categorical_maps = dict()
         self.assessment_categorical_maps = self._get_assessment_categorical_maps(version)
+        self.patient_field_descriptors =\
+            self._with_typed_fields(self.patient_categorical_maps, self.patient_id_fields)
+        self.assessment_field_descriptors =\
+            self._with_typed_fields(self.assessment_categorical_maps, self.assessment_id_fields,
+                                    self.assessment_numeric_fields,
+                                    self.assessment_timestamp_fields)
 
 
     def _validate_schema_number(self, schema):
@@ -118,6 +178,20 @@ class DataSchema:
             raise DataSchemaVersionError(f'{schema} is not a valid cleaning schema value')
 
 
+    def _with_typed_fields(self, categorical_maps, id_fields, numeric_fields=None,
+                           timestamp_fields=()):
+        # the categorical maps are used to write values back out, so id, numeric and timestamp
+        # fields are kept separate
+        field_descriptors = dict(categorical_maps)
+        for f in id_fields:
+            field_descriptors[f] = HexIdFieldDesc(f)
+        for f, dtype in (numeric_fields or dict()).items():
+            field_descriptors[f] = NumericFieldDesc(f, dtype)
+        for f in timestamp_fields:
+            field_descriptors[f] = TimestampFieldDesc(f)
+        return field_descriptors
+
+
     def _get_assessment_categorical_maps(self, version):
         self._validate_schema_number(version)
 
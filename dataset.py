@@ -10,10 +10,287 @@
 # limitations under the License.
 
 import csv
+import io
+import itertools
+import locale
+import multiprocessing
 import time
 import numpy as np
 
+import columnar_cache
+import compressed_io
+import csv_chunks
+import csv_readers
+import data_schemas
+import dictionary_field
+import hex_id_field
+import numeric_field
+import timestamp_field
 import numpy_buffer
+import row_index
+
+PARALLEL_RANGES_PER_WORKER = 4
+
+
+def _field_map(available_keys, keys, field_descriptors):
+    """
+    Get the names of the fields to load, the csv column of each, and the field descriptor for
+    every csv column, or None for columns without one
+    """
+    if not keys:
+        fields_to_use = available_keys
+        index_map = [i for i in range(len(fields_to_use))]
+    else:
+        fields_to_use = keys
+        index_map = [available_keys.index(k) for k in keys]
+
+    # build a full list of transforms by index whether they are are being filtered by 'keys' or not
+    transforms_by_index = list()
+    for i_n, n in enumerate(available_keys):
+        if field_descriptors and n in field_descriptors:
+            # transforms by csv field index
+            transforms_by_index.append(field_descriptors[n])
+        else:
+            transforms_by_index.append(None)
+    return fields_to_use, index_map, transforms_by_index
+
+
+def _predicate_map(available_keys, predicates):
+    """
+    Pair each predicate with the csv column of the field that it tests
+    """
+    if not predicates:
+        return None
+    return [(available_keys.index(p.field), p) for p in predicates]
+
+
+def _new_fields(index_map, transforms_by_index, size=None, auto_dictionary=False,
+                string_arenas=False):
+    """
+    Create a collection for each field to be loaded. If 'size' is given, each collection is
+    allocated at that size up front and filled in place. If 'string_arenas' is set, string
+    fields that aren't dictionary encoded are built as StringArenas rather than lists
+    """
+    new_fields = list()
+    for i_n in index_map:
+        transform = transforms_by_index[i_n]
+        if isinstance(transform, data_schemas.DictionaryFieldDesc):
+            new_fields.append(dictionary_field.DictionaryBuffer(size=size))
+        elif isinstance(transform, data_schemas.HexIdFieldDesc):
+            new_fields.append(hex_id_field.HexIdBuffer(size))
+        elif isinstance(transform, data_schemas.NumericFieldDesc):
+            new_fields.append(numeric_field.NumericBuffer(transform.to_datatype, size))
+        elif isinstance(transform, data_schemas.TimestampFieldDesc):
+            new_fields.append(timestamp_field.TimestampBuffer(size))
+        elif transform is None or transform.to_datatype == str:
+            if auto_dictionary:
+                new_fields.append(dictionary_field.DictionaryBuffer(
+                    dictionary_field.AUTO_DICTIONARY_MAX_VALUES, size, arena=True))
+            elif string_arenas:
+                new_fields.append(numpy_buffer.StringBuffer(size))
+            elif size is None:
+                new_fields.append(list())
+            else:
+                new_fields.append(numpy_buffer.FixedSizeListBuffer(size))
+            # new_fields.append(numpy_buffer.ListBuffer())
+        else:
+            new_fields.append(numpy_buffer.ColumnBuilder(transform.to_datatype, size))
+    return new_fields
+
+
+def _value_maps(index_map, transforms_by_index):
+    """
+    The strings_to_values map to apply to each field to be loaded, or None if the strings are
+    passed to the field's collection as they are
+    """
+    return [None if transforms_by_index[i_n] is None else transforms_by_index[i_n].strings_to_values
+            for i_n in index_map]
+
+
+def _extend_field(new_field, column, value_map):
+    """
+    Add a column of a batch from a reader backend (see csv_readers.StringColumn) to the
+    collection of a field, converting the whole column at once where the collection allows it
+    """
+    if value_map is not None:
+        # the map is applied to the distinct values of the column rather than to each row
+        dictionary = column.dictionary()
+        mapped = [value_map[v] for v in dictionary.values]
+        if isinstance(new_field, numpy_buffer.ColumnBuilder):
+            new_field.extend(np.asarray(mapped, dtype=new_field.dtype_)[dictionary.codes])
+            return
+        values = [mapped[c] for c in dictionary.codes.tolist()]
+    elif isinstance(new_field, dictionary_field.DictionaryBuffer):
+        new_field.extend(column.dictionary() if new_field.is_dictionary() else column.arena())
+        return
+    elif isinstance(new_field, (hex_id_field.HexIdBuffer, timestamp_field.TimestampBuffer,
+                                numpy_buffer.StringBuffer)):
+        new_field.extend(column.arena())
+        return
+    elif isinstance(new_field, numeric_field.NumericBuffer):
+        new_field.extend_values(*column.numbers(new_field.dtype_))
+        return
+    else:
+        values = column.strings()
+    if isinstance(new_field, list):
+        new_field.extend(values)
+    else:
+        for v in values:
+            new_field.append(v)
+
+
+def _concatenate_fields(parts, max_dictionary_values=None):
+    if isinstance(parts[0], np.ndarray):
+        return np.concatenate(parts)
+    if all(isinstance(p, dictionary_field.DictionaryField) for p in parts):
+        # fields that are dictionary encoded automatically fall back to a StringArena
+        return dictionary_field.concatenate(parts, max_dictionary_values,
+                                            arena=max_dictionary_values is not None)
+    if all(isinstance(p, hex_id_field.HexIdField) for p in parts):
+        return hex_id_field.concatenate(parts)
+    if all(isinstance(p, numeric_field.NumericField) for p in parts):
+        return numeric_field.concatenate(parts)
+    if all(isinstance(p, timestamp_field.TimestampField) for p in parts):
+        return timestamp_field.concatenate(parts)
+    if any(isinstance(p, timestamp_field.TimestampField) for p in parts):
+        # some of the parts fell back to strings, so the others give back theirs
+        parts = [p.source_strings() if isinstance(p, timestamp_field.TimestampField) else p
+                 for p in parts]
+    if any(isinstance(p, numpy_buffer.StringArena) for p in parts):
+        return numpy_buffer.concatenate_strings(parts)
+    return list(itertools.chain.from_iterable(parts))
+
+
+def _sort_keys(field):
+    """
+    Arrays that sort in the same order as the values of 'field', most significant first
+    """
+    if isinstance(field, dictionary_field.DictionaryField):
+        return [field.codes]
+    if isinstance(field, (hex_id_field.HexIdField, numeric_field.NumericField,
+                          timestamp_field.TimestampField)):
+        return list(field.sort_keys())
+    if isinstance(field, np.ndarray):
+        return [field]
+    # the strings are ranked among their distinct values, so that the key is an integer array
+    # rather than a fixed width string array as wide as the longest string
+    table = dict()
+    codes = np.fromiter((table.setdefault(v, len(table)) for v in field), dtype=np.int64,
+                        count=len(field))
+    return [dictionary_field.from_codes(list(table.keys()), codes).codes]
+
+
+def _is_sorted(sort_keys):
+    """
+    Check whether the rows are already in the order given by 'sort_keys', most significant
+    first, by comparing each row with the next one
+    """
+    # rows that are equal on all keys checked so far, and so are ordered by the next key
+    undecided = None
+    for k in sort_keys:
+        earlier = k[:-1]
+        later = k[1:]
+        descending = earlier > later
+        if undecided is not None:
+            descending &= undecided
+        if descending.any():
+            return False
+        equal = earlier == later
+        undecided = equal if undecided is None else undecided & equal
+        if not undecided.any():
+            break
+    return True
+
+
+def _print_progress(rows_read, rows_kept, row_total, tstart):
+    counts = f"{rows_read}" if rows_kept == rows_read else f"{rows_read} ({rows_kept})"
+    if row_total:
+        elapsed = time.time() - tstart
+        eta = elapsed * (row_total - rows_read) / rows_read if rows_read > 0 else 0
+        print(f"{counts} / {row_total} ({100 * rows_read / row_total:.1f}%), "
+              f"eta {eta:.0f} seconds")
+    else:
+        print(counts)
+
+
+def _finalise_fields(new_fields):
+    return [f if isinstance(f, list) else f.finalise() for f in new_fields]
+
+
+def _parse_range(task):
+    """
+    Parse the rows in a byte range of a csv file into a list of fields, as a worker process.
+    Also returns the rows of the range that were kept (or None if all were) and the number of
+    rows in the range
+    """
+    path, encoding, start, end, index_map, transforms_by_index, auto_dictionary, predicate_map =\
+        task
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    # match the universal newline translation that the serial loader gets from text mode files
+    text = data.decode(encoding or locale.getpreferredencoding(False))
+    del data
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+
+    new_fields = _new_fields(index_map, transforms_by_index, auto_dictionary=auto_dictionary)
+    value_maps = _value_maps(index_map, transforms_by_index)
+    kept_rows = numpy_buffer.ColumnBuilder(np.uint32) if predicate_map else None
+    row_count = 0
+    for row in csv.reader(io.StringIO(text, newline=''), delimiter=',', quotechar='"'):
+        row_count += 1
+        if predicate_map:
+            if not all(p(row[i_p]) for i_p, p in predicate_map):
+                continue
+            kept_rows.append(row_count - 1)
+        for i_df, i_f in enumerate(index_map):
+            f = row[i_f]
+            t = value_maps[i_df]
+            new_fields[i_df].append(f if t is None else t[f])
+    kept_rows = None if kept_rows is None else kept_rows.finalise()
+    return _finalise_fields(new_fields), kept_rows, row_count
+
+
+class PermutedFields:
+    """
+    The fields of a sorted dataset. Each field is permuted by the sorts that it hasn't yet been
+    permuted by the first time that it is read, so that sorting doesn't permute fields that are
+    never read again
+    """
+    def __init__(self, fields):
+        self.fields_ = list(fields)
+        self.pending_ = [None] * len(self.fields_)
+
+    def permute(self, permutation):
+        # fields with the same pending permutation share the composed permutation
+        composed = dict()
+        for i_f, pending in enumerate(self.pending_):
+            if pending is None:
+                self.pending_[i_f] = permutation
+            else:
+                if id(pending) not in composed:
+                    composed[id(pending)] = pending[permutation]
+                self.pending_[i_f] = composed[id(pending)]
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[i] for i in range(*item.indices(len(self)))]
+        permutation = self.pending_[item]
+        if permutation is not None:
+            self.fields_[item] = Dataset._apply_permutation(permutation, self.fields_[item])
+            self.pending_[item] = None
+        return self.fields_[item]
+
+    def __setitem__(self, item, field):
+        self.fields_[item] = field
+        self.pending_[item] = None
+
+    def __len__(self):
+        return len(self.fields_)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
 
 
 class Dataset:
@@ -22,88 +299,172 @@ class Dataset:
                        should be transformed when loading
     keys: a list of field names that represent the fields you wish to load and in what order they
           should be put. Leaving this blankloads all of the keys in csv column order
+    cache_dir: a directory in which to keep a columnar cache of the loaded fields. If the cache
+               holds the requested fields for the current version of the source file, loaded
+               with the same 'auto_dictionary', they are memory-mapped from it rather than
+               parsed; otherwise the source is parsed and the fields are added to the cache, or
+               replace it if it was written for another version of the source or other options.
+               String fields read from the cache are held in a numpy_buffer.StringArena.
+               Ignored for sources that aren't files and when filter_fn or stop_after are set
+    workers: the number of processes to parse the source with. If greater than 1, the source file
+             is split into byte ranges on row boundaries that are parsed in parallel and
+             concatenated in their original order. Ignored for sources that aren't uncompressed
+             files and when filter_fn or stop_after are set
+    preallocate: if set, count the rows of the source file in a pre-pass so that every field can
+                 be allocated once at its final size and filled in place. This also gives progress
+                 reporting a total and an estimated time remaining. Ignored for sources that
+                 aren't uncompressed files
+    predicates: a list of predicates (see predicates.py), each of which tests the value of a
+                field. Only rows for which every predicate holds are loaded. The fields tested
+                don't need to be among 'keys'. A dataset loaded with predicates is loaded from
+                the cache if its predicates only test string fields, but is never written to it
+    rows: the source rows to load, in the order in which they are to be loaded. Rather than
+          parsing the whole source, each row is read from its byte offset in the source file
+          (see row_index.py), so the memory used scales with the number of rows
+          requested. 'index_' is set to 'rows'. The rows are selected from the cache if it is
+          valid, but the cache is never written. Otherwise the source must not be compressed.
+          filter_fn, stop_after, workers, preallocate and predicates are ignored when rows are
+          set
+    auto_dictionary: if set, string fields without a field descriptor are dictionary encoded
+                     (see dictionary_field.DictionaryField) unless they turn out to have more than
+                     dictionary_field.AUTO_DICTIONARY_MAX_VALUES distinct values, in which case
+                     they are loaded as a numpy_buffer.StringArena. Fields can also be dictionary
+                     encoded individually with a data_schemas.DictionaryFieldDesc
+    reader: the reader backend to parse the source file with (see csv_readers.py), or the name of
+            one ('python', 'arrow', 'pandas', or 'auto' to time the installed backends on the
+            start of the file and use the fastest, falling back to 'python' if the others are
+            no faster). The fields loaded are the same whichever backend is used, except that
+            the arrow backend loads plain string fields as StringArenas. If not set, the source
+            is parsed row by row with the csv module. Ignored for sources that aren't files and
+            when filter_fn, stop_after, workers or rows are set
+    Fields of 32 character hex ids can be packed into 16 bytes per id by giving them a
+    data_schemas.HexIdFieldDesc (see hex_id_field.HexIdField), and numeric fields can be parsed
+    into arrays with a mask of missing values by giving them a data_schemas.NumericFieldDesc
+    (see numeric_field.NumericField). Timestamp fields can be parsed into datetime64 arrays by
+    giving them a data_schemas.TimestampFieldDesc (see timestamp_field.TimestampField)
     """
-    def __init__(self, source, field_descriptors=None, keys=None, filter_fn=None, progress=False, stop_after=None):
+    def __init__(self, source, field_descriptors=None, keys=None, filter_fn=None, progress=False,
+                 stop_after=None, cache_dir=None, workers=None, preallocate=False,
+                 auto_dictionary=False, predicates=None, rows=None, reader=None):
         self.names_ = list()
         self.fields_ = list()
         self.names_ = list()
         self.index_ = None
+        self.sorted_by_ = None
+
+        if rows is not None:
+            filter_fn = stop_after = workers = predicates = None
+            preallocate = False
+
+        cache_path = None
+        if cache_dir is not None and filter_fn is None and stop_after is None:
+            path = columnar_cache.source_path(source)
+            if path is not None:
+                cache_path = columnar_cache.cache_path_for(cache_dir, path)
+                source_fingerprint = columnar_cache.fingerprint(path)
+                if self._load_from_cache(cache_path, source_fingerprint, field_descriptors, keys,
+                                         predicates, rows, auto_dictionary):
+                    return
 
         csvf = csv.DictReader(source, delimiter=',', quotechar='"')
         #self.names_ = csvf.fieldnames
         available_keys = csvf.fieldnames
 
-        if not keys:
-            fields_to_use = available_keys
-            index_map = [i for i in range(len(fields_to_use))]
-        else:
-            fields_to_use = keys
-            index_map = [available_keys.index(k) for k in keys]
-
         tstart = time.time()
-        transforms_by_index = list()
+        fields_to_use, index_map, transforms_by_index =\
+            _field_map(available_keys, keys, field_descriptors)
+        predicate_map = _predicate_map(available_keys, predicates)
         new_fields = list()
 
-        # build a full list of transforms by index whether they are are being filtered by 'keys' or not
-        for i_n, n in enumerate(available_keys):
-            if field_descriptors and n in field_descriptors:
-                # transforms by csv field index
-                transforms_by_index.append(field_descriptors[n])
-            else:
-                transforms_by_index.append(None)
-
-        # build a new list of collections for every field that is to be loaded
-        for i_n in index_map:
-            if transforms_by_index[i_n] is not None:
-                to_datatype = transforms_by_index[i_n].to_datatype
-                if to_datatype == str:
-                    new_fields.append(list())
-                    # new_fields.append(numpy_buffer.ListBuffer())
-                else:
-                    # new_fields.append(numpy_buffer.NumpyBuffer(dtype=to_datatype))
-                    new_fields.append(numpy_buffer.NumpyBuffer2(dtype=to_datatype))
-            else:
-                new_fields.append(list())
-                # new_fields.append(numpy_buffer.ListBuffer())
+        path = columnar_cache.source_path(source)
+        # compressed sources can't be read from byte offsets (see compressed_io.py)
+        seekable_path = None if path is None or compressed_io.is_compressed(path) else path
+        if rows is not None:
+            if seekable_path is None:
+                raise ValueError("'rows' can only be loaded from an uncompressed source file")
+            self.fields_ = Dataset._load_rows(path, getattr(source, 'encoding', None), rows,
+                                              index_map, transforms_by_index, auto_dictionary)
+            self.index_ = np.asarray(rows, dtype=np.uint32)
+        elif workers is not None and workers > 1 and seekable_path is not None\
+          and filter_fn is None and stop_after is None:
+            self.fields_, self.index_ =\
+                Dataset._parallel_load(path, getattr(source, 'encoding', None), index_map,
+                                       transforms_by_index, workers, progress, auto_dictionary,
+                                       predicate_map)
+        elif reader is not None and path is not None\
+          and filter_fn is None and stop_after is None:
+            if reader == 'auto':
+                # time the installed readers on the start of the file
+                def load_sample(r, sample_rows):
+                    Dataset._reader_load(path, getattr(source, 'encoding', None), r, index_map,
+                                         transforms_by_index, False, auto_dictionary,
+                                         predicate_map, sample_rows)
+                reader = csv_readers.choose_reader(load_sample, progress=progress)
+            elif isinstance(reader, str):
+                reader = csv_readers.get_reader(reader)
+            self.fields_, self.index_ =\
+                Dataset._reader_load(path, getattr(source, 'encoding', None), reader, index_map,
+                                     transforms_by_index, progress, auto_dictionary,
+                                     predicate_map)
+        else:
+            row_total = None
+            field_size = None
+            if preallocate and seekable_path is not None:
+                row_total = csv_chunks.count_rows(path, csv_chunks.header_end(path))
+                field_size = row_total if not stop_after else min(row_total, stop_after + 1)
+                if progress:
+                    print(f"{row_total} rows to read")
 
-        # self.new_fields = [None] * len(self.names_)
-        # for i_t, t in enumerate(transforms_by_index):
-        #     self.new_fields[i_t] = [None] *
+            # build a new list of collections for every field that is to be loaded
+            new_fields = _new_fields(index_map, transforms_by_index, field_size, auto_dictionary)
+            value_maps = _value_maps(index_map, transforms_by_index)
 
-        # read the cvs rows into the fields
-        csvf = csv.reader(source, delimiter=',', quotechar='"')
-        ecsvf = iter(csvf)
-        filtered_count = 0
-        for i_r, row in enumerate(ecsvf):
+            # read the cvs rows into the fields
+            csvf = csv.reader(source, delimiter=',', quotechar='"')
+            ecsvf = iter(csvf)
+            kept_rows = numpy_buffer.ColumnBuilder(np.uint32)\
+                if filter_fn or predicate_map else None
+            filtered_count = 0
+            tparse = time.time()
+            for i_r, row in enumerate(ecsvf):
+                if progress:
+                    if i_r % 100000 == 0:
+                        _print_progress(i_r, filtered_count, row_total, tparse)
+                if (not filter_fn or filter_fn(i_r)) and\
+                  (not predicate_map or all(p(row[i_p]) for i_p, p in predicate_map)):
+                    # for i_f, f in enumerate(fields):
+                    for i_df, i_f in enumerate(index_map):
+                        f = row[i_f]
+                        t = value_maps[i_df]
+                        new_fields[i_df].append(f if t is None else t[f])
+                    del row
+                    if kept_rows is not None:
+                        kept_rows.append(i_r)
+                    filtered_count += 1
+                    if stop_after and i_r >= stop_after:
+                        break
             if progress:
-                if i_r % 100000 == 0:
-                    if filtered_count == i_r:
-                        print(i_r)
-                    else:
-                        print(f"{i_r} ({filtered_count})")
-            if not filter_fn or filter_fn(i_r):
-                # for i_f, f in enumerate(fields):
-                for i_df, i_f in enumerate(index_map):
-                    f = row[i_f]
-                    t = transforms_by_index[i_f]
-                    new_fields[i_df].append(f if not t else t.strings_to_values[f])
-                del row
-                filtered_count += 1
-                if stop_after and i_r >= stop_after:
-                    break
-        if progress:
-            print(i_r)
-
-        # assign the built sequences to fields_
-        for i_f, f in enumerate(new_fields):
-            if isinstance(f, list):
-                self.fields_.append(f)
-            else:
-                self.fields_.append(f.finalise())
-        self.index_ = np.asarray([i for i in range(len(self.fields_[0]))], dtype=np.uint32)
+                print(i_r)
+
+            # assign the built sequences to fields_
+            self.fields_ = _finalise_fields(new_fields)
+            if kept_rows is not None:
+                self.index_ = kept_rows.finalise()
+        if self.index_ is None:
+            self.index_ = np.asarray([i for i in range(len(self.fields_[0]))], dtype=np.uint32)
         self.names_ = fields_to_use
         print('loading took', time.time() - tstart, "seconds")
 
+        if cache_path is not None and not predicates and rows is None:
+            options = columnar_cache.load_options(auto_dictionary)
+            previous = columnar_cache.read_manifest(cache_path)
+            if not columnar_cache.is_valid_for(previous, source_fingerprint, (), {}, options):
+                previous = None
+            columnar_cache.write(cache_path, source_fingerprint, available_keys,
+                                 self.names_, self.fields_,
+                                 Dataset._descriptor_signatures(field_descriptors, self.names_),
+                                 options=options, previous=previous)
+
         #     if i > 0 and i % lines_per_dot == 0:
         #         if i % (lines_per_dot * newline_at) == 0:
         #             print(f'. {i}')
@@ -112,42 +473,293 @@ class Dataset:
         # if i % (lines_per_dot * newline_at) != 0:
         #     print(f' {i}')
 
-    def sort(self, keys):
+    @staticmethod
+    def _parallel_load(path, encoding, index_map, transforms_by_index, workers, progress,
+                       auto_dictionary, predicate_map=None):
+        ranges = csv_chunks.row_aligned_ranges(path, csv_chunks.header_end(path),
+                                               workers * PARALLEL_RANGES_PER_WORKER)
+        tasks = [(path, encoding, start, end, index_map, transforms_by_index, auto_dictionary,
+                  predicate_map)
+                 for start, end in ranges]
+        chunks = list()
+        kept_rows = list()
+        with multiprocessing.Pool(workers) as pool:
+            rows_parsed = 0
+            for chunk, kept, row_count in pool.imap(_parse_range, tasks):
+                chunks.append(chunk)
+                if kept is not None:
+                    kept_rows.append(kept.astype(np.int64) + rows_parsed)
+                rows_parsed += row_count
+                if progress:
+                    print(f'{rows_parsed} ({len(chunks)}/{len(tasks)} ranges)')
+
+        if len(chunks) == 0:
+            return _finalise_fields(_new_fields(index_map, transforms_by_index,
+                                                auto_dictionary=auto_dictionary)), None
+
+        index = np.concatenate(kept_rows).astype(np.uint32) if predicate_map else None
+        fields = list()
+        for i_f in range(len(index_map)):
+            auto_encoded = auto_dictionary and transforms_by_index[index_map[i_f]] is None
+            max_values = dictionary_field.AUTO_DICTIONARY_MAX_VALUES if auto_encoded else None
+            fields.append(_concatenate_fields([c[i_f] for c in chunks], max_values))
+            for c in chunks:
+                c[i_f] = None
+        return fields, index
+
+    @staticmethod
+    def _reader_load(path, encoding, reader, index_map, transforms_by_index, progress,
+                     auto_dictionary, predicate_map=None, max_rows=None):
+        """
+        Parse 'path', or its first 'max_rows' rows, a batch of columns at a time with a reader
+        backend, selecting the rows of each batch for which every predicate holds. Each column
+        is converted as a whole (see _extend_field)
+        """
+        columns = list(index_map) + [i_p for i_p, _ in predicate_map or ()]
+        new_fields = _new_fields(index_map, transforms_by_index, auto_dictionary=auto_dictionary,
+                                 string_arenas=reader.string_arenas)
+        value_maps = _value_maps(index_map, transforms_by_index)
+        kept_rows = list() if predicate_map else None
+        rows_read = 0
+        for batch in reader.batches(path, encoding, columns, max_rows=max_rows):
+            batch = [csv_readers.as_column(c) for c in batch]
+            batch_row_count = len(batch[0])
+            if predicate_map:
+                selected = np.ones(batch_row_count, dtype=np.bool_)
+                for (_, p), column in zip(predicate_map, batch[len(index_map):]):
+                    selected &= p.mask(column.dictionary())
+                kept = np.flatnonzero(selected)
+                kept_rows.append(kept + rows_read)
+            for i_df, column in enumerate(batch[:len(index_map)]):
+                if predicate_map:
+                    column = column.take(kept)
+                _extend_field(new_fields[i_df], column, value_maps[i_df])
+            rows_read += batch_row_count
+            if progress:
+                print(rows_read)
+
+        index = None
+        if predicate_map:
+            index = np.concatenate(kept_rows).astype(np.uint32) if len(kept_rows) > 0\
+                else np.zeros(0, dtype=np.uint32)
+        return _finalise_fields(new_fields), index
+
+    @staticmethod
+    def _load_rows(path, encoding, rows, index_map, transforms_by_index, auto_dictionary):
+        """
+        Read 'rows' from their byte offsets in 'path', using the row index of 'path' if it has
+        one (see row_index.py). The rows are read in source order and then put into the
+        requested order
+        """
+        index = row_index.read(path)
+        if index is not None:
+            offsets = index.offsets_
+        else:
+            offsets = csv_chunks.row_offsets(path, csv_chunks.header_end(path))
+        rows = np.asarray(rows, dtype=np.int64)
+        order = np.argsort(rows, kind='stable')
+
+        new_fields = _new_fields(index_map, transforms_by_index, len(rows), auto_dictionary)
+        value_maps = _value_maps(index_map, transforms_by_index)
+        for row in row_index.read_rows(path, offsets, rows[order].tolist(), encoding):
+            for i_df, i_f in enumerate(index_map):
+                f = row[i_f]
+                t = value_maps[i_df]
+                new_fields[i_df].append(f if t is None else t[f])
+        fields = _finalise_fields(new_fields)
+
+        # row 'order[i]' was read into position 'i'
+        permutation = np.empty_like(order)
+        permutation[order] = np.arange(len(order))
+        return [Dataset._apply_permutation(permutation, f) for f in fields]
+
+    @staticmethod
+    def iter_batches(source, batch_rows, keys=None, field_descriptors=None, progress=False):
+        """
+        Read 'source' up to 'batch_rows' rows at a time, yielding each batch of rows as a Dataset
+        whose 'index_' holds the source row of each row. Fields with a field descriptor are
+        transformed as they are when loading a Dataset; other fields are built as
+        numpy_buffer.StringArenas. Only the batch being built is held in memory, so a source can
+        be scanned in a single pass whatever its size
+        """
+        if batch_rows <= 0:
+            raise ValueError(f"'batch_rows' must be greater than 0 but is {batch_rows}")
+        return Dataset._iter_batches(source, batch_rows, keys, field_descriptors, progress)
+
+    @staticmethod
+    def _iter_batches(source, batch_rows, keys, field_descriptors, progress):
+        csvf = csv.reader(source, delimiter=',', quotechar='"')
+        available_keys = next(csvf)
+        fields_to_use, index_map, transforms_by_index =\
+            _field_map(available_keys, keys, field_descriptors)
+        value_maps = _value_maps(index_map, transforms_by_index)
+
+        batch_start = 0
+        row_count = 0
+        new_fields = _new_fields(index_map, transforms_by_index, batch_rows, string_arenas=True)
+        for row in csvf:
+            for i_df, i_f in enumerate(index_map):
+                f = row[i_f]
+                t = value_maps[i_df]
+                new_fields[i_df].append(f if t is None else t[f])
+            row_count += 1
+            if row_count == batch_rows:
+                yield Dataset._batch(fields_to_use, new_fields, batch_start)
+                batch_start += row_count
+                row_count = 0
+                new_fields = _new_fields(index_map, transforms_by_index, batch_rows,
+                                         string_arenas=True)
+                if progress:
+                    print(batch_start)
+        if row_count > 0:
+            yield Dataset._batch(fields_to_use, new_fields, batch_start)
+
+    @staticmethod
+    def _batch(names, new_fields, batch_start):
+        fields = _finalise_fields(new_fields)
+        return Dataset.from_fields(
+            names, fields, np.arange(batch_start, batch_start + len(fields[0]), dtype=np.uint32))
+
+    @staticmethod
+    def from_fields(names, fields, index):
+        """
+        Create a Dataset from fields that have already been built
+        """
+        ds = Dataset.__new__(Dataset)
+        ds.names_ = names
+        ds.fields_ = fields
+        ds.index_ = index
+        ds.sorted_by_ = None
+        return ds
+
+    @staticmethod
+    def _descriptor_signatures(field_descriptors, names):
+        signatures = dict()
+        for n in names:
+            descriptor = field_descriptors.get(n) if field_descriptors else None
+            signatures[n] = columnar_cache.descriptor_signature(descriptor)
+        return signatures
+
+    def _load_from_cache(self, cache_path, source_fingerprint, field_descriptors, keys,
+                         predicates=None, rows=None, auto_dictionary=False):
+        manifest = columnar_cache.read_manifest(cache_path)
+        if manifest is None:
+            return False
+        fields_to_use = list(keys) if keys else manifest['fieldnames']
+        predicate_fields = [p.field for p in predicates] if predicates else []
+        signatures = Dataset._descriptor_signatures(field_descriptors,
+                                                    fields_to_use + predicate_fields)
+        if not columnar_cache.is_valid_for(manifest, source_fingerprint,
+                                           fields_to_use + predicate_fields, signatures,
+                                           columnar_cache.load_options(auto_dictionary)):
+            return False
+        # predicates test csv values, which can't be recovered from transformed fields
+        for f in predicate_fields:
+            descriptor = field_descriptors.get(f) if field_descriptors else None
+            if descriptor is not None and descriptor.to_datatype != str:
+                return False
+
+        tstart = time.time()
+        self.fields_ = columnar_cache.read_columns(cache_path, manifest, fields_to_use)
+        self.names_ = fields_to_use
+        index = columnar_cache.read_index(cache_path, manifest)
+        self.index_ = np.arange(manifest['row_count'], dtype=np.uint32) if index is None else index
+        if 'sorted_by' in manifest:
+            self.sorted_by_ = tuple(manifest['sorted_by'])
+        if predicates:
+            selected = np.ones(manifest['row_count'], dtype=np.bool_)
+            predicate_fields = columnar_cache.read_columns(cache_path, manifest, predicate_fields)
+            for p, f in zip(predicates, predicate_fields):
+                selected &= p.mask(f)
+            rows = np.flatnonzero(selected)
+            self.fields_ = [Dataset._apply_permutation(rows, f) for f in self.fields_]
+            self.index_ = rows.astype(np.uint32) if index is None else index[rows]
+        elif rows is not None:
+            # the cache may be sorted, so find where each source row is in it
+            positions = np.asarray(rows, dtype=np.int64)
+            if index is not None:
+                cache_rows = np.empty(len(index), dtype=np.int64)
+                cache_rows[index] = np.arange(len(index))
+                positions = cache_rows[positions]
+            self.fields_ = [Dataset._apply_permutation(positions, f) for f in self.fields_]
+            self.index_ = np.asarray(rows, dtype=np.uint32)
+            self.sorted_by_ = None
+        print('loading from cache took', time.time() - tstart, "seconds")
+        return True
+
+    def sort(self, keys, lazy=True):
+        """
+        Sort the rows of the dataset by the fields named in 'keys', most significant first. The
+        sort is stable, and 'index_' maps each sorted row back to its row in the source.
+        If 'lazy' is set, each field is only permuted the first time that it is read through
+        'fields_' or 'field_by_name' (see PermutedFields); otherwise all fields are permuted
+        before returning.
+        If the rows are already in order, they are left as they are. 'sorted_by_' records the
+        keys that the rows are known to be ordered by, so that sorting again by those keys (or
+        a leading subset of them) does nothing
+        """
+        keys = tuple(keys)
+        if self.sorted_by_ is not None and self.sorted_by_[:len(keys)] == keys:
+            return
+
         #map names to indices
         kindices = [self.field_to_index(k) for k in keys]
+        sort_keys = list()
+        for i in kindices:
+            sort_keys.extend(_sort_keys(self.fields_[i]))
+        if _is_sorted(sort_keys):
+            self.sorted_by_ = keys
+            return
+        # np.lexsort sorts on its last key first
+        permutation = np.lexsort(sort_keys[::-1])
+        del sort_keys
+        self.sorted_by_ = keys
 
-        def index_sort(indices):
-            def inner_(r):
-                t = tuple(self.fields_[i][r] for i in indices)
-                return t
-            return inner_
+        self.index_ = self.index_[permutation]
+        if lazy:
+            if not isinstance(self.fields_, PermutedFields):
+                self.fields_ = PermutedFields(self.fields_)
+            self.fields_.permute(permutation)
+        else:
+            for i_f in range(len(self.fields_)):
+                unsorted_field = self.fields_[i_f]
+                self.fields_[i_f] = Dataset._apply_permutation(permutation, unsorted_field)
+                del unsorted_field
 
-        self.index_ = sorted(self.index_, key=index_sort(kindices))
+    def take(self, indices):
+        """
+        Create a Dataset of the rows at 'indices', in that order, with the same field names.
+        Its fields are compacted copies that don't refer to the fields of this dataset, so this
+        dataset can be released once the new one is built. 'index_' still maps each row back to
+        its row in the source, and fields with pending sort permutations (see PermutedFields)
+        are read through the permutation rather than being permuted in full first
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if isinstance(self.fields_, PermutedFields):
+            fields = [Dataset._apply_permutation(indices if p is None else p[indices], f)
+                      for f, p in zip(self.fields_.fields_, self.fields_.pending_)]
+        else:
+            fields = [Dataset._apply_permutation(indices, f) for f in self.fields_]
+        ds = Dataset.from_fields(list(self.names_), fields, self.index_[indices])
+        # a subsequence of sorted rows is still sorted
+        if self.sorted_by_ is not None and np.all(indices[1:] > indices[:-1]):
+            ds.sorted_by_ = self.sorted_by_
+        return ds
 
-        for i_f in range(len(self.fields_)):
-            unsorted_field = self.fields_[i_f]
-            self.fields_[i_f] = Dataset._apply_permutation(self.index_, unsorted_field)
-            del unsorted_field
+    def filter(self, mask):
+        """
+        Create a Dataset of the rows for which the boolean array 'mask' is set (see 'take')
+        """
+        return self.take(np.flatnonzero(mask))
 
     @staticmethod
     def _apply_permutation(permutation, field):
-        # n = len(permutation)
-        # for i in range(0, n):
-        #     print(i)
-        #     pi = permutation[i]
-        #     while pi < i:
-        #         pi = permutation[pi]
-        #     fields[i], fields[pi] = fields[pi], fields[i]
-        # return fields
         if isinstance(field, list):
-            sorted_field = [None] * len(field)
-            for ip, p in enumerate(permutation):
-                sorted_field[ip] = field[p]
-        else:
-            sorted_field = np.empty_like(field)
-            for ip, p in enumerate(permutation):
-                sorted_field[ip] = field[p]
-        return sorted_field
+            indices = permutation.tolist() if isinstance(permutation, np.ndarray) else permutation
+            return [field[p] for p in indices]
+        if isinstance(field, np.ndarray):
+            return field[np.asarray(permutation)]
+        return field.take(permutation)
 
     def field_by_name(self, field_name):
         return self.fields_[self.field_to_index(field_name)]
@@ -0,0 +1,202 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+
+import numpy as np
+
+import numpy_buffer
+
+AUTO_DICTIONARY_MAX_VALUES = 1 << 16
+
+
+def _code_dtype(value_count):
+    if value_count <= 1 << 8:
+        return np.uint8
+    if value_count <= 1 << 16:
+        return np.uint16
+    return np.uint32
+
+
+class DictionaryField:
+    """
+    A string field stored as an array of integer codes into a table of its distinct values.
+    The table is kept in sorted order so that the codes order in the same way as the strings,
+    meaning that sorting, comparison and grouping can all be done on the codes
+    """
+    def __init__(self, codes, values):
+        self.codes = codes
+        self.values = values
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return DictionaryField(self.codes[item], self.values)
+        return self.values[self.codes[item]]
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __iter__(self):
+        values = self.values
+        for c in self.codes:
+            yield values[c]
+
+    def take(self, indices):
+        return DictionaryField(self.codes[indices], self.values)
+
+    def copy(self):
+        return DictionaryField(self.codes.copy(), self.values)
+
+    def code_of(self, value):
+        """
+        The code for 'value', or -1 if it doesn't occur in the field
+        """
+        i = bisect.bisect_left(self.values, value)
+        if i < len(self.values) and self.values[i] == value:
+            return i
+        return -1
+
+    def equals(self, value):
+        return self.codes == self.code_of(value)
+
+    def isin(self, values):
+        if len(values) > len(self.values):
+            # look the distinct values up in 'values' rather than each of 'values' in the table
+            value_set = values if isinstance(values, (set, frozenset)) else set(values)
+            found = np.fromiter((v in value_set for v in self.values), dtype=np.bool_,
+                                count=len(self.values))
+            return found[self.codes]
+        codes = [self.code_of(v) for v in values]
+        return np.isin(self.codes, [c for c in codes if c != -1])
+
+    def value_counts(self):
+        counts = np.bincount(self.codes, minlength=len(self.values))
+        return [(v, int(counts[i])) for i, v in enumerate(self.values)]
+
+
+def concatenate(parts, max_values=None, arena=False):
+    """
+    Concatenate DictionaryFields built over different parts of a source, merging their tables.
+    If the merged table has more than 'max_values' entries, a list of strings is returned instead,
+    or a StringArena if 'arena' is set
+    """
+    values = sorted(set().union(*[p.values for p in parts]))
+    if max_values is not None and len(values) > max_values:
+        if arena:
+            return numpy_buffer.concatenate_strings(parts)
+        result = list()
+        for p in parts:
+            result.extend(p)
+        return result
+    dtype = _code_dtype(len(values))
+    remapped = list()
+    for p in parts:
+        remap = np.searchsorted(values, p.values).astype(dtype) if len(p.values) > 0\
+            else np.zeros(0, dtype=dtype)
+        remapped.append(remap[p.codes])
+    return DictionaryField(np.concatenate(remapped) if len(remapped) > 0
+                           else np.zeros(0, dtype=dtype), values)
+
+
+def from_codes(values, codes):
+    """
+    A DictionaryField of codes into a table of distinct values in any order, which is sorted
+    """
+    order = sorted(range(len(values)), key=values.__getitem__)
+    remap = np.zeros(len(values), dtype=_code_dtype(len(values)))
+    remap[order] = np.arange(len(values))
+    return DictionaryField(remap[codes], [values[i] for i in order])
+
+
+class DictionaryBuffer:
+    """
+    Build a DictionaryField from appended strings. If 'max_values' is set and the field turns out
+    to have more distinct values than that, the buffer falls back to building a list of strings,
+    or a StringArena if 'arena' is set
+    """
+    def __init__(self, max_values=None, size=None, arena=False):
+        self.max_values_ = max_values
+        self.size_ = size
+        self.arena_ = arena
+        self.table_ = dict()
+        self.codes_ = numpy_buffer.ColumnBuilder(np.uint32, size)
+        self.list_ = None
+
+    def append(self, value):
+        if self.list_ is not None:
+            self.list_.append(value)
+            return
+        code = self.table_.get(value)
+        if code is None:
+            if self.max_values_ is not None and len(self.table_) == self.max_values_:
+                self._to_list()
+                self.list_.append(value)
+                return
+            code = len(self.table_)
+            self.table_[value] = code
+        self.codes_.append(code)
+
+    def extend(self, values):
+        """
+        Append a DictionaryField, whose distinct values are added to the table together, or a
+        sequence of strings once the buffer has fallen back to them (see is_dictionary)
+        """
+        if self.list_ is None and isinstance(values, DictionaryField):
+            table = self.table_
+            new_values = [v for v in values.values if v not in table]
+            if self.max_values_ is None or len(table) + len(new_values) <= self.max_values_:
+                for v in new_values:
+                    table[v] = len(table)
+                remap = np.asarray([table[v] for v in values.values], dtype=np.uint32)
+                self.codes_.extend(remap[values.codes])
+                return
+            self._to_list()
+        if self.list_ is None:
+            for v in values:
+                self.append(v)
+        elif isinstance(self.list_, (list, numpy_buffer.StringBuffer)):
+            self.list_.extend(values)
+        else:
+            for v in values:
+                self.list_.append(v)
+
+    def is_dictionary(self):
+        """
+        Whether the buffer is still building a DictionaryField rather than a list of strings
+        """
+        return self.list_ is None
+
+    def _to_list(self):
+        values = list(self.table_.keys())
+        codes = self.codes_.finalise()
+        if self.arena_:
+            self.list_ = numpy_buffer.StringBuffer(self.size_)
+            self.list_.extend([values[c] for c in codes])
+        elif self.size_ is None:
+            self.list_ = [values[c] for c in codes]
+        else:
+            self.list_ = numpy_buffer.FixedSizeListBuffer(self.size_)
+            for c in codes:
+                self.list_.append(values[c])
+        self.codes_ = None
+        self.table_ = None
+
+    def finalise(self):
+        if self.list_ is not None:
+            return self.list_ if isinstance(self.list_, list) else self.list_.finalise()
+        codes = self.codes_.finalise()
+        values = sorted(self.table_.keys())
+        remap = np.zeros(len(values), dtype=_code_dtype(len(values)))
+        for i_v, v in enumerate(values):
+            remap[self.table_[v]] = i_v
+        self.codes_ = None
+        self.table_ = None
+        return DictionaryField(remap[codes], values)
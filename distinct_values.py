@@ -0,0 +1,113 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+
+from dictionary_field import DictionaryField
+
+# Many fields hold few distinct values relative to their row count (years of birth, heights,
+# weights, temperatures). A functor that cleans such fields a row at a time can instead be run
+# on one representative row of each distinct combination of its inputs, and its results and
+# flags broadcast back to every row through the inverse index of the factorisation.
+# This gives the same results as running the functor on every row, provided that the functor
+# treats each row independently, as the cleaning functors in 'processing' do: each row's results
+# and flags depend only on that row's inputs, including the flags and any arrays that it
+# writes to, all of which are part of the factorisation. The age and weight / height / bmi
+# functors use it for their string inputs.
+
+# don't factorise columns whose distinct combinations are more than this fraction of their rows
+MAX_DISTINCT_FRACTION = 0.5
+
+
+def factorise(field):
+    """
+    Factorise a field into integer codes, such that two rows have the same code if and only if
+    they have the same value. Returns the codes and the number of codes, which may include
+    codes that no row has
+    """
+    if isinstance(field, DictionaryField):
+        return field.codes, len(field.values)
+    if isinstance(field, np.ndarray):
+        distinct, codes = np.unique(field, return_inverse=True)
+        return codes, len(distinct)
+    if hasattr(field, 'sort_keys'):
+        return factorise_rows(field.sort_keys())
+    codes_by_value = dict()
+    codes = np.fromiter((codes_by_value.setdefault(v, len(codes_by_value)) for v in field),
+                        dtype=np.int64, count=len(field))
+    return codes, len(codes_by_value)
+
+
+def factorise_rows(columns):
+    """
+    Factorise the rows of several columns of the same length into integer codes, such that two
+    rows have the same code if and only if they have the same value in every column. Returns
+    the codes and the number of codes
+    """
+    key = None
+    key_count = 1
+    for column in columns:
+        codes, count = factorise(column)
+        codes = np.asarray(codes, dtype=np.int64)
+        if key is None:
+            key, key_count = codes, count
+        else:
+            if key_count * count >= 1 << 62:
+                # renumber the combined key so that it stays within an int64
+                _, key = np.unique(key, return_inverse=True)
+                key_count = int(key.max()) + 1 if len(key) > 0 else 0
+            key = key * count + codes
+            key_count *= count
+    if key is None:
+        raise ValueError("at least one column must be given")
+    distinct, codes = np.unique(key, return_inverse=True)
+    return codes, len(distinct)
+
+
+def _take(field, rows):
+    if isinstance(field, list):
+        return [field[r] for r in rows.tolist()]
+    if isinstance(field, np.ndarray):
+        return field[rows]
+    return field.take(rows)
+
+
+def _broadcast(result, inverse, distinct_count):
+    if isinstance(result, np.ndarray) and len(result) == distinct_count:
+        return result[inverse]
+    if isinstance(result, tuple):
+        return tuple(_broadcast(r, inverse, distinct_count) for r in result)
+    return result
+
+
+def apply_by_distinct(fn, *columns, max_distinct_fraction=MAX_DISTINCT_FRACTION):
+    """
+    Call 'fn(*columns)' once per distinct combination of the rows of 'columns', rather than on
+    every row. The writeable numpy arrays among 'columns' (flags and output arrays) are updated
+    as 'fn' would have updated them, and arrays that 'fn' returns, alone or in a tuple, are
+    expanded back to one entry per row. 'fn' is called on all of the rows if more than
+    'max_distinct_fraction' of them are distinct
+    """
+    row_count = len(columns[0])
+    if row_count == 0:
+        return fn(*columns)
+    inverse, distinct_count = factorise_rows(columns)
+    if distinct_count > max_distinct_fraction * row_count:
+        return fn(*columns)
+
+    # the first row of each distinct combination
+    _, representatives = np.unique(inverse, return_index=True)
+    distinct_columns = [_take(c, representatives) for c in columns]
+    result = fn(*distinct_columns)
+    for c, d in zip(columns, distinct_columns):
+        if isinstance(c, np.ndarray) and c.flags.writeable:
+            c[:] = d[inverse]
+    return _broadcast(result, inverse, distinct_count)
@@ -0,0 +1,389 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import csv
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import columnar_cache
+import compressed_io
+import dataset
+import dictionary_field
+import hex_id_field
+import numeric_field
+import timestamp_field
+
+# An external sort of a csv file into a columnar cache (see columnar_cache), for files whose
+# parsed fields don't fit in memory:
+#  * the file is parsed in runs whose estimated size fits within the memory budget; each run is
+#    sorted and spilled to a temporary columnar cache
+#  * the runs are memory-mapped and merged a block of rows at a time. The rows of each block
+#    that can't be preceded by rows yet to be read from any run are sorted and written out
+# Rows that compare equal on the sort keys are ordered by source row, so the result is the
+# same as a stable in-memory sort. The sorted cache is then loaded by Dataset like any other.
+
+DEFAULT_MEMORY_BUDGET = 1 << 30
+ROW_SIZE_SAMPLE = 1000
+POINTER_SIZE = 8
+
+
+def _row_size(row, index_map, transforms_by_index):
+    """
+    Estimate the memory taken by the fields of a parsed row
+    """
+    size = 0
+    for i_f in index_map:
+        transform = transforms_by_index[i_f]
+        if transform is None or transform.to_datatype == str:
+            size += sys.getsizeof(row[i_f]) + POINTER_SIZE
+        else:
+            size += np.dtype(transform.to_datatype).itemsize
+    return size
+
+
+def _encoded(values):
+    # utf-8 bytes order in the same way as the strings that they encode
+    return np.array([v.encode('utf-8') for v in values], dtype=np.bytes_)
+
+
+def _rows_not_after(keys, cutoff):
+    """
+    A mask of the rows whose keys are less than or equal to the row of keys 'cutoff'
+    """
+    result = np.zeros(len(keys[0]), dtype=np.bool_)
+    undecided = np.ones(len(keys[0]), dtype=np.bool_)
+    for k, c in zip(keys, cutoff):
+        result |= undecided & (k < c)
+        undecided &= k == c
+    return result | undecided
+
+
+class _ArrayColumn:
+    def __init__(self, cache_path, file_stem, dtype, row_count):
+        self.values_ = np.lib.format.open_memmap(os.path.join(cache_path, file_stem + '.npy'),
+                                                 mode='w+', dtype=dtype, shape=(row_count,))
+
+    def write(self, start, values):
+        self.values_[start:start + len(values)] = values
+
+    def close(self):
+        self.values_.flush()
+        del self.values_
+
+
+class _NumericColumn:
+    def __init__(self, cache_path, file_stem, dtype, row_count):
+        self.values_ = _ArrayColumn(cache_path, file_stem, dtype, row_count)
+        self.missing_ = _ArrayColumn(cache_path, file_stem + '.missing', np.bool_, row_count)
+
+    def write(self, start, block):
+        self.values_.write(start, block['value'])
+        self.missing_.write(start, block['missing'])
+
+    def close(self):
+        self.values_.close()
+        self.missing_.close()
+
+
+class _TimestampColumn:
+    def __init__(self, cache_path, file_stem, row_count):
+        self.timestamps_ = _ArrayColumn(cache_path, file_stem, timestamp_field.TIMESTAMP_DTYPE,
+                                        row_count)
+        self.days_ = _ArrayColumn(cache_path, file_stem + '.days', np.int32, row_count)
+
+    def write(self, start, block):
+        self.timestamps_.write(start, block)
+        self.days_.write(start, timestamp_field.to_days(block))
+
+    def close(self):
+        self.timestamps_.close()
+        self.days_.close()
+
+
+class _StringColumn:
+    def __init__(self, cache_path, file_stem, row_count):
+        self.offsets_ = np.lib.format.open_memmap(
+            os.path.join(cache_path, file_stem + '.offsets.npy'),
+            mode='w+', dtype=np.int64, shape=(row_count + 1,))
+        self.offsets_[0] = 0
+        self.data_ = open(os.path.join(cache_path, file_stem + '.bytes'), 'wb')
+
+    def write(self, start, values):
+        lengths = np.fromiter((len(v) for v in values), dtype=np.int64, count=len(values))
+        end = start + len(values)
+        self.offsets_[start + 1:end + 1] = self.offsets_[start] + np.cumsum(lengths)
+        self.data_.write(b''.join(values))
+
+    def close(self):
+        self.offsets_.flush()
+        del self.offsets_
+        self.data_.close()
+
+
+class _MergeColumn:
+    """
+    Reads blocks of a field from each run in a form that can be combined across runs, and
+    writes the merged field to the sorted cache
+    """
+    def __init__(self, cache_path, file_stem, runs, max_dictionary_values):
+        self.runs_ = runs
+        row_count = sum(len(r) for r in runs)
+        if all(isinstance(r, np.ndarray) for r in runs):
+            self.kind = 'array'
+            self.column_ = _ArrayColumn(cache_path, file_stem, runs[0].dtype, row_count)
+        elif all(isinstance(r, hex_id_field.HexIdField) for r in runs):
+            self.kind = 'hexid'
+            self.column_ = _ArrayColumn(cache_path, file_stem, hex_id_field.ID_DTYPE, row_count)
+        elif all(isinstance(r, numeric_field.NumericField) for r in runs):
+            self.kind = 'numeric'
+            self.dtype_ = np.dtype([('missing', np.bool_), ('value', runs[0].dtype)])
+            self.column_ = _NumericColumn(cache_path, file_stem, runs[0].dtype, row_count)
+        elif all(isinstance(r, timestamp_field.TimestampField) for r in runs):
+            self.kind = 'timestamp'
+            self.column_ = _TimestampColumn(cache_path, file_stem, row_count)
+        else:
+            self.kind = 'strings'
+            if all(isinstance(r, dictionary_field.DictionaryField) for r in runs):
+                values = sorted(set().union(*[r.values for r in runs]))
+                if max_dictionary_values is None or len(values) <= max_dictionary_values:
+                    self.kind = 'dictionary'
+                    columnar_cache.write_strings(cache_path, file_stem + '.values', values)
+                    dtype = dictionary_field._code_dtype(len(values))
+                    self.remaps_ = [np.searchsorted(values, r.values).astype(dtype)
+                                    if len(r.values) > 0 else np.zeros(0, dtype=dtype)
+                                    for r in runs]
+                    self.column_ = _ArrayColumn(cache_path, file_stem, dtype, row_count)
+            if self.kind == 'strings':
+                self.column_ = _StringColumn(cache_path, file_stem, row_count)
+
+    def block(self, i_r, start, end):
+        run = self.runs_[i_r]
+        if self.kind == 'array':
+            return run[start:end]
+        if self.kind == 'hexid':
+            return run.ids[start:end]
+        if self.kind == 'numeric':
+            block = np.empty(end - start, dtype=self.dtype_)
+            block['missing'] = run.missing[start:end]
+            block['value'] = run.values[start:end]
+            return block
+        if self.kind == 'timestamp':
+            return run.timestamps[start:end]
+        if self.kind == 'dictionary':
+            return self.remaps_[i_r][run.codes[start:end]]
+        if isinstance(run, dictionary_field.DictionaryField):
+            return _encoded(run.values)[run.codes[start:end]]
+        return _encoded(run[start:end])
+
+    def sort_keys(self, block):
+        if self.kind == 'hexid':
+            return [block['hi'], block['lo']]
+        if self.kind == 'numeric':
+            return list(numeric_field.NumericField(block['value'], block['missing']).sort_keys())
+        if self.kind == 'timestamp':
+            return [block.view(np.int64)]
+        return [block]
+
+    def write(self, start, block):
+        if self.kind == 'strings':
+            block = block.tolist()
+        self.column_.write(start, block)
+
+    def close(self):
+        self.column_.close()
+
+
+def _spill_runs(path, encoding, runs_dir, index_map, transforms_by_index, sort_indices,
+                memory_budget, auto_dictionary, progress):
+    """
+    Parse 'path' in runs that fit within 'memory_budget', writing each run, sorted, to a
+    columnar cache in 'runs_dir'. Returns the paths of the runs and the number of rows per run
+    """
+    value_maps = dataset._value_maps(index_map, transforms_by_index)
+    run_paths = list()
+    with compressed_io.open_text(path, encoding=encoding) as f:
+        csvr = csv.reader(f, delimiter=',', quotechar='"')
+        next(csvr)
+
+        first_row = 0
+        run_rows = None
+        sampled_size = 0
+        new_fields = dataset._new_fields(index_map, transforms_by_index,
+                                         auto_dictionary=auto_dictionary)
+        row_count = 0
+
+        def spill():
+            fields = dataset._finalise_fields(new_fields)
+            sort_keys = list()
+            for i in sort_indices:
+                sort_keys.extend(dataset._sort_keys(fields[i]))
+            permutation = np.lexsort(sort_keys[::-1])
+            del sort_keys
+            fields = [dataset.Dataset._apply_permutation(permutation, fld) for fld in fields]
+            index = (np.arange(row_count, dtype=np.uint32) + first_row)[permutation]
+            run_path = os.path.join(runs_dir, f'run_{len(run_paths):06d}')
+            columnar_cache.write(run_path, None, [], [str(i) for i in range(len(fields))],
+                                 fields, dict(), index)
+            run_paths.append(run_path)
+            if progress:
+                print(f'run {len(run_paths)}: sorted {row_count} rows')
+
+        for row in csvr:
+            if run_rows is None:
+                sampled_size += _row_size(row, index_map, transforms_by_index)
+            for i_df, i_f in enumerate(index_map):
+                f = row[i_f]
+                t = value_maps[i_df]
+                new_fields[i_df].append(f if t is None else t[f])
+            row_count += 1
+            if run_rows is None and row_count == ROW_SIZE_SAMPLE:
+                # sorting a run takes up to twice the memory of its fields
+                run_rows = max(ROW_SIZE_SAMPLE,
+                               memory_budget // max(1, 2 * sampled_size // row_count))
+            if run_rows is not None and row_count >= run_rows:
+                spill()
+                first_row += row_count
+                row_count = 0
+                new_fields = dataset._new_fields(index_map, transforms_by_index,
+                                                 auto_dictionary=auto_dictionary)
+        if row_count > 0 or len(run_paths) == 0:
+            spill()
+        if run_rows is None:
+            run_rows = ROW_SIZE_SAMPLE
+    return run_paths, run_rows
+
+
+def _merge_runs(run_paths, run_rows, cache_path, names, sort_indices, max_dictionary_values):
+    """
+    Merge sorted runs into columns of 'cache_path', returning the column entries for the
+    manifest, the source row of each merged row and the merged row count
+    """
+    manifests = [columnar_cache.read_manifest(p) for p in run_paths]
+    run_names = [str(i) for i in range(len(names))]
+    run_fields = [columnar_cache.read_columns(p, m, run_names)
+                  for p, m in zip(run_paths, manifests)]
+    run_indices = [columnar_cache.read_index(p, m) for p, m in zip(run_paths, manifests)]
+    run_lengths = [len(i) for i in run_indices]
+    row_count = sum(run_lengths)
+
+    columns = [_MergeColumn(cache_path, f'col_{i_f:04d}', [rf[i_f] for rf in run_fields],
+                            max_dictionary_values[i_f])
+               for i_f in range(len(names))]
+    index = np.zeros(row_count, dtype=np.uint32)
+
+    # the merge holds a block from each run, and a sorted copy of the rows taken from them
+    block_rows = max(1, run_rows // (2 * len(run_paths)))
+    positions = [0] * len(run_paths)
+    written = 0
+    while written < row_count:
+        blocks = list()
+        for i_r in range(len(run_paths)):
+            start = positions[i_r]
+            end = min(run_lengths[i_r], start + block_rows)
+            key_blocks = list()
+            for i in sort_indices:
+                key_blocks.extend(columns[i].sort_keys(columns[i].block(i_r, start, end)))
+            # rows that are equal on the sort keys stay in source order
+            key_blocks.append(run_indices[i_r][start:end])
+            blocks.append((i_r, start, end, key_blocks))
+
+        # rows that can't be preceded by a row that is still to be read from a run
+        cutoffs = [tuple(k[-1] for k in key_blocks)
+                   for i_r, start, end, key_blocks in blocks
+                   if end < run_lengths[i_r]]
+        cutoff = min(cutoffs) if len(cutoffs) > 0 else None
+
+        taken = list()
+        for i_r, start, end, key_blocks in blocks:
+            if end == start:
+                continue
+            count = end - start if cutoff is None\
+                else np.count_nonzero(_rows_not_after(key_blocks, cutoff))
+            if count > 0:
+                taken.append((i_r, start, start + count, [k[:count] for k in key_blocks]))
+
+        merged_keys = [np.concatenate([t[3][i_k] for t in taken])
+                       for i_k in range(len(taken[0][3]))]
+        order = np.lexsort(merged_keys[::-1])
+        taken_count = len(order)
+        index[written:written + taken_count] = merged_keys[-1][order]
+        del merged_keys
+        for c in columns:
+            merged = np.concatenate([c.block(i_r, start, end) for i_r, start, end, _ in taken])
+            c.write(written, merged[order])
+            del merged
+        for i_r, start, end, _ in taken:
+            positions[i_r] = end
+        written += taken_count
+
+    entries = list()
+    for name, c in zip(names, columns):
+        c.close()
+        entries.append((name, c.kind))
+    del run_fields
+    return entries, index, row_count
+
+
+def sort_to_cache(path, cache_dir, sort_keys, field_descriptors=None, keys=None,
+                  memory_budget=DEFAULT_MEMORY_BUDGET, auto_dictionary=False, encoding=None,
+                  progress=False):
+    """
+    Sort the csv file at 'path' by the fields named in 'sort_keys', writing the sorted fields to
+    the columnar cache for 'path' in 'cache_dir', so that a Dataset loaded from 'path' with the
+    same 'cache_dir', 'field_descriptors', 'keys' and 'auto_dictionary' is memory-mapped from the
+    sorted cache. The fields parsed at any one time are kept within roughly 'memory_budget' bytes. The
+    sort keys must be among the fields named in 'keys', if it is given. If the cache already
+    holds the fields sorted by 'sort_keys', it is left as it is
+    """
+    path = os.path.abspath(path)
+    cache_path = columnar_cache.cache_path_for(cache_dir, path)
+    source_fingerprint = columnar_cache.fingerprint(path)
+
+    with compressed_io.open_text(path, encoding=encoding) as f:
+        available_keys = next(csv.reader(f, delimiter=',', quotechar='"'))
+    names = list(keys) if keys else available_keys
+    signatures = dataset.Dataset._descriptor_signatures(field_descriptors, names)
+    sort_keys = tuple(sort_keys)
+
+    options = columnar_cache.load_options(auto_dictionary)
+    manifest = columnar_cache.read_manifest(cache_path)
+    if columnar_cache.is_valid_for(manifest, source_fingerprint, names, signatures, options) and\
+            tuple(manifest.get('sorted_by', ()))[:len(sort_keys)] == sort_keys:
+        return
+
+    tstart = time.time()
+    _, index_map, transforms_by_index = dataset._field_map(available_keys, names,
+                                                           field_descriptors)
+    sort_indices = [names.index(k) for k in sort_keys]
+    max_dictionary_values = [dictionary_field.AUTO_DICTIONARY_MAX_VALUES
+                             if auto_dictionary and transforms_by_index[i_n] is None else None
+                             for i_n in index_map]
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=cache_dir) as runs_dir:
+        run_paths, run_rows = _spill_runs(path, encoding, runs_dir, index_map,
+                                          transforms_by_index, sort_indices, memory_budget,
+                                          auto_dictionary, progress)
+        if progress:
+            print(f'merging {len(run_paths)} runs')
+        columnar_cache.begin_write(cache_path)
+        entries, index, row_count = _merge_runs(run_paths, run_rows, cache_path, names,
+                                                sort_indices, max_dictionary_values)
+
+    columns = [columnar_cache.column_entry(name, kind, f'col_{i_f:04d}', signatures[name])
+               for i_f, (name, kind) in enumerate(entries)]
+    columnar_cache.write_manifest(cache_path, source_fingerprint, available_keys, row_count,
+                                  columns, index, sort_keys, options=options)
+    print('external sort took', time.time() - tstart, "seconds")
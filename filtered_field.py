@@ -16,15 +16,47 @@ def filtered_field(field, filter):
         yield field[f]
 
 
+def _take(field, indices):
+    if isinstance(field, list):
+        return [field[i] for i in indices.tolist()]
+    if isinstance(field, np.ndarray):
+        return field[indices]
+    return field.take(indices)
+
+
 class FilteredField:
+    """
+    The rows of 'field' selected by 'filter', which is a sequence or array of row indices or a
+    boolean mask. Filtering a FilteredField selects from the underlying field directly, rather
+    than through both filters. Reading a single row reads it from 'field'; slices and take
+    give a compacted column of the same kind as 'field', as does materialise for all of the rows
+    """
     def __init__(self, field, filter):
+        filter = np.asarray(filter)
+        if filter.dtype == np.bool_:
+            filter = np.flatnonzero(filter)
+        elif len(filter) == 0:
+            filter = filter.astype(np.int64)
+        if isinstance(field, FilteredField):
+            filter = field.filter[filter]
+            field = field.field
         self.field = field
         self.filter = filter
         self.dtype = self.field.dtype if isinstance(self.field, np.ndarray) else None
 
     def __getitem__(self, item):
+        if isinstance(item, slice):
+            return _take(self.field, self.filter[item])
         return self.field[self.filter[item]]
 
     def __len__(self):
         return len(self.filter)
 
+    def __iter__(self):
+        return iter(self.materialise())
+
+    def take(self, indices):
+        return _take(self.field, self.filter[np.asarray(indices, dtype=np.int64)])
+
+    def materialise(self):
+        return _take(self.field, self.filter)
@@ -0,0 +1,213 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+
+import numpy as np
+
+import numpy_buffer
+
+# ids are packed into two big-endian halves so that numpy orders them as it would the strings
+ID_DTYPE = np.dtype([('hi', np.uint64), ('lo', np.uint64)])
+HEX_ID_LENGTH = 32
+HEX_ID_PATTERN = re.compile('[0-9a-f]{32}')
+
+
+def encode(value):
+    return int(value[:16], 16), int(value[16:], 16)
+
+
+def decode(hi, lo):
+    return f'{hi:016x}{lo:016x}'
+
+
+class HexIdField:
+    """
+    A field of 32 character lowercase hex ids, packed into 16 bytes each. The packed ids order
+    in the same way as the strings, so sorting, joining and membership tests can be done on them
+    """
+    def __init__(self, ids):
+        self.ids = ids
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return HexIdField(self.ids[item])
+        id = self.ids[item]
+        return decode(id['hi'], id['lo'])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        for hi, lo in zip(self.ids['hi'].tolist(), self.ids['lo'].tolist()):
+            yield decode(hi, lo)
+
+    def take(self, indices):
+        return HexIdField(self.ids[indices])
+
+    def copy(self):
+        return HexIdField(self.ids.copy())
+
+    def sort_keys(self):
+        """
+        Keys in order of significance that sort this field in the same way as its strings
+        """
+        return self.ids['hi'], self.ids['lo']
+
+    def runs(self):
+        """
+        The (start, end) rows, inclusive, of each run of equal ids
+        """
+        starts = np.flatnonzero(self.ids[1:] != self.ids[:-1]) + 1
+        ends = np.append(starts - 1, len(self.ids) - 1)
+        starts = np.insert(starts, 0, 0)
+        return zip(starts.tolist(), ends.tolist())
+
+    def equals(self, value):
+        if HEX_ID_PATTERN.fullmatch(value) is None:
+            return np.zeros(len(self.ids), dtype=np.bool_)
+        return self.ids == np.asarray([encode(value)], dtype=ID_DTYPE)[0]
+
+
+def to_ids(values):
+    """
+    Pack a sequence of hex id strings into an array of ID_DTYPE, skipping any that aren't ids
+    """
+    if isinstance(values, HexIdField):
+        return values.ids
+    return np.asarray([encode(v) for v in values if HEX_ID_PATTERN.fullmatch(v)], dtype=ID_DTYPE)
+
+
+def arena_to_ids(arena):
+    """
+    Pack a numpy_buffer.StringArena of hex id strings into an array of ID_DTYPE in bulk, or
+    return None if any of its strings isn't an id
+    """
+    offsets, data = arena.encoded()
+    if len(data) != HEX_ID_LENGTH * (len(offsets) - 1) or\
+            (np.diff(offsets) != HEX_ID_LENGTH).any():
+        return None
+    digits = data.reshape(-1, HEX_ID_LENGTH)
+    is_digit = (digits >= ord('0')) & (digits <= ord('9'))
+    if not (is_digit | ((digits >= ord('a')) & (digits <= ord('f')))).all():
+        return None
+    nibbles = np.where(is_digit, digits - ord('0'), digits - (ord('a') - 10)).astype(np.uint8)
+    # pairs of digits make the bytes of the big-endian halves
+    halves = ((nibbles[:, 0::2] << 4) | nibbles[:, 1::2]).view('>u8')
+    ids = np.empty(len(digits), dtype=ID_DTYPE)
+    ids['hi'] = halves[:, 0]
+    ids['lo'] = halves[:, 1]
+    return ids
+
+
+def concatenate(parts):
+    return HexIdField(np.concatenate([p.ids for p in parts]))
+
+
+def isin(field, values):
+    """
+    A boolean array that is True for each entry of 'field' that is in 'values'
+    """
+    if isinstance(field, HexIdField):
+        return np.isin(field.ids, to_ids(values))
+    value_set = values if isinstance(values, set) else set(values)
+    return np.fromiter((v in value_set for v in field), dtype=np.bool_, count=len(field))
+
+
+class Lookup:
+    """
+    Find the index of the last entry of 'keys' that matches each of a sequence of values, or -1
+    if there is no matching entry. The keys are indexed once, so that they can be looked up in
+    many sequences of values
+    """
+    def __init__(self, keys):
+        self.keys_ = keys
+        self.key_map_ = None
+        if isinstance(keys, HexIdField):
+            self.order_ = np.argsort(keys.ids, kind='stable')
+            self.sorted_keys_ = keys.ids[self.order_]
+
+    def __call__(self, values):
+        if isinstance(self.keys_, HexIdField) and isinstance(values, HexIdField):
+            positions = np.searchsorted(self.sorted_keys_, values.ids, side='right') - 1
+            found = positions >= 0
+            found[found] = self.sorted_keys_[positions[found]] == values.ids[found]
+            return np.where(found, self.order_[np.maximum(positions, 0)], -1)
+        if self.key_map_ is None:
+            self.key_map_ = {k: i for i, k in enumerate(self.keys_)}
+        key_map = self.key_map_
+        return np.fromiter((key_map.get(v, -1) for v in values), dtype=np.int64, count=len(values))
+
+
+def lookup(keys, values):
+    """
+    For each entry of 'values', the index of the last matching entry in 'keys', or -1 if there
+    is no matching entry
+    """
+    return Lookup(keys)(values)
+
+
+class HexIdBuffer:
+    """
+    Build a HexIdField from appended strings. If a value that isn't a 32 character lowercase hex
+    id is appended, the buffer falls back to building a list of strings
+    """
+    def __init__(self, size=None):
+        self.size_ = size
+        self.his_ = numpy_buffer.ColumnBuilder(np.uint64, size)
+        self.los_ = numpy_buffer.ColumnBuilder(np.uint64, size)
+        self.list_ = None
+
+    def append(self, value):
+        if self.list_ is None:
+            if HEX_ID_PATTERN.fullmatch(value) is not None:
+                self.his_.append(int(value[:16], 16))
+                self.los_.append(int(value[16:], 16))
+                return
+            self._to_list()
+        self.list_.append(value)
+
+    def extend(self, strings):
+        """
+        Append a numpy_buffer.StringArena of strings, which are packed together if they are all
+        ids
+        """
+        ids = arena_to_ids(strings) if self.list_ is None else None
+        if ids is None:
+            for v in strings:
+                self.append(v)
+            return
+        self.his_.extend(ids['hi'])
+        self.los_.extend(ids['lo'])
+
+    def _to_list(self):
+        values = list(self._finalise_ids())
+        if self.size_ is None:
+            self.list_ = values
+        else:
+            self.list_ = numpy_buffer.FixedSizeListBuffer(self.size_)
+            for v in values:
+                self.list_.append(v)
+
+    def _finalise_ids(self):
+        his = self.his_.finalise()
+        los = self.los_.finalise()
+        ids = np.empty(len(his), dtype=ID_DTYPE)
+        ids['hi'] = his
+        ids['lo'] = los
+        self.his_ = None
+        self.los_ = None
+        return HexIdField(ids)
+
+    def finalise(self):
+        if self.list_ is not None:
+            return self.list_ if isinstance(self.list_, list) else self.list_.finalise()
+        return self._finalise_ids()
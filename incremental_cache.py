@@ -0,0 +1,167 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import csv
+import os
+import shutil
+import time
+
+import numpy as np
+
+import columnar_cache
+import compressed_io
+import dataset
+import dictionary_field
+
+# Incremental ingest of a csv export into a columnar cache (see columnar_cache), starting from
+# the cache of an earlier export that the new export extends:
+#  * if the earlier export is a byte prefix of the new one, which is checked against the content
+#    digest recorded in its cache, only the rows after the prefix are parsed and appended
+#  * otherwise, if the cache holds MATCH_KEYS, those fields are parsed for every row of the new
+#    export, and the rows whose id and updated_at are in the earlier cache are taken from it.
+#    The remaining (new or changed) rows are read from their byte offsets and parsed
+# Either way, the cache that is written holds the rows of the new export in source order, as a
+# cache written by parsing the whole export would, so Dataset loads it in the same way. If the
+# earlier cache can't be used (it is sorted, was built with different fields, descriptors or options, or
+# the new export is compressed), the new export is parsed in full.
+
+MATCH_KEYS = ('id', 'updated_at')
+
+
+def _can_extend(manifest, available_keys, names, signatures, options):
+    if manifest is None or manifest.get('format') != columnar_cache.CACHE_FORMAT_VERSION:
+        return False
+    if manifest.get('options') != options:
+        return False
+    # a sorted cache doesn't hold the rows in source order
+    if 'index' in manifest or manifest['fieldnames'] != available_keys:
+        return False
+    columns = {c['name']: c for c in manifest['columns']}
+    return all(k in columns and columns[k]['descriptor'] == signatures.get(k) for k in names)
+
+
+def _is_prefix(path, content):
+    """
+    Check whether the file that had the content digest 'content' is a prefix of 'path' that
+    ends on a row boundary
+    """
+    if content is None or content['size'] == 0 or content['size'] > os.path.getsize(path):
+        return False
+    with open(path, 'rb') as f:
+        f.seek(content['size'] - 1)
+        if f.read(1) != b'\n':
+            return False
+    return columnar_cache.content_digest(path, content['size']) == content
+
+
+def _write(cache_path, source_fingerprint, fieldnames, names, fields, signatures, path,
+           options):
+    # the earlier cache may be the one being replaced, and its columns are still mapped, so the
+    # new cache is written alongside it and then moved into place. The content digest lets the
+    # next export be checked for extending this one
+    temp_path = cache_path + '.incremental'
+    if os.path.exists(temp_path):
+        shutil.rmtree(temp_path)
+    content = None if compressed_io.is_compressed(path) else columnar_cache.content_digest(path)
+    columnar_cache.write(temp_path, source_fingerprint, fieldnames, names, fields, signatures,
+                         content=content, options=options)
+    if os.path.exists(cache_path):
+        shutil.rmtree(cache_path)
+    os.rename(temp_path, cache_path)
+
+
+def _parse_all(path, cache_path, source_fingerprint, available_keys, names, signatures,
+               field_descriptors, keys, auto_dictionary, encoding, progress):
+    print('parsing all rows of', path)
+    with compressed_io.open_text(path, encoding=encoding) as f:
+        ds = dataset.Dataset(f, field_descriptors, keys=keys, auto_dictionary=auto_dictionary,
+                             progress=progress)
+    _write(cache_path, source_fingerprint, available_keys, names, ds.fields_, signatures, path,
+           columnar_cache.load_options(auto_dictionary))
+    return ds.row_count()
+
+
+def update_cache(path, cache_dir, previous_cache_path, field_descriptors=None, keys=None,
+                 auto_dictionary=False, encoding=None, progress=False):
+    """
+    Write the columnar cache for 'path' in 'cache_dir' from the cache of an earlier export at
+    'previous_cache_path', parsing only the rows of 'path' that aren't in it. 'field_descriptors',
+    'keys' and 'auto_dictionary' are as for Dataset. Returns the number of rows parsed
+    """
+    path = os.path.abspath(path)
+    cache_path = columnar_cache.cache_path_for(cache_dir, path)
+    source_fingerprint = columnar_cache.fingerprint(path)
+    with compressed_io.open_text(path, encoding=encoding) as f:
+        available_keys = next(csv.reader(f, delimiter=',', quotechar='"'))
+    names = list(keys) if keys else available_keys
+    signatures = dataset.Dataset._descriptor_signatures(field_descriptors, names)
+    options = columnar_cache.load_options(auto_dictionary)
+
+    if columnar_cache.is_valid_for(columnar_cache.read_manifest(cache_path), source_fingerprint,
+                                   names, signatures, options):
+        return 0
+
+    tstart = time.time()
+    previous = columnar_cache.read_manifest(previous_cache_path)
+    if compressed_io.is_compressed(path) or\
+            not _can_extend(previous, available_keys, names, signatures, options):
+        return _parse_all(path, cache_path, source_fingerprint, available_keys, names,
+                          signatures, field_descriptors, keys, auto_dictionary, encoding, progress)
+
+    _, index_map, transforms_by_index =\
+        dataset._field_map(available_keys, names, field_descriptors)
+    max_values = [dictionary_field.AUTO_DICTIONARY_MAX_VALUES
+                  if auto_dictionary and transforms_by_index[i_n] is None else None
+                  for i_n in index_map]
+    fields = columnar_cache.read_columns(previous_cache_path, previous, names)
+
+    if _is_prefix(path, previous.get('content')):
+        new_fields, _, row_count = dataset._parse_range(
+            (path, encoding, previous['content']['size'], os.path.getsize(path), index_map,
+             transforms_by_index, auto_dictionary, None))
+        print(f'appending {row_count} rows to {previous["row_count"]} cached rows')
+        fields = [dataset._concatenate_fields([f, n], m)
+                  for f, n, m in zip(fields, new_fields, max_values)]
+    elif all(k in names for k in MATCH_KEYS):
+        # match rows on the representation of MATCH_KEYS that the cache holds
+        match_descriptors = {k: field_descriptors[k] for k in MATCH_KEYS
+                             if field_descriptors and k in field_descriptors}
+        with open(path, encoding=encoding) as f:
+            match_ds = dataset.Dataset(f, match_descriptors, keys=list(MATCH_KEYS),
+                                       progress=progress)
+        cached_rows = {k: i for i, k in enumerate(zip(*[fields[names.index(k)]
+                                                        for k in MATCH_KEYS]))}
+        row_count = match_ds.row_count()
+        matches = np.fromiter((cached_rows.get(k, -1) for k in zip(*match_ds.fields_)),
+                              dtype=np.int64, count=row_count)
+        del cached_rows, match_ds
+        found = np.flatnonzero(matches >= 0)
+        parsed = np.flatnonzero(matches < 0)
+        print(f'taking {len(found)} rows from the cache and parsing {len(parsed)} rows')
+        parts = [[dataset.Dataset._apply_permutation(matches[found], f) for f in fields]]
+        if len(parsed) > 0:
+            with open(path, encoding=encoding) as f:
+                parts.append(dataset.Dataset(f, field_descriptors, keys=names, rows=parsed,
+                                             auto_dictionary=auto_dictionary).fields_)
+        # put the rows back into source order
+        order = np.argsort(np.concatenate((found, parsed)), kind='stable')
+        fields = [dataset.Dataset._apply_permutation(
+                      order, dataset._concatenate_fields([p[i_f] for p in parts], max_values[i_f]))
+                  for i_f in range(len(names))]
+        row_count = len(parsed)
+    else:
+        return _parse_all(path, cache_path, source_fingerprint, available_keys, names,
+                          signatures, field_descriptors, keys, auto_dictionary, encoding, progress)
+
+    _write(cache_path, source_fingerprint, available_keys, names, fields, signatures, path,
+           options)
+    print('incremental cache update took', time.time() - tstart, "seconds")
+    return row_count
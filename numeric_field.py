@@ -0,0 +1,132 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+
+import dictionary_field
+import numpy_buffer
+
+# strings are converted to numbers this many at a time as they are appended to a NumericBuffer
+CONVERT_BATCH_ROWS = 1 << 16
+
+
+class NumericField:
+    """
+    A numeric field stored as an array of values and a boolean array that is True for each
+    missing value. Missing values are NaN in 'values'. Reading a single entry gives '' for a
+    missing value and a float otherwise, so that code written against the string field still
+    works; code that handles NumericFields directly can work on 'values' and 'missing' instead
+    """
+    def __init__(self, values, missing):
+        self.values = values
+        self.missing = missing
+        self.dtype = values.dtype
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return NumericField(self.values[item], self.missing[item])
+        return '' if self.missing[item] else float(self.values[item])
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        for v, m in zip(self.values.tolist(), self.missing.tolist()):
+            yield '' if m else v
+
+    def take(self, indices):
+        return NumericField(self.values[indices], self.missing[indices])
+
+    def copy(self):
+        return NumericField(self.values.copy(), self.missing.copy())
+
+    def sort_keys(self):
+        """
+        Keys in order of significance that sort missing values first, followed by the values
+        in numeric order
+        """
+        return ~self.missing, np.where(self.missing, 0, self.values)
+
+
+def to_numeric(strings, dtype):
+    """
+    Convert a sequence of strings to an array of 'dtype' in bulk, returning the values and a
+    boolean array that is True for each empty string. A ValueError is raised for the first
+    string that isn't a number, as float() would
+    """
+    strings = np.asarray(strings, dtype=np.str_)
+    missing = strings == ''
+    values = np.full(len(strings), np.nan, dtype=dtype)
+    present = ~missing
+    try:
+        values[present] = strings[present].astype(dtype)
+    except ValueError:
+        for i in np.flatnonzero(present):
+            try:
+                values[i] = float(strings[i])
+            except ValueError:
+                raise ValueError(f'{strings[i]} cannot be converted to float')
+    return values, missing
+
+
+def from_strings(field, dtype=np.float64):
+    """
+    A NumericField of the values of a string field of any kind. Only the distinct values of a
+    DictionaryField are converted
+    """
+    if isinstance(field, dictionary_field.DictionaryField):
+        values, missing = to_numeric(list(field.values), dtype)
+        return NumericField(values[field.codes], missing[field.codes])
+    return NumericField(*to_numeric(list(field), dtype))
+
+
+def concatenate(parts):
+    return NumericField(np.concatenate([p.values for p in parts]),
+                        np.concatenate([p.missing for p in parts]))
+
+
+class NumericBuffer:
+    """
+    Build a NumericField from appended strings. The strings are held until CONVERT_BATCH_ROWS
+    of them have been appended and then converted together. If 'size' is given, the field is
+    allocated at that size up front and filled in place
+    """
+    def __init__(self, dtype, size=None):
+        self.dtype_ = dtype
+        self.pending_ = list()
+        self.values_ = numpy_buffer.ColumnBuilder(dtype, size)
+        self.missing_ = numpy_buffer.ColumnBuilder(np.bool_, size)
+
+    def append(self, value):
+        self.pending_.append(value)
+        if len(self.pending_) == CONVERT_BATCH_ROWS:
+            self._convert()
+
+    def extend_values(self, values, missing):
+        """
+        Append values that are already converted, with their mask of missing values
+        """
+        self._convert()
+        self.values_.extend(np.asarray(values, dtype=self.dtype_))
+        self.missing_.extend(missing)
+
+    def _convert(self):
+        values, missing = to_numeric(self.pending_, self.dtype_)
+        self.values_.extend(values)
+        self.missing_.extend(missing)
+        self.pending_ = list()
+
+    def finalise(self):
+        self._convert()
+        field = NumericField(self.values_.finalise(), self.missing_.finalise())
+        self.values_ = None
+        self.missing_ = None
+        return field
@@ -11,57 +11,124 @@
 
 import numpy as np
 
-class NumpyBuffer2:
-    def __init__(self, dtype, block_pow=8):
+# the number of appended values that ColumnBuilder holds before converting them together
+PENDING_ROWS = 1 << 12
+MIN_CAPACITY = 1 << 8
+# the number of strings whose bytes StringArena.take gathers at a time
+TAKE_BLOCK_ROWS = 1 << 16
+# the bytes that csv.writer quotes a field for with the default dialect
+CSV_QUOTE = ord('"')
+CSV_SPECIAL_BYTES = np.frombuffer(b',"\r\n', dtype=np.uint8)
+
+
+class ColumnBuilder:
+    """
+    Build an array of 'dtype' from appended values and arrays. The array grows by doubling, so
+    appends are amortised constant time, and single values are held in a short list and
+    converted in bulk. 'capacity' allocates the array at the expected final size up front;
+    if more values than that are added, it grows as usual. The array is grown by copying it into
+    a larger one, so no view of an earlier array is left pointing at freed memory, and finalise
+    trims it in place only if nothing else refers to it
+    """
+    def __init__(self, dtype, capacity=None):
         self.dtype_ = dtype
-        self.list_ = list()
+        self.array_ = np.empty(capacity or 0, dtype=dtype)
+        self.count_ = 0
+        self.pending_ = list()
+
+    def __len__(self):
+        return self.count_ + len(self.pending_)
+
+    def reserve(self, capacity):
+        """
+        Make room for at least 'capacity' values in total without reallocating
+        """
+        if capacity > len(self.array_):
+            array = np.empty(capacity, dtype=self.dtype_)
+            array[:self.count_] = self.array_[:self.count_]
+            self.array_ = array
+
+    def _grow(self, required):
+        if required > len(self.array_):
+            self.reserve(max(required, 2 * len(self.array_), MIN_CAPACITY))
 
     def append(self, value):
-        self.list_.append(value)
+        pending = self.pending_
+        pending.append(value)
+        if len(pending) == PENDING_ROWS:
+            self._flush()
+
+    def extend(self, values):
+        """
+        Append an array or an iterable of values
+        """
+        self._flush()
+        if not isinstance(values, np.ndarray):
+            values = np.fromiter(values, dtype=self.dtype_) if not isinstance(values, list)\
+                else np.asarray(values, dtype=self.dtype_)
+        end = self.count_ + len(values)
+        self._grow(end)
+        self.array_[self.count_:end] = values
+        self.count_ = end
+
+    def _flush(self):
+        if len(self.pending_) > 0:
+            pending = self.pending_
+            self.pending_ = list()
+            self.extend(pending)
 
     def finalise(self):
-        result = np.asarray(self.list_, dtype=self.dtype_)
-        del self.list_
+        self._flush()
+        result = self.array_
+        self.array_ = None
+        if self.count_ < len(result):
+            try:
+                result.resize(self.count_)
+            except ValueError:
+                # the array is referenced elsewhere, so it can't be resized in place
+                result = result[:self.count_].copy()
         return result
 
 
-class NumpyBuffer:
+class NumpyBuffer(ColumnBuilder):
+    """
+    A ColumnBuilder, kept for existing callers. 'block_pow' is ignored
+    """
     def __init__(self, dtype, block_pow=8):
-        self.block_shift_ = block_pow
-        self.block_size_ = 1 << block_pow
-        self.block_mask_ = self.block_size_ - 1
-        self.blocks_ = list()
-        self.dtype_ = dtype
-        self.current_block_ = None
-        self.current_ = 0
+        super().__init__(dtype)
 
-    def append(self, value):
-        if self.current_ == len(self.blocks_) * self.block_size_:
-            self.blocks_.append(np.zeros(self.block_size_, dtype=self.dtype_))
-            self.current_block_ = self.blocks_[-1]
-        self.current_block_[self.current_ & self.block_mask_] = value
-        self.current_ += 1
 
+NumpyBuffer2 = NumpyBuffer
 
-    def finalise(self):
-        if self.current_ == 0:
-            return None
-        final = np.zeros(self.current_, dtype=self.dtype_)
-        start = 0
-        for b in range(len(self.blocks_) - 1):
-            cur_block = self.blocks_[b]
-            final[start:start + self.block_size_] = cur_block
-            start += self.block_size_
-            del cur_block
-        current = self.current_ & self.block_mask_
-        last_block = self.blocks_[-1]
-        final[start:start + current] = last_block[0:current]
-        del last_block
 
-        self.blocks_ = list()
+class FixedSizeBuffer(ColumnBuilder):
+    """
+    A ColumnBuilder allocated at the expected final size, kept for existing callers
+    """
+    def __init__(self, dtype, size):
+        super().__init__(dtype, size)
+
+
+class FixedSizeListBuffer:
+    """
+    Fill a list that is allocated once at the expected final size
+    """
+    def __init__(self, size):
+        self.list_ = [None] * size
         self.current_ = 0
 
-        return final
+    def append(self, value):
+        if self.current_ == len(self.list_):
+            self.list_.append(value)
+        else:
+            self.list_[self.current_] = value
+        self.current_ += 1
+
+    def finalise(self):
+        result = self.list_
+        del result[self.current_:]
+        self.list_ = None
+        return result
 
 
 class ListBuffer:
@@ -99,6 +166,165 @@ class ListBuffer:
 
         return final
 
+class StringArena:
+    """
+    A string field stored as one utf-8 byte buffer and an int64 array of offsets into it, with
+    one more offset than there are strings. The strings are decoded when they are read, so the
+    field takes about as much memory as its text, and reordering it is done on the two arrays
+    """
+    def __init__(self, offsets, data):
+        self.offsets_ = offsets
+        self.data_ = data
+        self.dtype = None
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, stop, step = item.indices(len(self))
+            if step == 1:
+                return StringArena(self.offsets_[start:max(start, stop) + 1], self.data_)
+            return self.take(np.arange(start, stop, step))
+        if item < 0:
+            item += len(self)
+        return str(self.data_[self.offsets_[item]:self.offsets_[item + 1]], 'utf-8')
+
+    def __len__(self):
+        return len(self.offsets_) - 1
+
+    def __iter__(self):
+        data = memoryview(self.data_)
+        offsets = self.offsets_.tolist()
+        for i in range(len(offsets) - 1):
+            yield str(data[offsets[i]:offsets[i + 1]], 'utf-8')
+
+    def encoded(self):
+        """
+        The offsets and utf-8 bytes of just the strings in this field, with the offsets starting
+        at zero
+        """
+        start = int(self.offsets_[0]) if len(self.offsets_) > 0 else 0
+        end = int(self.offsets_[-1]) if len(self.offsets_) > 0 else 0
+        return np.asarray(self.offsets_, dtype=np.int64) - start, self.data_[start:end]
+
+    def take(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        starts = self.offsets_[:-1][indices]
+        lengths = self.offsets_[1:][indices] - starts
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        data = np.empty(offsets[-1], dtype=np.uint8)
+        # gather the bytes of a block of strings at a time, to bound the size of the byte index
+        for b in range(0, len(indices), TAKE_BLOCK_ROWS):
+            e = min(b + TAKE_BLOCK_ROWS, len(indices))
+            block_lengths = lengths[b:e]
+            positions = np.repeat(starts[b:e] - offsets[b:e], block_lengths) +\
+                np.arange(offsets[b], offsets[e])
+            data[offsets[b]:offsets[e]] = self.data_[positions]
+        return StringArena(offsets, data)
+
+    def copy(self):
+        offsets, data = self.encoded()
+        return StringArena(offsets, np.array(data))
+
+    def csv_quoted(self):
+        """
+        A StringArena of these strings as csv.writer writes them with the default dialect, so
+        that they can be written to csv output as they are: strings holding a separator, quote
+        or line break are quoted, with their quotes doubled
+        """
+        offsets, data = self.encoded()
+        lengths = np.diff(offsets)
+        rows = np.repeat(np.arange(len(lengths)), lengths)
+        quotes = data == CSV_QUOTE
+        needs_quoting = np.bincount(rows[np.isin(data, CSV_SPECIAL_BYTES)],
+                                    minlength=len(lengths)) > 0
+        quote_counts = np.bincount(rows[quotes], minlength=len(lengths))
+        quoted_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths + 2 * needs_quoting + quote_counts, out=quoted_offsets[1:])
+
+        # each byte moves along by the opening quote of its string and the quotes doubled
+        # before it in the string
+        quotes_before = np.cumsum(quotes) - quotes
+        row_quotes_before = np.concatenate(([0], np.cumsum(quotes)))[offsets[:-1]]
+        positions = np.arange(len(data)) + (quoted_offsets[:-1] - offsets[:-1] +
+                                            needs_quoting - row_quotes_before)[rows] +\
+            quotes_before
+        quoted = np.empty(quoted_offsets[-1], dtype=np.uint8)
+        quoted[positions] = data
+        quoted[positions[quotes] + 1] = CSV_QUOTE
+        quoted[quoted_offsets[:-1][needs_quoting]] = CSV_QUOTE
+        quoted[quoted_offsets[1:][needs_quoting] - 1] = CSV_QUOTE
+        return StringArena(quoted_offsets, quoted)
+
+
+class StringBuffer:
+    """
+    Build a StringArena from appended strings, which are encoded in batches. 'size' is the
+    expected number of strings, if it is known
+    """
+    def __init__(self, size=None):
+        self.lengths_ = ColumnBuilder(np.int64, size)
+        self.data_ = ColumnBuilder(np.uint8)
+        self.pending_ = list()
+
+    def __len__(self):
+        return len(self.lengths_) + len(self.pending_)
+
+    def append(self, value):
+        pending = self.pending_
+        pending.append(value)
+        if len(pending) == PENDING_ROWS:
+            self._flush()
+
+    def extend(self, values):
+        """
+        Append a sequence of strings. The bytes of a StringArena are copied as they are
+        """
+        if isinstance(values, StringArena):
+            self._flush()
+            offsets, data = values.encoded()
+            self.lengths_.extend(np.diff(offsets))
+            self.data_.extend(data)
+            return
+        self.pending_.extend(values)
+        if len(self.pending_) >= PENDING_ROWS:
+            self._flush()
+
+    def _flush(self):
+        encoded = [v.encode('utf-8') for v in self.pending_]
+        self.pending_ = list()
+        self.lengths_.extend([len(e) for e in encoded])
+        self.data_.extend(np.frombuffer(b''.join(encoded), dtype=np.uint8))
+
+    def finalise(self):
+        self._flush()
+        lengths = self.lengths_.finalise()
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        self.lengths_ = None
+        return StringArena(offsets, self.data_.finalise())
+
+
+def concatenate_strings(parts):
+    """
+    Concatenate string fields of any kind into a StringArena
+    """
+    if all(isinstance(p, StringArena) for p in parts):
+        encoded = [p.encoded() for p in parts]
+        offsets = np.zeros(sum(len(o) - 1 for o, _ in encoded) + 1, dtype=np.int64)
+        row = 0
+        base = 0
+        for o, d in encoded:
+            offsets[row + 1:row + len(o)] = o[1:] + base
+            row += len(o) - 1
+            base += len(d)
+        return StringArena(offsets, np.concatenate([d for _, d in encoded]) if len(encoded) > 0
+                           else np.zeros(0, dtype=np.uint8))
+    buffer = StringBuffer(sum(len(p) for p in parts))
+    for p in parts:
+        buffer.extend(p)
+    return buffer.finalise()
+
+
 # x = np.zeros(32)
 # y = np.asarray([x for x in range(16)])
 # start = 0
@@ -12,24 +12,37 @@
 import copy
 import csv
 import datetime
+import itertools
 import time
 from collections import defaultdict
 
 import numpy as np
 
+import columnar_cache
+import compressed_io
+import csv_readers
 import dataset
 import data_schemas
+import dictionary_field
+import external_sort
 import filtered_field
+import hex_id_field
+import incremental_cache
+import numeric_field
+import numpy_buffer
 import parsing_schemas
+import predicates
 import regression
+import row_index
+import timestamp_field
 from processing.age_from_year_of_birth import CalculateAgeFromYearOfBirth
 from processing.assessment_merge import CalculateMergedFieldCount, MergeAssessmentRows
 from processing.inconsistent_symptoms import CheckInconsistentSymptoms
 from processing.inconsistent_testing import CheckTestingConsistency
 
-from utils import count_flag_empty, count_flag_set, build_histogram, map_between_categories, \
+from utils import count_flag_set, flag_summary, build_histogram, map_between_categories, \
     to_categorical, print_diagnostic_row, valid_range_fac_inc, iterate_over_patient_assessments, \
-    iterate_over_patient_assessments2, datetime_to_seconds, concatenate_maybe_strs
+    iterate_over_patient_assessments2, datetime_to_seconds, concatenate_maybe_strs, to_csv_value
 
 
 def copy_field(field):
@@ -54,6 +67,15 @@ def map_patient_ids(geoc, asmt, map_fn):
             a += 1
 
 
+def print_flag_summary(summary):
+    for desc, count, exclusive in summary.counts_by_desc():
+        if exclusive is None:
+            print(f'{desc}: {count}')
+        else:
+            print(f'{desc}: {count} ({exclusive} with no other flag)')
+    print('no flags:', summary.unflagged_)
+
+
 #patient limits
 MIN_AGE = 16
 MAX_AGE = 90
@@ -129,17 +151,104 @@ custom_field_aggregators = {
     'treatment': concatenate_maybe_strs,
     'other_symptoms': concatenate_maybe_strs
 }
+# assessment fields read by the parsing schema functors, by functor key
+assessment_functor_fields = {
+    'validate_temperature': ('temperature',),
+    'clean_covid_progression': ('had_covid_test', 'tested_covid_positive')
+}
+# assessment fields read by the stages that filter assessments before their symptoms are checked
+assessment_validation_fields = ('patient_id', 'updated_at', 'temperature',
+                                'had_covid_test', 'tested_covid_positive')
+
+
+def assessment_keys_to_load(parsing_schema):
+    """
+    The assessment fields that the pipeline reads, so that no other fields are loaded.
+    'existing_fields' come first. The merge stage finds its fields by name, so it doesn't
+    depend on this order
+    """
+    keys = list(existing_fields)
+    functor_fields = [assessment_functor_fields.get(k, ()) for k in parsing_schema.class_entries]
+    for k in itertools.chain(symptomatic_fields, [f[0] for f in flattened_fields],
+                             exposure_fields, miscellaneous_fields, *functor_fields):
+        if k not in keys:
+            keys.append(k)
+    return keys
+
+
+def load_remaining_assessments(asmt_ds, rows, assessment_filename, data_schema, parsing_schema,
+                               cache_dir=None):
+    """
+    The second phase of a two-phase assessment load: load the fields of 'rows' of 'asmt_ds'
+    that weren't loaded in the first phase from their byte offsets in the assessment file, and
+    combine them with the first phase fields of those rows. The fields are in the order given
+    by 'assessment_keys_to_load'
+    """
+    keys = assessment_keys_to_load(parsing_schema)
+    remaining_keys = [k for k in keys if k not in asmt_ds.names_]
+    source_rows = asmt_ds.index_[rows]
+    with compressed_io.open_text(assessment_filename) as f:
+        remaining_ds = dataset.Dataset(f, data_schema.assessment_field_descriptors,
+                                       keys=remaining_keys, rows=source_rows,
+                                       cache_dir=cache_dir, auto_dictionary=True)
+    fields = list()
+    for k in keys:
+        if k in asmt_ds.names_:
+            fields.append(dataset.Dataset._apply_permutation(rows, asmt_ds.field_by_name(k)))
+        else:
+            fields.append(remaining_ds.field_by_name(k))
+    return dataset.Dataset.from_fields(keys, fields, source_rows)
+
+
+def validate_covid_progression(asmt_ds, asmt_filter_status, parsing_schema):
+    """
+    Validate the covid test results of each patient's assessments in turn, flagging invalid
+    progressions in 'asmt_filter_status'. Returns the cleaned had_covid_test and
+    tested_covid_positive values
+    """
+    print(); print()
+    print("validate covid progression")
+    print("--------------------------")
+    sanitised_hct_covid_results = np.ndarray(asmt_ds.row_count(), dtype=np.uint8)
+    sanitised_covid_results = np.ndarray(asmt_ds.row_count(), dtype=np.uint8)
+
+    fn_fac = parsing_schema.class_entries['clean_covid_progression']
+    fn = fn_fac(asmt_ds.field_by_name('had_covid_test'), asmt_ds.field_by_name('tested_covid_positive'),
+                asmt_filter_status,
+                sanitised_hct_covid_results, sanitised_covid_results,
+                FILTER_INVALID_COVID_PROGRESSION)
+    iterate_over_patient_assessments2(
+        asmt_ds.field_by_name('patient_id'), asmt_filter_status, fn)
+
+    print(f'{assessment_flag_descs[FILTER_INVALID_COVID_PROGRESSION]}:',
+          count_flag_set(asmt_filter_status, FILTER_INVALID_COVID_PROGRESSION))
+    return sanitised_hct_covid_results, sanitised_covid_results
 
 
-def pipeline(patient_filename, assessment_filename, data_schema, parsing_schema, year, territory=None):
+def pipeline(patient_filename, assessment_filename, data_schema, parsing_schema, year, territory=None,
+             cache_dir=None, workers=None, preallocate=False, memory_budget=None,
+             two_phase=False, csv_reader=None, incremental_from=None):
 
     categorical_maps = data_schema.assessment_categorical_maps
     # TODO: use proper logging throughout
     print(); print()
     print('load patients')
     print('=============')
-    with open(patient_filename) as f:
-        geoc_ds = dataset.Dataset(f, data_schema.patient_categorical_maps, progress=True)
+    if memory_budget is not None:
+        print('sorting patients out of core')
+        external_sort.sort_to_cache(patient_filename, cache_dir, ('id',),
+                                    data_schema.patient_field_descriptors,
+                                    memory_budget=memory_budget, auto_dictionary=True,
+                                    progress=True)
+    # only the patients in the territory, and their assessments, are loaded
+    patient_predicates = None
+    if territory is not None:
+        patient_predicates = [predicates.Equals('country_code', territory)]
+    with compressed_io.open_text(patient_filename) as f:
+        geoc_ds = dataset.Dataset(f, data_schema.patient_field_descriptors, progress=True,
+                                  cache_dir=cache_dir, workers=workers,
+                                  preallocate=preallocate, auto_dictionary=True,
+                                  predicates=patient_predicates, reader=csv_reader)
     print("sorting patients")
     geoc_ds.sort(('id',))
     geoc_ds.show()
@@ -149,8 +258,34 @@ def pipeline(patient_filename, assessment_filename, data_schema, parsing_schema,
     print(); print()
     print('load assessments')
     print('================')
-    with open(assessment_filename) as f:
-        asmt_ds = dataset.Dataset(f, data_schema.assessment_categorical_maps, progress=True)
+    if incremental_from is not None:
+        print('updating the assessment cache from', incremental_from)
+        incremental_cache.update_cache(
+            assessment_filename, cache_dir,
+            columnar_cache.cache_path_for(cache_dir, incremental_from),
+            data_schema.assessment_field_descriptors, assessment_keys_to_load(parsing_schema),
+            auto_dictionary=True, progress=True)
+    if memory_budget is not None:
+        print('sorting assessments out of core')
+        external_sort.sort_to_cache(assessment_filename, cache_dir, ('patient_id', 'updated_at'),
+                                    data_schema.assessment_field_descriptors,
+                                    assessment_keys_to_load(parsing_schema),
+                                    memory_budget=memory_budget, auto_dictionary=True,
+                                    progress=True)
+    assessment_predicates = None
+    if territory is not None:
+        assessment_predicates =\
+            [predicates.IsIn('patient_id', set(geoc_ds.field_by_name('id')))]
+    # a two-phase load only loads the fields needed to filter assessments until they are filtered
+    assessment_keys = assessment_keys_to_load(parsing_schema)
+    if two_phase:
+        assessment_keys = [k for k in assessment_keys if k in assessment_validation_fields]
+    with compressed_io.open_text(assessment_filename) as f:
+        asmt_ds = dataset.Dataset(f, data_schema.assessment_field_descriptors,
+                                  keys=assessment_keys, progress=True,
+                                  cache_dir=cache_dir, workers=workers,
+                                  preallocate=preallocate, auto_dictionary=True,
+                                  predicates=assessment_predicates, reader=csv_reader)
     print('sorting assessments')
     asmt_ds.sort(('patient_id', 'updated_at'))
     asmt_ds.show()
@@ -173,9 +308,12 @@ def pipeline(patient_filename, assessment_filename, data_schema, parsing_schema,
         print("------------------------------------------------------")
 
         country_codes = geoc_ds.field_by_name('country_code')
-        for ir, r in enumerate(country_codes):
-            if r != territory:
-                geoc_filter_status[ir] |= PFILTER_OTHER_TERRITORY
+        if isinstance(country_codes, dictionary_field.DictionaryField):
+            geoc_filter_status[~country_codes.equals(territory)] |= PFILTER_OTHER_TERRITORY
+        else:
+            for ir, r in enumerate(country_codes):
+                if r != territory:
+                    geoc_filter_status[ir] |= PFILTER_OTHER_TERRITORY
         print(f'other territories: filtered {count_flag_set(geoc_filter_status, PFILTER_OTHER_TERRITORY)} missing values')
 
     print('patients:', len(geoc_filter_status))
@@ -197,10 +335,13 @@ def pipeline(patient_filename, assessment_filename, data_schema, parsing_schema,
     ages = np.zeros(len(src_yobs), dtype=np.uint32)
     fn = CalculateAgeFromYearOfBirth(FILTER_MISSING_AGE, FILTER_BAD_AGE,
                                      valid_range_fac_inc(MIN_AGE, MAX_AGE), year)
-    fn(src_yobs, ages, geoc_filter_status)
+    # the patient fields are loaded as strings so that they are written out as they were read,
+    # so they are converted here for the numeric checks
+    fn(numeric_field.from_strings(src_yobs), ages, geoc_filter_status)
     ptnt_dest_fields['age'] = ages
-    print(f'age: filtered {count_flag_set(geoc_filter_status, FILTER_MISSING_AGE)} missing values')
-    print(f'age: filtered {count_flag_set(geoc_filter_status, FILTER_BAD_AGE)} bad values')
+    patient_summary = flag_summary(geoc_filter_status)
+    print(f'age: filtered {patient_summary.set_count(FILTER_MISSING_AGE)} missing values')
+    print(f'age: filtered {patient_summary.set_count(FILTER_BAD_AGE)} bad values')
 
 
     print()
@@ -217,18 +358,21 @@ def pipeline(patient_filename, assessment_filename, data_schema, parsing_schema,
                 FILTER_MISSING_HEIGHT, FILTER_BAD_HEIGHT,
                 FILTER_MISSING_BMI, FILTER_BAD_BMI)
     weight_clean, height_clean, bmi_clean =\
-        fn(src_genders, ages, src_weights, src_heights, src_bmis, geoc_filter_status)
+        fn(src_genders, ages, numeric_field.from_strings(src_weights),
+           numeric_field.from_strings(src_heights), numeric_field.from_strings(src_bmis),
+           geoc_filter_status)
     ptnt_dest_fields['weight_clean'] = weight_clean
     ptnt_dest_fields['height_clean'] = height_clean
     ptnt_dest_fields['bmi_clean'] = bmi_clean
-    print(f'weight: filtered {count_flag_set(geoc_filter_status, FILTER_MISSING_WEIGHT)} missing_values')
-    print(f'weight: filtered {count_flag_set(geoc_filter_status, FILTER_BAD_WEIGHT)} missing_values')
-    print(f'height: filtered {count_flag_set(geoc_filter_status, FILTER_MISSING_HEIGHT)} missing_values')
-    print(f'height: filtered {count_flag_set(geoc_filter_status, FILTER_BAD_HEIGHT)} missing_values')
-    print(f'bmi: filtered {count_flag_set(geoc_filter_status, FILTER_MISSING_BMI)} missing_values')
-    print(f'bmi: filtered {count_flag_set(geoc_filter_status, FILTER_BAD_BMI)} missing_values')
+    patient_summary = flag_summary(geoc_filter_status)
+    print(f'weight: filtered {patient_summary.set_count(FILTER_MISSING_WEIGHT)} missing_values')
+    print(f'weight: filtered {patient_summary.set_count(FILTER_BAD_WEIGHT)} missing_values')
+    print(f'height: filtered {patient_summary.set_count(FILTER_MISSING_HEIGHT)} missing_values')
+    print(f'height: filtered {patient_summary.set_count(FILTER_BAD_HEIGHT)} missing_values')
+    print(f'bmi: filtered {patient_summary.set_count(FILTER_MISSING_BMI)} missing_values')
+    print(f'bmi: filtered {patient_summary.set_count(FILTER_BAD_BMI)} missing_values')
 
-    print(); print('unfiltered patients:', count_flag_empty(geoc_filter_status))
+    print(); print('unfiltered patients:', patient_summary.unflagged_)
 
 
     print(); print()
@@ -238,20 +382,20 @@ def pipeline(patient_filename, assessment_filename, data_schema, parsing_schema,
     asmt_dest_fields = dict()
     asmt_dest_keys = dict()
 
-    patient_ids = set()
     src_patient_ids = geoc_ds.field_by_name('id')
-    for ir, r in enumerate(src_patient_ids):
-        if geoc_filter_status[ir] == 0:
-            patient_ids.add(r)
+    unfiltered_patients = np.flatnonzero(geoc_filter_status == 0)
+    if isinstance(src_patient_ids, hex_id_field.HexIdField):
+        patient_ids = src_patient_ids.take(unfiltered_patients)
+    else:
+        patient_ids = set(src_patient_ids[ir] for ir in unfiltered_patients)
     src_asmt_patient_ids = asmt_ds.field_by_name('patient_id')
-    for ir, r in enumerate(src_asmt_patient_ids):
-        if r not in patient_ids:
-            asmt_filter_status[ir] |= AFILTER_PATIENT_FILTERED
+    asmt_filter_status[~hex_id_field.isin(src_asmt_patient_ids, patient_ids)] |=\
+        AFILTER_PATIENT_FILTERED
 
+    assessment_summary = flag_summary(asmt_filter_status)
     print('assessments filtered due to patient filtering:',
-          count_flag_set(asmt_filter_status, AFILTER_PATIENT_FILTERED))
-    print('assessments filtered total:',
-          count_flag_set(asmt_filter_status, FILTERA_ALL))
+          assessment_summary.set_count(AFILTER_PATIENT_FILTERED))
+    print('assessments filtered total:', assessment_summary.set_count(FILTERA_ALL))
 
     print(); print("checking temperature")
     fn_fac = parsing_schema.class_entries['validate_temperature']
@@ -265,13 +409,39 @@ def pipeline(patient_filename, assessment_filename, data_schema, parsing_schema,
     src_tested_covid_positive = asmt_ds.field_by_name('tested_covid_positive')
     fn = CheckTestingConsistency(FILTER_INCONSISTENT_NOT_TESTED, FILTER_INCONSISTENT_TESTED)
     fn(src_had_test, src_tested_covid_positive, asmt_filter_status)
-    print(f'inconsistent_not_tested: filtered {count_flag_set(asmt_filter_status, FILTER_INCONSISTENT_NOT_TESTED)} missing values')
-    print(f'inconsistent_tested: filtered {count_flag_set(asmt_filter_status, FILTER_INCONSISTENT_TESTED)} missing values')
+    assessment_summary = flag_summary(asmt_filter_status)
+    print(f'inconsistent_not_tested: filtered {assessment_summary.set_count(FILTER_INCONSISTENT_NOT_TESTED)} missing values')
+    print(f'inconsistent_tested: filtered {assessment_summary.set_count(FILTER_INCONSISTENT_TESTED)} missing values')
 
 
     print(); print('unfiltered assessments:', np.count_nonzero(asmt_filter_status == 0))
 
 
+    sanitised_covid_results_key = categorical_maps['tested_covid_positive'].values_to_strings[:]
+    all_asmt_filter_status = asmt_filter_status
+    if two_phase:
+        # the covid progression check runs before the second phase, so that it filters the
+        # assessments whose remaining fields are loaded
+        sanitised_hct_covid_results, sanitised_covid_results =\
+            validate_covid_progression(asmt_ds, asmt_filter_status, parsing_schema)
+        print(); print('unfiltered assessments:', np.count_nonzero(asmt_filter_status == 0))
+
+        print(); print()
+        print("load remaining fields of unfiltered assessments")
+        print("-----------------------------------------------")
+        unfiltered_rows = np.flatnonzero(asmt_filter_status == 0)
+        asmt_ds = load_remaining_assessments(asmt_ds, unfiltered_rows, assessment_filename,
+                                             data_schema, parsing_schema, cache_dir)
+        asmt_ds.show()
+        print("assessment row count:", asmt_ds.row_count())
+        # from here on, assessments are only those that were loaded in the second phase
+        asmt_filter_status = asmt_filter_status[unfiltered_rows]
+        for k, v in asmt_dest_fields.items():
+            asmt_dest_fields[k] = v[unfiltered_rows]
+        sanitised_hct_covid_results = sanitised_hct_covid_results[unfiltered_rows]
+        sanitised_covid_results = sanitised_covid_results[unfiltered_rows]
+
+
     print(); print()
     print("convert symptomatic, exposure, flattened and miscellaneous fields to bool")
     print("-------------------------------------------------------------------------")
@@ -307,35 +477,23 @@ def pipeline(patient_filename, assessment_filename, data_schema, parsing_schema,
     print(); print()
     print("validate health status with symptoms")
     print("---------------------------------")
+    if two_phase:
+        # the assessments filtered in the first phase weren't loaded, so aren't counted here
+        print('checking the assessments that passed the earlier checks only')
     fn = CheckInconsistentSymptoms(FILTER_HEALTHY_BUT_SYMPTOMS, FILTER_NOT_HEALTHY_BUT_NO_SYMPTOMS)
     # TODO: keys should be got from the dataset once it is loaded rather than referring to the categorical maps directly
     fn(asmt_dest_fields['health_status'], any_symptoms, asmt_filter_status,
        categorical_maps['health_status'].strings_to_values['healthy'],
        categorical_maps['health_status'].strings_to_values['not_healthy'])
+    assessment_summary = flag_summary(asmt_filter_status)
     for f in (FILTER_HEALTHY_BUT_SYMPTOMS, FILTER_NOT_HEALTHY_BUT_NO_SYMPTOMS):
-        print(f'{assessment_flag_descs[f]}: {count_flag_set(asmt_filter_status, f)}')
+        print(f'{assessment_flag_descs[f]}: {assessment_summary.set_count(f)}')
 
     print(); print('unfiltered assessments:', np.count_nonzero(asmt_filter_status == 0))
 
-
-    # validate assessments per patient
-    print(); print()
-    print("validate covid progression")
-    print("--------------------------")
-    sanitised_hct_covid_results = np.ndarray(asmt_ds.row_count(), dtype=np.uint8)
-    sanitised_covid_results = np.ndarray(asmt_ds.row_count(), dtype=np.uint8)
-    sanitised_covid_results_key = categorical_maps['tested_covid_positive'].values_to_strings[:]
-
-    fn_fac = parsing_schema.class_entries['clean_covid_progression']
-    fn = fn_fac(asmt_ds.field_by_name('had_covid_test'), asmt_ds.field_by_name('tested_covid_positive'),
-                asmt_filter_status,
-                sanitised_hct_covid_results, sanitised_covid_results,
-                FILTER_INVALID_COVID_PROGRESSION)
-    iterate_over_patient_assessments2(
-        asmt_ds.field_by_name('patient_id'), asmt_filter_status, fn)
-
-    print(f'{assessment_flag_descs[FILTER_INVALID_COVID_PROGRESSION]}:',
-          count_flag_set(asmt_filter_status, FILTER_INVALID_COVID_PROGRESSION))
+    if not two_phase:
+        sanitised_hct_covid_results, sanitised_covid_results =\
+            validate_covid_progression(asmt_ds, asmt_filter_status, parsing_schema)
 
     asmt_dest_fields['tested_covid_positive_clean'] = sanitised_covid_results
     asmt_dest_keys['tested_covid_positive_clean'] = sanitised_covid_results_key
@@ -348,19 +506,18 @@ def pipeline(patient_filename, assessment_filename, data_schema, parsing_schema,
     print(); print()
     print("discard all filtered assessments")
     print("--------------------------------")
-    remaining_asmt_fields = list()
     remaining_dest_fields = dict()
 
-    filter_map = list()
-    for ir, r in enumerate(asmt_filter_status):
-        if r == 0:
-            filter_map.append(ir)
+    filter_map = np.flatnonzero(asmt_filter_status == 0)
 
-    for ir, r in enumerate(asmt_ds.fields_):
-        remaining_asmt_fields.append(filtered_field.FilteredField(r, filter_map))
+    # the unfiltered rows are compacted into contiguous fields of the same kinds, so that packed
+    # ids and timestamps can be grouped quickly and merging reads each row directly. The names
+    # are unchanged, so field indices are the same, and the full assessment fields are released
+    asmt_ds = asmt_ds.filter(asmt_filter_status == 0)
+    remaining_asmt_fields = list(asmt_ds.fields_)
 
     for k, v in asmt_dest_fields.items():
-        remaining_dest_fields[k] = filtered_field.FilteredField(v, filter_map)
+        remaining_dest_fields[k] = filtered_field.FilteredField(v, filter_map).materialise()
 
     print("remaining asmt fields: ", len(filter_map))
     remaining_asmt_filter_status = [0] * len(filter_map)
@@ -380,8 +537,12 @@ def pipeline(patient_filename, assessment_filename, data_schema, parsing_schema,
     existing_field_indices = [(f, asmt_ds.field_to_index(f)) for f in existing_fields]
 
     resulting_fields = dict()
-    for e in existing_fields:
-        resulting_fields[e] = [None] * remaining_asmt_row_count
+    for e, i_e in existing_field_indices:
+        if isinstance(remaining_asmt_fields[i_e], timestamp_field.TimestampField):
+            resulting_fields[e] = np.zeros(remaining_asmt_row_count,
+                                           dtype=timestamp_field.TIMESTAMP_DTYPE)
+        else:
+            resulting_fields[e] = [None] * remaining_asmt_row_count
     for dk, dv in remaining_dest_fields.items():
         resulting_fields[dk] = np.zeros((remaining_asmt_row_count, ), dtype=dv.dtype)
 
@@ -398,7 +559,8 @@ def pipeline(patient_filename, assessment_filename, data_schema, parsing_schema,
     merge = MergeAssessmentRows(concat_field_indices,
                                 resulting_fields, remaining_dest_fields,
                                 existing_field_indices, custom_field_aggregators)
-    iterate_over_patient_assessments(remaining_asmt_fields, remaining_asmt_filter_status, merge)
+    iterate_over_patient_assessments(remaining_asmt_fields, remaining_asmt_filter_status, merge,
+                                     asmt_ds.field_to_index('patient_id'))
     print(merge.rfindex)
 
     unique_patients = defaultdict(int)
@@ -411,12 +573,12 @@ def pipeline(patient_filename, assessment_filename, data_schema, parsing_schema,
     print("----------------")
 
     print(); print('patient flags set')
-    for v in patient_flag_descs.keys():
-        print(f'{patient_flag_descs[v]}: {count_flag_set(geoc_filter_status, v)}')
+    print_flag_summary(flag_summary(geoc_filter_status, patient_flag_descs))
 
+    if two_phase:
+        all_asmt_filter_status[unfiltered_rows] = asmt_filter_status
     print(); print('assessment flags set')
-    for v in assessment_flag_descs.keys():
-        print(f'{assessment_flag_descs[v]}: {count_flag_set(asmt_filter_status, v)}')
+    print_flag_summary(flag_summary(all_asmt_filter_status, assessment_flag_descs))
 
     return (geoc_ds, geoc_filter_status, ptnt_dest_fields,
             asmt_ds, asmt_filter_status,
@@ -493,14 +655,18 @@ def regression_test_assessments(old_assessments, new_assessments):
     r_a_ds.sort(('patient_id', 'updated_at'))
     p_a_ds.sort(('patient_id', 'updated_at'))
 
+    # find each patient's assessments through the row indices of the files rather than by
+    # scanning every assessment for every patient
+    r_a_rows = row_index.for_source(old_assessments, ('patient_id',))
+    p_a_rows = row_index.for_source(new_assessments, ('patient_id',))
+    r_a_sorted_rows = np.argsort(r_a_ds.index_)
+    p_a_sorted_rows = np.argsort(p_a_ds.index_)
     for pd in patients_with_disparities:
         print(); print(pd)
-        for ir in range(r_a_ds.row_count()):
-            if r_a_ds.value_from_fieldname(ir, 'patient_id') == pd:
-                print_diagnostic_row(f'r[ir]', r_a_ds, ir, diagnostic_row_keys, fns=r_fns)
-        for ip in range(p_a_ds.row_count()):
-            if p_a_ds.value_from_fieldname(ir, 'patient_id') == pd:
-                print_diagnostic_row(f'p[ip]', p_a_ds, ip, diagnostic_row_keys)
+        for ir in np.sort(r_a_sorted_rows[r_a_rows.rows_for('patient_id', pd)]):
+            print_diagnostic_row(f'r[ir]', r_a_ds, ir, diagnostic_row_keys, fns=r_fns)
+        for ip in np.sort(p_a_sorted_rows[p_a_rows.rows_for('patient_id', pd)]):
+            print_diagnostic_row(f'p[ip]', p_a_ds, ip, diagnostic_row_keys)
 
     print('done')
 
@@ -574,35 +740,45 @@ def save_csv(pipeline_output, patient_data_out, assessment_data_out, data_schema
     p_ds, p_status, p_dest_fields,\
     a_ds, a_status, ra_fields, ra_status, res_fields, res_keys \
         = pipeline_output
-    remaining_patients = set()
-    for p in res_fields['patient_id']:
-        remaining_patients.add(p)
-    for ip, p in enumerate(p_ds.field_by_name('id')):
-        if p not in remaining_patients:
-            p_status[ip] |= FILTER_NOT_IN_FINAL_ASSESSMENTS
+    p_status[~hex_id_field.isin(p_ds.field_by_name('id'), res_fields['patient_id'])] |=\
+        FILTER_NOT_IN_FINAL_ASSESSMENTS
 
     print();
     print(f'writing patient data to {patient_data_out}')
     tstart = time.time()
-    with open(patient_data_out, 'w') as f:
+    with compressed_io.open_text(patient_data_out, 'w') as f:
         dest_keys = list(p_dest_fields.keys())
         values = [None] * (len(p_ds.names_) + len(dest_keys))
         csvw = csv.writer(f)
         csvw.writerow(p_ds.names_ + dest_keys)
+        # string arenas are quoted in bulk and their rows written as they are; other values are
+        # quoted as csv.writer would quote them
+        p_fields = [v.csv_quoted() if isinstance(v, numpy_buffer.StringArena) else v
+                    for v in p_ds.fields_]
+        p_fields += [p_dest_fields[k] for k in dest_keys]
+        quoted = [isinstance(v, numpy_buffer.StringArena) for v in p_fields]
         for ir in range(p_ds.row_count()):
             if p_status[ir] == 0:
-                for iv, v in enumerate(p_ds.fields_):
-                    values[iv] = v[ir]
-                for iv in range(len(dest_keys)):
-                    values[len(p_ds.names_) + iv] = p_dest_fields[dest_keys[iv]][ir]
-                csvw.writerow(values)
+                for iv, v in enumerate(p_fields):
+                    values[iv] = v[ir] if quoted[iv] else to_csv_value(v[ir])
+                f.write(','.join(values) + '\r\n')
     print(f'written to {patient_data_out} in {time.time() - tstart} seconds')
 
     functor_fields = {'created_at': datetime_to_seconds, 'updated_at': datetime_to_seconds}
+    # timestamp fields are formatted in bulk rather than row by row
+    formatted_fields = dict()
+    for rh in functor_fields:
+        if timestamp_field.is_timestamps(res_fields[rh]):
+            formatted_fields[rh] = timestamp_field.to_strings(res_fields[rh], unit='s').tolist()
+    updated = res_fields['updated_at']
+    if timestamp_field.is_timestamps(updated):
+        days = timestamp_field.to_strings(updated, unit='D').tolist()
+    else:
+        days = [f"{u[0:4]}-{u[5:7]}-{u[8:10]}" for u in updated]
 
     print(f'writing assessment data to {assessment_data_out}')
     tstart = time.time()
-    with open(assessment_data_out, 'w') as f:
+    with compressed_io.open_text(assessment_data_out, 'w') as f:
         csvw = csv.writer(f)
         headers = list(res_fields.keys())
         # TODO: constructed fields should be in their own collection; the ['day'] and +1 stuff is a temporary hack
@@ -612,7 +788,9 @@ def save_csv(pipeline_output, patient_data_out, assessment_data_out, data_schema
         for ir in range(len(res_fields['id'])):
             if ra_status[ir] == 0:
                 for irh, rh in enumerate(headers):
-                    if rh in functor_fields:
+                    if rh in formatted_fields:
+                        row_values[irh] = formatted_fields[rh][ir]
+                    elif rh in functor_fields:
                         row_values[irh] = functor_fields[rh](res_fields[rh][ir])
                     elif rh in categorical_maps:
                         v_to_s = categorical_maps[rh].values_to_strings
@@ -621,8 +799,7 @@ def save_csv(pipeline_output, patient_data_out, assessment_data_out, data_schema
                         row_values[irh] = v_to_s[res_fields[rh][ir]]
                     else:
                         row_values[irh] = res_fields[rh][ir]
-                updated = res_fields['updated_at']
-                row_values[-1] = f"{updated[ir][0:4]}-{updated[ir][5:7]}-{updated[ir][8:10]}"
+                row_values[-1] = days[ir]
                 csvw.writerow(row_values)
                 for irv in range(len(row_values)):
                     row_values[irv] = None
@@ -652,6 +829,29 @@ if __name__ == '__main__':
     parser.add_argument('-ps', '--parsing_schema', default=1, type=int,
                         help='the schema number to use for parsing and cleaning data')
     parser.add_argument('-y', '--year', default=datetime.datetime.now().year, type=int)
+    parser.add_argument('-c', '--cache_dir', default=None,
+                        help='a directory in which to cache parsed input data for faster reloading')
+    parser.add_argument('-w', '--workers', default=None, type=int,
+                        help='the number of processes to use when parsing input data')
+    parser.add_argument('-pa', '--preallocate', action='store_true',
+                        help='count the input rows before parsing so that fields are allocated once')
+    parser.add_argument('-m', '--memory_budget', default=None, type=int,
+                        help='sort the input data out of core using roughly this many megabytes, '
+                             'into the cache directory (requires --cache_dir)')
+    parser.add_argument('-tp', '--two_phase', action='store_true',
+                        help='only load the fields that assessments are filtered on for every '
+                             'assessment, and the remaining fields for unfiltered assessments. '
+                             'The health status checks then only count assessments that passed '
+                             'the earlier checks in the filter summaries')
+    parser.add_argument('-cr', '--csv_reader', default=None,
+                        choices=list(csv_readers.READERS.keys()) + ['auto'],
+                        help="the csv parser to read input data with; 'arrow' and 'pandas' "
+                             "require pyarrow or pandas, and 'auto' times the installed parsers "
+                             "on the start of each file and picks the fastest, using 'python' "
+                             "if the others are no faster")
+    parser.add_argument('-ia', '--incremental_from', default=None,
+                        help='an earlier assessment export whose cached fields are reused for the '
+                             'rows it shares with the assessment data (requires --cache_dir)')
     args = parser.parse_args()
 
     if args.parsing_schema not in parsing_schemas.parsing_schemas:
@@ -659,6 +859,22 @@ if __name__ == '__main__':
         print(error_str.format(parsing_schemas.parsing_schemas))
         exit(-1)
 
+    if args.memory_budget is not None and args.cache_dir is None:
+        print('--memory_budget requires --cache_dir to be set')
+        exit(-1)
+
+    if args.incremental_from is not None:
+        if args.cache_dir is None:
+            print('--incremental_from requires --cache_dir to be set')
+            exit(-1)
+        if args.memory_budget is not None:
+            print('--incremental_from can\'t be combined with --memory_budget')
+            exit(-1)
+
+    if args.two_phase and compressed_io.is_compressed(args.assessment_data):
+        print('--two_phase requires an uncompressed assessment data file')
+        exit(-1)
+
     if args.regression_test:
         regression_test_assessments('assessments_cleaned_short.csv', args.assessment_data)
         regression_test_patients('patients_cleaned_short.csv', args.patient_data)
@@ -671,7 +887,12 @@ if __name__ == '__main__':
         parsing_schema = parsing_schemas.ParsingSchema(parsing_schema_version)
         pipeline_output = pipeline(args.patient_data, args.assessment_data,
                                    data_schema, parsing_schema, args.year,
-                                   territory=args.territory)
+                                   territory=args.territory, cache_dir=args.cache_dir,
+                                   workers=args.workers, preallocate=args.preallocate,
+                                   memory_budget=None if args.memory_budget is None
+                                   else args.memory_budget << 20,
+                                   two_phase=args.two_phase, csv_reader=args.csv_reader,
+                                   incremental_from=args.incremental_from)
         print(f'cleaning completed in {time.time() - tstart} seconds')
 
         save_csv(pipeline_output, args.patient_data_out, args.assessment_data_out, data_schema)
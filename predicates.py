@@ -0,0 +1,54 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+
+from dictionary_field import DictionaryField
+import hex_id_field
+
+# Predicates select the rows of a source to load by the value of one of its fields. They are
+# called with the csv value of their field while the source is parsed, and can also be applied
+# to a string field that has already been loaded (such as a field from a columnar cache).
+# Predicates are passed to the worker processes of a parallel load, so must be picklable.
+
+
+class Equals:
+    """
+    Holds for rows whose value of 'field' is 'value'
+    """
+    def __init__(self, field, value):
+        self.field = field
+        self.value = value
+
+    def __call__(self, value):
+        return value == self.value
+
+    def mask(self, field):
+        if isinstance(field, (DictionaryField, hex_id_field.HexIdField)):
+            return field.equals(self.value)
+        return np.fromiter((v == self.value for v in field), dtype=np.bool_, count=len(field))
+
+
+class IsIn:
+    """
+    Holds for rows whose value of 'field' is one of 'values'
+    """
+    def __init__(self, field, values):
+        self.field = field
+        self.values = values if isinstance(values, (set, frozenset)) else frozenset(values)
+
+    def __call__(self, value):
+        return value in self.values
+
+    def mask(self, field):
+        if isinstance(field, DictionaryField):
+            return field.isin(self.values)
+        return hex_id_field.isin(field, self.values)
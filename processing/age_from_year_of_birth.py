@@ -9,6 +9,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import numpy as np
+
+from distinct_values import apply_by_distinct
+from numeric_field import NumericField
 from utils import check_input_lengths
 
 
@@ -23,6 +27,31 @@ class CalculateAgeFromYearOfBirth:
     def __call__(self, year_of_birth, age, flags):
         check_input_lengths(('year_of_birth', 'age'), (year_of_birth, age))
 
+        if isinstance(year_of_birth, NumericField):
+            # the years are already parsed, so the range check is only done per distinct age
+            present = np.flatnonzero(~year_of_birth.missing)
+            ages = self.current_year - np.trunc(year_of_birth.values[present])
+            # years such as 'nan' and 'inf' have no age, so are bad rather than cast to one
+            finite = np.isfinite(ages)
+            distinct_ages, inverse = np.unique(ages[finite], return_inverse=True)
+            in_range = np.zeros(len(present), dtype=np.bool_)
+            in_range[finite] = np.asarray([self.in_range_fn(int(a)) for a in distinct_ages],
+                                          dtype=np.bool_)[inverse]
+            age[present] = 0
+            age[present[in_range]] = ages[in_range]
+            for i_r in present[~in_range]:
+                flags[i_r] |= self.f_bad_age
+            for i_r in np.flatnonzero(year_of_birth.missing):
+                flags[i_r] |= self.f_missing_age
+            return
+
+        # the row by row calculation is done once per distinct combination of year and flags
+        if isinstance(age, np.ndarray) and isinstance(flags, np.ndarray):
+            apply_by_distinct(self._from_strings, year_of_birth, age, flags)
+        else:
+            self._from_strings(year_of_birth, age, flags)
+
+    def _from_strings(self, year_of_birth, age, flags):
         for i_r in range(len(year_of_birth)):
             yob = year_of_birth[i_r]
             if yob != '':
@@ -9,14 +9,28 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import numpy as np
+
+from timestamp_field import TimestampField
 from utils import find_longest_sequence_of
 
 class CalculateMergedFieldCount:
     def __init__(self, updated_ats):
         self.updated_ats = updated_ats
         self.merged_row_count = 0
+        self.same_day_counts = None
+        if isinstance(updated_ats, TimestampField):
+            # the number of rows up to and including each row that are on the same day as the
+            # row before them
+            same_day = updated_ats.days[1:] == updated_ats.days[:-1]
+            self.same_day_counts = np.zeros(len(updated_ats), dtype=np.int64)
+            np.cumsum(same_day, out=self.same_day_counts[1:])
+            self.same_day_counts = self.same_day_counts.tolist()
 
     def __call__(self, patient_id, filter_status, start, end):
+        if self.same_day_counts is not None:
+            self.merged_row_count += self.same_day_counts[end] - self.same_day_counts[start]
+            return
         for i in range(start + 1, end + 1):
             last_date_str = self.updated_ats[i - 1]
             last_date = (last_date_str[0:4], last_date_str[5:7], last_date_str[8:10])
@@ -27,6 +41,12 @@ class CalculateMergedFieldCount:
 
 
 class MergeAssessmentRows:
+    """
+    Merge the assessments of each patient that were updated on the same day into one row of
+    'resulting_fields'. Timestamp fields (see timestamp_field.TimestampField) are copied as
+    datetime64 values, so their resulting fields should be datetime64 arrays. The patient id and
+    update time are found by name in 'existing_field_indices'
+    """
     def __init__(self, concat_field_indices,
                  resulting_fields, created_fields, existing_field_indices,
                  custom_field_aggregators):
@@ -37,7 +57,18 @@ class MergeAssessmentRows:
         self.created_fields = created_fields
         self.existing_field_indices = existing_field_indices
         self.custom_field_aggregators = custom_field_aggregators
+        field_indices = dict(existing_field_indices)
+        self.patient_id_index = field_indices['patient_id']
+        self.updated_at_index = field_indices['updated_at']
+        self.fields_ = None
+        self.source_fields_ = None
 
+    def _source_fields(self, fields):
+        if fields is not self.fields_:
+            self.fields_ = fields
+            self.source_fields_ = [f.timestamps if isinstance(f, TimestampField) else f
+                                   for f in fields]
+        return self.source_fields_
 
     def populate_row(self, source_fields, source_index):
         for e in self.existing_field_indices:
@@ -60,20 +91,29 @@ class MergeAssessmentRows:
                 esq_sequences[i_c] =\
                     max(esq_sequences[i_c], find_longest_sequence_of(fields[c][i], '`'))
         if esq_sequences != [1, 1]:
-            print(fields[1], esq_sequences)
+            print(fields[self.patient_id_index], esq_sequences)
+        source_fields = self._source_fields(fields)
+        updated_ats = fields[self.updated_at_index]
+        days = updated_ats.days if isinstance(updated_ats, TimestampField) else None
         # write the first row to the current resulting field index
-        prev_date_str = fields[3][start]
-        prev_date = (prev_date_str[0:4], prev_date_str[5:7], prev_date_str[8:10])
-        self.populate_row(fields, start)
+        if days is not None:
+            prev_date = days[start]
+        else:
+            prev_date_str = updated_ats[start]
+            prev_date = (prev_date_str[0:4], prev_date_str[5:7], prev_date_str[8:10])
+        self.populate_row(source_fields, start)
 
         for i in range(start + 1, end + 1):
-            cur_date_str = fields[3][i]
-            cur_date = (cur_date_str[0:4], cur_date_str[5:7], cur_date_str[8:10])
+            if days is not None:
+                cur_date = days[i]
+            else:
+                cur_date_str = updated_ats[i]
+                cur_date = (cur_date_str[0:4], cur_date_str[5:7], cur_date_str[8:10])
             if cur_date != prev_date:
                 self.rfindex += 1
             if i % 1000000 == 0 and i > 0:
                 print('.')
-            self.populate_row(fields, i)
+            self.populate_row(source_fields, i)
             prev_date = cur_date
 
         # finally, update the resulting field index one more time
@@ -11,6 +11,8 @@
 
 import numpy as np
 
+from numeric_field import NumericField
+
 
 class ValidateTemperature1:
     def __init__(self, min_temp_incl, max_temp_incl, f_missing_temp, f_bad_temp):
@@ -20,6 +22,8 @@ class ValidateTemperature1:
         self.f_bad_temp = f_bad_temp
 
     def __call__(self, temps, filter_list):
+        if isinstance(temps, NumericField):
+            return self._validate_numeric(temps, filter_list)
         temperature_c = np.zeros_like(temps, dtype=np.float)
         for ir, t in enumerate(temps):
             if t == '':
@@ -37,4 +41,21 @@ class ValidateTemperature1:
                 else:
                     temperature_c[ir] = dest_temp
 
-        return temperature_c
\ No newline at end of file
+        return temperature_c
+
+    def _validate_numeric(self, temps, filter_list):
+        present = ~temps.missing
+        t = temps.values
+        dest_temps = np.where(t > self.max_temp_incl, (t - 32) / 1.8, t)
+        zero = present & (dest_temps == 0.0)
+        bad = present & ~zero &\
+            ((dest_temps <= self.min_temp_incl) | (dest_temps >= self.max_temp_incl))
+        valid = present & ~zero & ~bad
+
+        temperature_c = np.zeros(len(temps), dtype=np.float64)
+        temperature_c[valid] = dest_temps[valid]
+        for ir in np.flatnonzero(temps.missing | zero):
+            filter_list[ir] |= self.f_missing_temp
+        for ir in np.flatnonzero(bad):
+            filter_list[ir] |= self.f_bad_temp
+        return temperature_c
@@ -11,6 +11,9 @@
 
 import numpy as np
 
+from distinct_values import apply_by_distinct
+from numeric_field import NumericField
+
 
 class ValidateHeight1:
     def __init__(self,
@@ -53,6 +56,30 @@ class ValidateHeight1:
         self.height_cm_clean = np.zeros(len(heights), dtype=np.float)
         self.bmi_clean = np.zeros(len(bmis), dtype=np.float)
 
+        if _all_numeric(weights, heights, bmis):
+            _clean_numeric(weights, self.min_weight_inc, self.max_weight_inc,
+                           self.f_missing_weight, self.f_bad_weight,
+                           self.weight_kg_clean, filter_list)
+            _clean_numeric(heights, self.min_height_inc, self.max_height_inc,
+                           self.f_missing_height, self.f_bad_height,
+                           self.height_cm_clean, filter_list)
+            _clean_numeric(bmis, self.min_bmi_inc, self.max_bmi_inc,
+                           self.f_missing_bmi, self.f_bad_bmi,
+                           self.bmi_clean, filter_list)
+            return self.weight_kg_clean, self.height_cm_clean, self.bmi_clean
+
+        # the row by row cleaning is done once per distinct combination of the strings
+        if isinstance(filter_list, np.ndarray):
+            results = apply_by_distinct(self._clean_strings, weights, heights, bmis, filter_list)
+        else:
+            results = self._clean_strings(weights, heights, bmis, filter_list)
+        self.weight_kg_clean, self.height_cm_clean, self.bmi_clean = results
+        return results
+
+    def _clean_strings(self, weights, heights, bmis, filter_list):
+        weights_clean = np.zeros(len(weights), dtype=np.float)
+        heights_clean = np.zeros(len(heights), dtype=np.float)
+        bmis_clean = np.zeros(len(bmis), dtype=np.float)
         for ir in range(len(weights)):
             if weights[ir] == '':
                 if self.f_missing_weight != 0:
@@ -62,7 +89,7 @@ class ValidateHeight1:
                 if weight_clean < self.min_weight_inc or weight_clean > self.max_weight_inc:
                     filter_list[ir] |= self.f_bad_weight
                 else:
-                    self.weight_kg_clean[ir] = weight_clean
+                    weights_clean[ir] = weight_clean
 
             if heights[ir] == '':
                 if self.f_missing_height != 0:
@@ -72,7 +99,7 @@ class ValidateHeight1:
                 if height_clean < self.min_height_inc or height_clean > self.max_height_inc:
                     filter_list[ir] |= self.f_bad_height
                 else:
-                    self.height_cm_clean[ir] = height_clean
+                    heights_clean[ir] = height_clean
 
             if bmis[ir] == '':
                 if self.f_missing_bmi != 0:
@@ -82,8 +109,8 @@ class ValidateHeight1:
                 if bmi_clean < self.min_bmi_inc or bmi_clean > self.max_bmi_inc:
                     filter_list[ir] |= self.f_bad_bmi
                 else:
-                    self.bmi_clean[ir] = bmi_clean
-        return self.weight_kg_clean, self.height_cm_clean, self.bmi_clean
+                    bmis_clean[ir] = bmi_clean
+        return weights_clean, heights_clean, bmis_clean
 
 
 class ValidateHeight2:
@@ -135,6 +162,22 @@ class ValidateHeight2:
         self.height_cm_clean = np.zeros(len(heights), dtype=np.float)
         self.bmi_clean = np.zeros(len(bmis), dtype=np.float)
 
+        if _all_numeric(weights, heights, bmis):
+            self._clean_numeric(weights, heights, filter_list)
+            return self.weight_kg_clean, self.height_cm_clean, self.bmi_clean
+
+        # the row by row cleaning is done once per distinct combination of the strings
+        if isinstance(filter_list, np.ndarray):
+            results = apply_by_distinct(self._clean_strings, weights, heights, bmis, filter_list)
+        else:
+            results = self._clean_strings(weights, heights, bmis, filter_list)
+        self.weight_kg_clean, self.height_cm_clean, self.bmi_clean = results
+        return results
+
+    def _clean_strings(self, weights, heights, bmis, filter_list):
+        weights_clean = np.zeros(len(weights), dtype=np.float)
+        heights_clean = np.zeros(len(heights), dtype=np.float)
+        bmis_clean = np.zeros(len(bmis), dtype=np.float)
         for ir in range(len(weights)):
             if weights[ir] == '':
                 if self.f_missing_weight != 0:
@@ -156,7 +199,7 @@ class ValidateHeight2:
                 if weight_clean < self.min_weight_inc or weight_clean > self.max_weight_inc:
                     filter_list[ir] |= self.f_bad_weight
                 else:
-                    self.weight_kg_clean[ir] = weight_clean
+                    weights_clean[ir] = weight_clean
 
             if heights[ir] == '':
                 if self.f_missing_height != 0:
@@ -173,7 +216,7 @@ class ValidateHeight2:
                 if height_clean < self.min_height_inc or height_clean > self.max_height_inc:
                     filter_list[ir] |= self.f_bad_height
                 else:
-                    self.height_cm_clean[ir] = height_clean
+                    heights_clean[ir] = height_clean
 
                 # Cleaning up bmi
                 if weights[ir] == '' or heights[ir] == '' or height_clean == 0.0:
@@ -185,9 +228,64 @@ class ValidateHeight2:
                     if bmi_clean < self.min_bmi_inc or bmi_clean > self.max_bmi_inc:
                         filter_list[ir] |= self.f_bad_bmi
                     else:
-                        self.bmi_clean[ir] = bmi_clean
-
-        return self.weight_kg_clean, self.height_cm_clean, self.bmi_clean
+                        bmis_clean[ir] = bmi_clean
+
+        return weights_clean, heights_clean, bmis_clean
+
+    def _clean_numeric(self, weights, heights, filter_list):
+        """
+        The same cleaning as the row by row loop, done on the arrays of NumericFields
+        """
+        weight_present = ~weights.missing
+        w = weights.values.astype(np.float64)
+        w = np.select([w < 25, (150 <= w) & (w < 300), (300 <= w) & (w < 450),
+                       (450 <= w) & (w < 1500)],
+                      [w * self.kgs_per_stone, w * self.kgs_per_lb, w * self.stones_per_kg,
+                       w * 0.1], w)
+        # second pass on partially sanitised figure
+        w = np.where((450 <= w) & (w < 600), w * self.stones_per_kg, w)
+        _flag_range(w, weight_present, self.min_weight_inc, self.max_weight_inc,
+                    self.f_missing_weight, self.f_bad_weight, self.weight_kg_clean, filter_list)
+
+        height_present = ~heights.missing
+        h = heights.values.astype(np.float64)
+        h = np.select([h < 2.4, h < 7.4, h > 4000],
+                      [h * 100, h * self.cms_per_foot, h * self.feet_per_cm], h)
+        _flag_range(h, height_present, self.min_height_inc, self.max_height_inc,
+                    self.f_missing_height, self.f_bad_height, self.height_cm_clean, filter_list)
+
+        # bmi is only checked for rows with a height
+        bmi_missing = height_present & (weights.missing | (h == 0.0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            bmi = w / ((h / 100) ** 2)
+        _flag_range(bmi, height_present & ~bmi_missing, self.min_bmi_inc, self.max_bmi_inc,
+                    0, self.f_bad_bmi, self.bmi_clean, filter_list)
+        for ir in np.flatnonzero(bmi_missing):
+            filter_list[ir] |= self.f_missing_bmi
+
+
+def _all_numeric(*fields):
+    return all(isinstance(f, NumericField) for f in fields)
+
+
+def _flag_range(values, present, min_inc, max_inc, f_missing, f_bad, clean, filter_list):
+    """
+    Flag the rows of 'values' that are missing or outside of [min_inc, max_inc] and copy the
+    rest into 'clean'
+    """
+    bad = present & ((values < min_inc) | (values > max_inc))
+    valid = present & ~bad
+    clean[valid] = values[valid]
+    if f_missing != 0:
+        for ir in np.flatnonzero(~present):
+            filter_list[ir] |= f_missing
+    for ir in np.flatnonzero(bad):
+        filter_list[ir] |= f_bad
+
+
+def _clean_numeric(field, min_inc, max_inc, f_missing, f_bad, clean, filter_list):
+    _flag_range(field.values.astype(np.float64), ~field.missing, min_inc, max_inc,
+                f_missing, f_bad, clean, filter_list)
 
 
 class ValidateHeight3:
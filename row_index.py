@@ -0,0 +1,192 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import csv
+import json
+import locale
+import mmap
+import os
+
+import numpy as np
+
+import columnar_cache
+import compressed_io
+import csv_chunks
+
+# The row index for a csv export is a sidecar directory next to it that holds:
+#  * the byte offset of the start of every row, followed by the size of the file, as a .npy file
+#  * for each key field that the index was built with, the distinct values of the field as a .npy
+#    file of utf-8 bytes in sorted order, the source rows grouped by value and the start of each
+#    value's group of rows
+# All files are memory-mapped on load. The manifest records the fingerprint of the source file
+# (see columnar_cache.fingerprint); an index is only used if it still matches.
+
+INDEX_FORMAT_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+OFFSETS_NAME = 'offsets.npy'
+KEY_BATCH_ROWS = 1 << 20
+
+
+def index_path_for(path):
+    return path + '.rowindex'
+
+
+class RowIndex:
+    """
+    The byte offsets of the rows of a csv file, and optionally the rows of each value of some of
+    its fields, so that rows can be read without parsing the rest of the file
+    """
+    def __init__(self, path, index_path, manifest):
+        self.path_ = path
+        self.index_path_ = index_path
+        self.offsets_ = np.load(os.path.join(index_path, OFFSETS_NAME), mmap_mode='r')
+        self.keys_ = manifest['keys']
+
+    def row_count(self):
+        return len(self.offsets_) - 1
+
+    def keys(self):
+        return list(self.keys_.keys())
+
+    def rows_for(self, key, value):
+        """
+        The source rows, in source order, at which 'key' has the value 'value'
+        """
+        file_stem = self.keys_[key]
+        values = np.load(os.path.join(self.index_path_, file_stem + '.values.npy'),
+                         mmap_mode='r')
+        encoded = value.encode('utf-8')
+        i = np.searchsorted(values, encoded)
+        if i == len(values) or values[i] != encoded:
+            return np.zeros(0, dtype=np.uint32)
+        starts = np.load(os.path.join(self.index_path_, file_stem + '.starts.npy'),
+                         mmap_mode='r')
+        rows = np.load(os.path.join(self.index_path_, file_stem + '.rows.npy'), mmap_mode='r')
+        return np.asarray(rows[starts[i]:starts[i+1]])
+
+    def read_rows(self, rows, encoding=None):
+        """
+        Parse 'rows' from the source file, in the order given
+        """
+        return read_rows(self.path_, self.offsets_, rows, encoding)
+
+
+def read_rows(path, offsets, rows, encoding=None):
+    """
+    Parse 'rows' of 'path' in the order given, reading each row from its byte offset (see
+    csv_chunks.row_offsets)
+    """
+    encoding = encoding or locale.getpreferredencoding(False)
+    if os.path.getsize(path) == 0:
+        return
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            def row_text():
+                for r in rows:
+                    # match the universal newline translation of a text mode file
+                    text = mm[offsets[r]:offsets[r+1]].decode(encoding)
+                    yield text.replace('\r\n', '\n').replace('\r', '\n')
+            for row in csv.reader(row_text(), delimiter=',', quotechar='"'):
+                yield row
+
+
+def _key_values(path, encoding, key_indices, progress):
+    """
+    Read the values of the fields at 'key_indices' from every row of 'path', as arrays of
+    utf-8 bytes
+    """
+    batches = [list() for _ in key_indices]
+    values = [list() for _ in key_indices]
+    with open(path, encoding=encoding) as f:
+        csvr = csv.reader(f, delimiter=',', quotechar='"')
+        next(csvr)
+        for i_r, row in enumerate(csvr):
+            for i_k, i_f in enumerate(key_indices):
+                values[i_k].append(row[i_f].encode('utf-8'))
+            if len(values[0]) == KEY_BATCH_ROWS:
+                for i_k in range(len(key_indices)):
+                    batches[i_k].append(np.asarray(values[i_k], dtype=np.bytes_))
+                    values[i_k] = list()
+                if progress:
+                    print(i_r + 1)
+    for i_k in range(len(key_indices)):
+        batches[i_k].append(np.asarray(values[i_k], dtype=np.bytes_))
+    return [np.concatenate(b) for b in batches]
+
+
+def build(path, keys=(), index_path=None, encoding=None, progress=False):
+    """
+    Build the row index for 'path', with a map from value to rows for each field in 'keys'
+    """
+    path = os.path.abspath(path)
+    if compressed_io.is_compressed(path):
+        raise ValueError(f"'{path}' is compressed, so its rows can't be read from byte offsets")
+    index_path = index_path or index_path_for(path)
+    columnar_cache.begin_write(index_path)
+    source_fingerprint = columnar_cache.fingerprint(path)
+
+    offsets = csv_chunks.row_offsets(path, csv_chunks.header_end(path))
+    np.save(os.path.join(index_path, OFFSETS_NAME), offsets)
+    del offsets
+
+    key_files = dict()
+    if len(keys) > 0:
+        with open(path, encoding=encoding) as f:
+            available_keys = next(csv.reader(f, delimiter=',', quotechar='"'))
+        key_values = _key_values(path, encoding, [available_keys.index(k) for k in keys],
+                                 progress)
+        for i_k, k in enumerate(keys):
+            file_stem = f'key_{i_k:04d}'
+            order = np.argsort(key_values[i_k], kind='stable')
+            values, starts = np.unique(key_values[i_k][order], return_index=True)
+            key_values[i_k] = None
+            np.save(os.path.join(index_path, file_stem + '.values.npy'), values)
+            np.save(os.path.join(index_path, file_stem + '.starts.npy'),
+                    np.append(starts, len(order)).astype(np.int64))
+            np.save(os.path.join(index_path, file_stem + '.rows.npy'), order.astype(np.uint32))
+            key_files[k] = file_stem
+
+    manifest = {'format': INDEX_FORMAT_VERSION,
+                'source': source_fingerprint,
+                'keys': key_files}
+    with open(os.path.join(index_path, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f)
+    return RowIndex(path, index_path, manifest)
+
+
+def read(path, keys=(), index_path=None):
+    """
+    The row index for 'path', or None if there isn't one for the current version of 'path' that
+    has all of 'keys'
+    """
+    path = os.path.abspath(path)
+    index_path = index_path or index_path_for(path)
+    manifest = columnar_cache.read_manifest(index_path)
+    if manifest is None or manifest.get('format') != INDEX_FORMAT_VERSION:
+        return None
+    if manifest['source'] != columnar_cache.fingerprint(path):
+        return None
+    if any(k not in manifest['keys'] for k in keys):
+        return None
+    return RowIndex(path, index_path, manifest)
+
+
+def for_source(path, keys=(), index_path=None, encoding=None, progress=False):
+    """
+    The row index for 'path', which is built if there isn't a valid one with all of 'keys'
+    """
+    index = read(path, (), index_path)
+    if index is not None:
+        if all(k in index.keys_ for k in keys):
+            return index
+        # keep the keys that the index already has
+        keys = index.keys() + [k for k in keys if k not in index.keys_]
+    return build(path, keys, index_path, encoding, progress)
@@ -10,15 +10,44 @@
 # limitations under the License.
 
 import csv
+import os
+import tempfile
 
+import numpy as np
+
+import compressed_io
 import dataset
+import data_schemas
+import hex_id_field
+import row_index
 import utils
 
+ASSESSMENT_BATCH_ROWS = 1 << 20
+
 # read patients in batches of n
 # read assessments for those pages and output them to n
 
 
+def bucket_filename(path, bucket):
+    # the buckets of a compressed file are compressed too
+    extension = '.csv.gz' if compressed_io.is_compressed(path) else '.csv'
+    return compressed_io.csv_stem(path) + f"_{bucket:04d}" + extension
+
+
 def patient_splitter(input_filename, output_filenames, sorted_indices, bucket_size):
+    if not compressed_io.is_compressed(input_filename):
+        _write_patient_buckets(input_filename, output_filenames, sorted_indices, bucket_size)
+        return
+
+    # a compressed file can't be read from row offsets, so it is decompressed once, next to the
+    # input, and the buckets are written from the decompressed copy and its row index
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(input_filename))) as d:
+        source = os.path.join(d, os.path.basename(compressed_io.csv_stem(input_filename)) + '.csv')
+        compressed_io.decompress(input_filename, source)
+        _write_patient_buckets(source, output_filenames, sorted_indices, bucket_size)
+
+
+def _write_patient_buckets(input_filename, output_filenames, sorted_indices, bucket_size):
     ch_del = ','
     ch_quote = '"'
     rows_parsed = 0
@@ -27,23 +56,21 @@ def patient_splitter(input_filename, output_filenames, sorted_indices, bucket_si
 
         keys = next(csvr)
 
-        input_rows = list()
-        for r in csvr:
-            input_rows.append(r)
-
-    remaining_rows = len(input_rows)
+    # rows are read from their offsets in the input file as they are written rather than held
+    read_rows = row_index.for_source(input_filename).read_rows
+    remaining_rows = len(sorted_indices)
 
     accumulated = 0
     for ofn in output_filenames:
-        with open(ofn, 'w') as f_o:
+        with compressed_io.open_text(ofn, 'w') as f_o:
             print("writing", ofn)
             csvw = csv.writer(f_o, delimiter=ch_del, quotechar=ch_quote)
 
             csvw.writerow(keys)
 
-            for i_r in range(min(bucket_size, remaining_rows)):
-                ind = sorted_indices[accumulated + i_r]
-                csvw.writerow(input_rows[ind])
+            bucket_rows = min(bucket_size, remaining_rows)
+            for r in read_rows(sorted_indices[accumulated:accumulated + bucket_rows]):
+                csvw.writerow(r)
             accumulated += bucket_size
             remaining_rows -= bucket_size
 
@@ -53,8 +80,8 @@ def assessment_splitter(input_filename, output_filename, assessment_buckets, buc
     ch_quote = '"'
     rows_parsed = 0
     rows_written = 0
-    with open(input_filename) as f_i:
-        with open(output_filename, 'w') as f_o:
+    with compressed_io.open_text(input_filename) as f_i:
+        with compressed_io.open_text(output_filename, 'w') as f_o:
             csvdr = csv.DictReader(f_i, delimiter=ch_del, quotechar=ch_quote)
             keys = csvdr.fieldnames
             csvr = csv.reader(f_i, delimiter=ch_del, quotechar=ch_quote)
@@ -73,30 +100,27 @@ def assessment_splitter(input_filename, output_filename, assessment_buckets, buc
     print(f"complete: {rows_parsed} ({rows_written})")
 
 
-def split_data(patient_data, assessment_data, bucket_size=500000):
+def split_data(patient_data, assessment_data, bucket_size=500000, cache_dir=None, workers=None,
+               preallocate=False):
 
-    with open(patient_data) as f:
-        p_ds = dataset.Dataset(f, keys=('id', 'created_at'),
-                               progress=True)
+    with compressed_io.open_text(patient_data) as f:
+        p_ds = dataset.Dataset(f, {'id': data_schemas.HexIdFieldDesc('id')},
+                               keys=('id', 'created_at'),
+                               progress=True, cache_dir=cache_dir, workers=workers,
+                               preallocate=preallocate)
                                # progress=True, stop_after=500000)
         p_ds.sort(('created_at', 'id'))
         p_ids = p_ds.field_by_name('id')
         p_dts = p_ds.field_by_name('created_at')
 
-    # put assessment ids into buckets
-    buckets = dict()
-    bucket_index = 0
-    bucket_count = 0
-    for i_r in range(p_ds.row_count()):
-        if bucket_index == bucket_size:
-            bucket_index = 0
-            bucket_count += 1
-        buckets[p_ids[i_r]] = bucket_count
-        bucket_index += 1
+    # put patients into buckets of bucket_size in the order that they were created
+    patient_buckets = np.arange(p_ds.row_count()) // bucket_size
+    bucket_count = int(patient_buckets[-1]) if len(patient_buckets) > 0 else 0
+    bucket_index = p_ds.row_count() - bucket_count * bucket_size
 
     filenames = list()
     for b in range(bucket_count+1):
-        destination_filename = patient_data[:-4] + f"_{b:04d}" + ".csv"
+        destination_filename = bucket_filename(patient_data, b)
         filenames.append(destination_filename)
     print(filenames)
     sorted_indices = p_ds.index_
@@ -105,30 +129,33 @@ def split_data(patient_data, assessment_data, bucket_size=500000):
     patient_splitter(patient_data, filenames, sorted_indices, bucket_size)
 
     print('buckets:', bucket_index)
-    with open(assessment_data) as f:
-        a_ds = dataset.Dataset(f, keys=('patient_id', 'other_symptoms'), progress=True)
 
-    print(utils.build_histogram(buckets.values()))
+    # a patient id that occurs more than once belongs to the bucket of its last occurrence
+    find_patient_rows = hex_id_field.Lookup(p_ids)
+    patient_rows = np.unique(find_patient_rows(p_ids))
+    print(utils.build_histogram(patient_buckets[patient_rows].tolist()))
 
+    # the assessments are read a batch at a time, keeping only the bucket of each
     print('associating assessments with patients')
-    orphaned_assessments = 0
     a_buckets = list()
-    a_pids = a_ds.field_by_name('patient_id')
-    a_os = a_ds.field_by_name('other_symptoms')
-    for i_r in range(a_ds.row_count()):
-        if a_pids[i_r] in buckets:
-            a_buckets.append(buckets[a_pids[i_r]])
-        else:
-            orphaned_assessments += 1
-            a_buckets.append(-1)
-
-    del a_ds
+    with compressed_io.open_text(assessment_data) as f:
+        for batch in dataset.Dataset.iter_batches(
+                f, ASSESSMENT_BATCH_ROWS, keys=('patient_id',),
+                field_descriptors={'patient_id': data_schemas.HexIdFieldDesc('patient_id')},
+                progress=True):
+            a_rows = find_patient_rows(batch.field_by_name('patient_id'))
+            batch_buckets = np.full(len(a_rows), -1, dtype=np.int32)
+            batch_buckets[a_rows >= 0] = patient_buckets[a_rows[a_rows >= 0]]
+            a_buckets.append(batch_buckets)
+    a_buckets = np.concatenate(a_buckets) if len(a_buckets) > 0 else np.zeros(0, dtype=np.int32)
+    orphaned_assessments = np.count_nonzero(a_buckets < 0)
+
     print('orphaned_assessments:', orphaned_assessments)
 
     print(f'{bucket_count + 1} buckets')
     for i in range(bucket_count + 1):
         print('bucket', i)
-        destination_filename = assessment_data[:-4] + f"_{i:04d}" + ".csv"
+        destination_filename = bucket_filename(assessment_data, i)
         print(destination_filename)
         # with open(assessment_data) as f:
         #     a_ds = dataset.Dataset(f, filter_fn=lambda j: a_buckets[j] == i, progress=True)
@@ -148,6 +175,12 @@ if __name__ == '__main__':
                         help='the location and name of the assessment data csv file')
     parser.add_argument('-b', '--bucket_size', type=int, default=500000,
                         help='the number of patients to include in a bucket')
+    parser.add_argument('-c', '--cache_dir', default=None,
+                        help='a directory in which to cache parsed patient data for faster reloading')
+    parser.add_argument('-w', '--workers', default=None, type=int,
+                        help='the number of processes to use when parsing patient data')
+    parser.add_argument('-pa', '--preallocate', action='store_true',
+                        help='count the patient rows before parsing so that fields are allocated once')
 
     args = parser.parse_args()
     if args.bucket_size < 10000:
@@ -158,7 +191,8 @@ if __name__ == '__main__':
     utils.validate_file_exists(args.assessment_data)
 
     try:
-        split_data(args.patient_data, args.assessment_data, args.bucket_size)
+        split_data(args.patient_data, args.assessment_data, args.bucket_size, args.cache_dir,
+                   args.workers, args.preallocate)
     except Exception as e:
         print(e)
         exit(-1)
@@ -13,6 +13,7 @@ import unittest
 
 import numpy as np
 
+from numeric_field import NumericField, to_numeric
 from utils import valid_range_fac_inc
 from processing.age_from_year_of_birth import CalculateAgeFromYearOfBirth
 
@@ -34,3 +35,24 @@ class TestAgeFromYearOfBirth(unittest.TestCase):
         print(yobs)
         print(ages)
         print(flags)
+
+    def test_age_from_numeric_year_of_birth(self):
+        yobs = ['', '1.0', '1930.0', '1950', '1980.5', '2004.0', '2021.0']
+        fn = CalculateAgeFromYearOfBirth(0x1, 0x2, valid_range_fac_inc(16, 70), 2020)
+        expected_ages = np.zeros(len(yobs), dtype=np.uint32)
+        expected_flags = np.zeros_like(expected_ages)
+        fn(yobs, expected_ages, expected_flags)
+
+        ages = np.zeros_like(expected_ages)
+        flags = np.zeros_like(expected_ages)
+        fn(NumericField(*to_numeric(yobs, np.float64)), ages, flags)
+        self.assertListEqual(ages.tolist(), expected_ages.tolist())
+        self.assertListEqual(flags.tolist(), expected_flags.tolist())
+
+        # years that aren't finite numbers, or are too large for an integer age, are bad
+        yobs = ['nan', 'inf', '-inf', '1e300', '1980']
+        ages = np.full(len(yobs), 7, dtype=np.uint32)
+        flags = np.zeros_like(ages)
+        fn(NumericField(*to_numeric(yobs, np.float64)), ages, flags)
+        self.assertListEqual(ages.tolist(), [0, 0, 0, 0, 40])
+        self.assertListEqual(flags.tolist(), [0x2, 0x2, 0x2, 0x2, 0])
@@ -0,0 +1,158 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+import columnar_cache
+import data_schemas
+import dataset
+import dictionary_field
+import external_sort
+
+small_dataset = ('id,patient_id,foo,bar\n'
+                 '0aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa,11111111111111111111111111111111,,"a,b"\n'
+                 '07777777777777777777777777777777,33333333333333333333333333333333,True,\n'
+                 '02222222222222222222222222222222,11111111111111111111111111111111,False,"\xe9\n"\n')
+
+foo_descriptors = {'foo': data_schemas.FieldDesc('foo', {'': 0, 'False': 1, 'True': 2},
+                                                 ['', 'False', 'True'], np.uint8)}
+
+
+class TestColumnarCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.tempdir.name, 'small.csv')
+        self.cache_dir = os.path.join(self.tempdir.name, 'cache')
+        with open(self.source, 'w') as f:
+            f.write(small_dataset)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def _load(self, **kwargs):
+        with open(self.source) as f:
+            return dataset.Dataset(f, cache_dir=self.cache_dir, **kwargs)
+
+    def _cache_path(self):
+        return columnar_cache.cache_path_for(self.cache_dir, os.path.abspath(self.source))
+
+    def _manifest(self):
+        return columnar_cache.read_manifest(self._cache_path())
+
+    def _file_stems(self):
+        return {n.split('.', 1)[0] for n in os.listdir(self._cache_path())
+                if n != columnar_cache.MANIFEST_NAME}
+
+    def test_cached_load_matches_parsed_load(self):
+        parsed = self._load(field_descriptors=foo_descriptors)
+        self.assertIsNotNone(self._manifest())
+        cached = self._load(field_descriptors=foo_descriptors)
+
+        self.assertIsInstance(cached.field_by_name('foo'), np.memmap)
+        self.assertIsInstance(cached.field_by_name('id'), columnar_cache.MappedStringField)
+        self.assertEqual(parsed.names_, cached.names_)
+        self.assertEqual(parsed.row_count(), cached.row_count())
+        for p, c in zip(parsed.fields_, cached.fields_):
+            self.assertListEqual(list(p), list(c))
+
+    def test_subset_of_cached_keys(self):
+        self._load()
+        cached = self._load(keys=('bar', 'id'))
+        self.assertEqual(cached.names_, ['bar', 'id'])
+        self.assertListEqual(list(cached.field_by_name('bar')), ['a,b', '', '\xe9\n'])
+
+    def test_cache_invalidated_by_descriptor_change(self):
+        self._load()
+        ds = self._load(field_descriptors=foo_descriptors)
+        self.assertIsInstance(ds.field_by_name('foo'), np.ndarray)
+        self.assertEqual(self._manifest()['columns'][2]['descriptor']['type'], 'FieldDesc')
+
+    def test_cache_invalidated_by_options(self):
+        self._load()
+        ds = self._load(auto_dictionary=True)
+        self.assertIsInstance(ds.field_by_name('foo'), dictionary_field.DictionaryField)
+        self.assertDictEqual(self._manifest()['options'], {'auto_dictionary': True})
+        ds = self._load()
+        self.assertIsInstance(ds.field_by_name('foo'), list)
+
+        # a cache sorted with dictionary encoded fields isn't used by a plain load
+        external_sort.sort_to_cache(self.source, self.cache_dir, ('id',), auto_dictionary=True)
+        self.assertIsInstance(self._load(auto_dictionary=True).field_by_name('foo'),
+                              dictionary_field.DictionaryField)
+        ds = self._load()
+        self.assertIsInstance(ds.field_by_name('foo'), list)
+        self.assertIsNone(ds.sorted_by_)
+
+    def test_missing_keys_added_to_cache(self):
+        self._load(keys=('id', 'foo'))
+        self._load(keys=('bar',), field_descriptors=foo_descriptors)
+        self.assertListEqual([c['name'] for c in self._manifest()['columns']],
+                             ['id', 'foo', 'bar'])
+        cached = self._load(keys=('bar', 'id', 'foo'))
+        self.assertIsInstance(cached.field_by_name('bar'), columnar_cache.MappedStringField)
+        self.assertListEqual(list(cached.field_by_name('bar')), ['a,b', '', '\xe9\n'])
+
+        # a replaced column's files are removed
+        self._load(keys=('foo',), field_descriptors=foo_descriptors)
+        self.assertSetEqual(self._file_stems(), {c['file'] for c in self._manifest()['columns']})
+        self.assertEqual(len(self._file_stems()), 3)
+
+        # a load with other options replaces the cache and removes its files
+        self._load(keys=('id',), auto_dictionary=True)
+        self.assertSetEqual(self._file_stems(), {self._manifest()['columns'][0]['file']})
+
+    def test_missing_keys_added_to_sorted_cache(self):
+        external_sort.sort_to_cache(self.source, self.cache_dir, ('patient_id', 'id'),
+                                    keys=('id', 'patient_id'))
+        self._load(keys=('bar', 'foo'))
+        ds = self._load(keys=('id', 'bar', 'foo'))
+        self.assertTupleEqual(ds.sorted_by_, ('patient_id', 'id'))
+        self.assertListEqual(ds.index_.tolist(), [2, 0, 1])
+        self.assertListEqual(list(ds.field_by_name('bar')), ['\xe9\n', 'a,b', ''])
+        self.assertListEqual(list(ds.field_by_name('foo')), ['False', '', 'True'])
+
+    def test_cache_invalidated_by_source_change(self):
+        self._load()
+        with open(self.source, 'a') as f:
+            f.write('03333333333333333333333333333333,11111111111111111111111111111111,True,\n')
+        ds = self._load()
+        self.assertEqual(ds.row_count(), 4)
+        self.assertEqual(self._manifest()['row_count'], 4)
+
+    def test_sort_cached(self):
+        self._load()
+        ds = self._load()
+        ds.sort(('patient_id', 'id'))
+        self.assertListEqual(list(ds.field_by_name('id')),
+                             ['02222222222222222222222222222222',
+                              '0aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa',
+                              '07777777777777777777777777777777'])
+
+    def test_same_name_in_different_directories(self):
+        other = os.path.join(self.tempdir.name, 'other', 'small.csv')
+        os.makedirs(os.path.dirname(other))
+        with open(other, 'w') as f:
+            f.write(small_dataset.replace('True', 'False'))
+        self.assertNotEqual(columnar_cache.cache_path_for(self.cache_dir, self.source),
+                            columnar_cache.cache_path_for(self.cache_dir, other))
+        self._load()
+        with open(other) as f:
+            dataset.Dataset(f, cache_dir=self.cache_dir)
+        # neither load invalidated the cache of the other
+        self.assertEqual(self._manifest()['source'],
+                         columnar_cache.fingerprint(os.path.abspath(self.source)))
+        self.assertNotIn('content', self._manifest())
+        self.assertListEqual(list(self._load().field_by_name('foo')), ['', 'True', 'False'])
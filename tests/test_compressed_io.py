@@ -0,0 +1,130 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import io
+import os
+import tempfile
+import unittest
+
+import compressed_io
+import data_schemas
+import dataset
+import split
+
+text = 'id,value\n' + ''.join(f'{i:032x},"value, {i}"\n' for i in range(5000))
+
+
+class TestCompressedIO(unittest.TestCase):
+
+    def test_write_read(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'data.csv.gz')
+            f = io.TextIOWrapper(io.BufferedWriter(
+                compressed_io.ParallelGzipWriter(path, block_size=1000, workers=3)))
+            f.write(text)
+            f.close()
+            # written as many members, which gzip reads as one stream
+            with gzip.open(path, 'rt') as f:
+                self.assertEqual(f.read(), text)
+            with compressed_io.open_text(path) as f:
+                self.assertEqual(f.name, path)
+                self.assertEqual(f.read(), text)
+
+    def test_read_gzip(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'data.csv.gz')
+            with gzip.open(path, 'wt') as f:
+                f.write(text)
+            reader = compressed_io.GzipReader(path, block_size=100, queue_blocks=2)
+            with io.TextIOWrapper(io.BufferedReader(reader)) as f:
+                self.assertEqual(f.readline(), 'id,value\n')
+            with compressed_io.open_text(path) as f:
+                self.assertEqual(f.read(), text)
+
+    def test_truncated(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'data.csv.gz')
+            with gzip.open(path, 'wt') as f:
+                f.write(text)
+            with open(path, 'rb') as f:
+                data = f.read()
+            with open(path, 'wb') as f:
+                f.write(data[:len(data) // 2])
+            with self.assertRaises(EOFError):
+                with compressed_io.open_text(path) as f:
+                    f.read()
+
+    def test_empty(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'empty.csv.gz')
+            with compressed_io.open_text(path, 'w'):
+                pass
+            with gzip.open(path, 'rt') as f:
+                self.assertEqual(f.read(), '')
+
+    def test_dataset(self):
+        descriptors = {'id': data_schemas.HexIdFieldDesc('id')}
+        expected = dataset.Dataset(io.StringIO(text), descriptors)
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'data.csv.gz')
+            with compressed_io.open_text(path, 'w') as f:
+                f.write(text)
+            # loads that need byte offsets fall back to parsing the stream
+            for kwargs in (dict(), dict(workers=2, preallocate=True),
+                           dict(cache_dir=os.path.join(tempdir, 'cache')),
+                           dict(cache_dir=os.path.join(tempdir, 'cache'))):
+                with compressed_io.open_text(path) as f:
+                    ds = dataset.Dataset(f, descriptors, **kwargs)
+                self.assertListEqual(ds.names_, expected.names_)
+                for a, e in zip(ds.fields_, expected.fields_):
+                    self.assertListEqual(list(a), list(e))
+            with compressed_io.open_text(path) as f:
+                with self.assertRaises(ValueError):
+                    dataset.Dataset(f, descriptors, rows=[1, 0])
+
+    def test_bucket_filename(self):
+        self.assertEqual(split.bucket_filename('/data/patients.csv', 3),
+                         '/data/patients_0003.csv')
+        self.assertEqual(split.bucket_filename('/data/patients.csv.gz', 12),
+                         '/data/patients_0012.csv.gz')
+
+    def test_decompress(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'data.csv.gz')
+            with compressed_io.open_text(path, 'w', newline='') as f:
+                f.write(text)
+            compressed_io.decompress(path, os.path.join(tempdir, 'data.csv'))
+            with open(os.path.join(tempdir, 'data.csv'), newline='') as f:
+                self.assertEqual(f.read(), text)
+
+    def test_patient_splitter(self):
+        rows = [4999 - i for i in range(5000)]
+        with tempfile.TemporaryDirectory() as tempdir:
+            buckets = dict()
+            for name in ('data.csv', 'data.csv.gz'):
+                path = os.path.join(tempdir, 'source', name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with compressed_io.open_text(path, 'w') as f:
+                    f.write(text)
+                outputs = [os.path.join(tempdir, f'{name}_{b}.csv') for b in range(3)]
+                split.patient_splitter(path, outputs, rows, 2000)
+                buckets[name] = list()
+                for o in outputs:
+                    with open(o) as f:
+                        buckets[name].append(f.read())
+            self.assertListEqual(buckets['data.csv.gz'], buckets['data.csv'])
+            lines = text.splitlines(keepends=True)
+            self.assertEqual(buckets['data.csv'][1],
+                             lines[0] + ''.join(lines[1 + r] for r in rows[2000:4000]))
+            # the decompressed copy is removed once the buckets are written
+            self.assertListEqual(sorted(os.listdir(os.path.join(tempdir, 'source'))),
+                                 ['data.csv', 'data.csv.gz', 'data.csv.rowindex'])
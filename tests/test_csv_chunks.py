@@ -0,0 +1,74 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import unittest
+
+import csv_chunks
+
+
+class TestCsvChunks(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.tempdir.name, 'rows.csv')
+        self.contents = b'a,"b\nc"\n' + b'1,"x\n\ny"\n2,"""\n"\n3,z\n' * 10
+        with open(self.source, 'wb') as f:
+            f.write(self.contents)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_header_end(self):
+        self.assertEqual(csv_chunks.header_end(self.source), len(b'a,"b\nc"\n'))
+
+    def test_row_aligned_ranges(self):
+        start = csv_chunks.header_end(self.source)
+        for count in (1, 2, 3, 7, 100):
+            ranges = csv_chunks.row_aligned_ranges(self.source, start, count)
+            self.assertEqual(ranges[0][0], start)
+            self.assertEqual(ranges[-1][1], len(self.contents))
+            for r in range(len(ranges) - 1):
+                self.assertEqual(ranges[r][1], ranges[r+1][0])
+            for r in ranges:
+                self.assertIn(self.contents[r[0]:r[0]+2], (b'1,', b'2,', b'3,'))
+
+    def test_count_rows(self):
+        start = csv_chunks.header_end(self.source)
+        self.assertEqual(csv_chunks.count_rows(self.source, start), 30)
+        self.assertEqual(csv_chunks.count_rows(self.source), 31)
+
+    def test_count_rows_without_quotes_or_trailing_newline(self):
+        with open(self.source, 'wb') as f:
+            f.write(b'a,b\n1,2\n3,4')
+        self.assertEqual(csv_chunks.count_rows(self.source, csv_chunks.header_end(self.source)), 2)
+        with open(self.source, 'wb') as f:
+            f.write(b'a,b\n')
+        self.assertEqual(csv_chunks.count_rows(self.source, csv_chunks.header_end(self.source)), 0)
+
+    def test_row_offsets(self):
+        start = csv_chunks.header_end(self.source)
+        offsets = csv_chunks.row_offsets(self.source, start)
+        self.assertEqual(len(offsets), 31)
+        self.assertEqual(offsets[-1], len(self.contents))
+        self.assertEqual(self.contents[offsets[0]:offsets[1]], b'1,"x\n\ny"\n')
+        self.assertEqual(self.contents[offsets[1]:offsets[2]], b'2,"""\n"\n')
+        self.assertEqual(self.contents[offsets[2]:offsets[3]], b'3,z\n')
+
+    def test_row_offsets_without_trailing_newline(self):
+        with open(self.source, 'wb') as f:
+            f.write(b'a,b\n1,2\n3,4')
+        start = csv_chunks.header_end(self.source)
+        self.assertListEqual(csv_chunks.row_offsets(self.source, start).tolist(), [4, 8, 11])
+        with open(self.source, 'wb') as f:
+            f.write(b'a,b\n')
+        self.assertListEqual(csv_chunks.row_offsets(self.source, start).tolist(), [4])
@@ -0,0 +1,151 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import csv_readers
+import data_schemas
+import dataset
+import numpy_buffer
+import predicates
+
+ids = ['0123456789abcdef0123456789abcdef', 'fedcba9876543210fedcba9876543210',
+       '00000000000000000000000000000001']
+countries = ['GB', 'US', 'SE', '']
+treatments = ['', 'rest', '"fluids, paracetamol"', '"two\r\nlines"', 'a ""quoted"" word']
+temperatures = ['36.6', '', '98.6', '-1']
+updated_ats = ['2020-04-01 08:00:00.123456+00:00', '2020-04-02 09:00:00+00:00']
+
+# a mix of quoting, embedded separators and newlines, empty values and typed fields
+rows = [f'{ids[i % 3]},{countries[i % 4]},{treatments[i % 5]},{temperatures[i % 4]},'
+        f'{updated_ats[i % 2]},{["", "True", "False"][i % 3]}'
+        for i in range(50)]
+reader_dataset = 'patient_id,country_code,treatment,temperature,updated_at,fever\r\n' +\
+                 '\r\n'.join(rows) + '\r\n'
+
+descriptors = {
+    'patient_id': data_schemas.HexIdFieldDesc('patient_id'),
+    'country_code': data_schemas.DictionaryFieldDesc('country_code'),
+    'temperature': data_schemas.NumericFieldDesc('temperature'),
+    'updated_at': data_schemas.TimestampFieldDesc('updated_at'),
+    'fever': data_schemas.FieldDesc('fever', {'': 0, 'False': 1, 'True': 2},
+                                    ['', 'False', 'True'], np.uint8)
+}
+
+
+class TestCsvReaders(unittest.TestCase):
+
+    def _load(self, source, reader, **kwargs):
+        with open(source) as f:
+            return dataset.Dataset(f, descriptors, reader=reader, **kwargs)
+
+    def assertDatasetsEqual(self, ds, expected, string_arenas=False):
+        self.assertListEqual(ds.names_, expected.names_)
+        self.assertListEqual(ds.index_.tolist(), expected.index_.tolist())
+        for f, e in zip(ds.fields_, expected.fields_):
+            if string_arenas and isinstance(e, list):
+                # readers that build string fields from their own buffers return StringArenas
+                self.assertIsInstance(f, numpy_buffer.StringArena)
+            else:
+                self.assertIs(type(f), type(e))
+            self.assertListEqual(list(f), list(e))
+
+    def test_readers_conform(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            source = os.path.join(tempdir, 'readers.csv')
+            with open(source, 'w', newline='') as f:
+                f.write(reader_dataset)
+            expected = self._load(source, None)
+            expected_filtered = self._load(source, None, keys=['treatment', 'fever'],
+                                           predicates=[predicates.Equals('country_code', 'GB')])
+            expected_auto = self._load(source, None, auto_dictionary=True)
+            for name in csv_readers.READERS:
+                with self.subTest(reader=name):
+                    if not csv_readers.READERS[name].available():
+                        self.skipTest(f"the '{name}' reader isn't installed")
+                    arenas = csv_readers.READERS[name].string_arenas
+                    self.assertDatasetsEqual(self._load(source, name), expected, arenas)
+                    self.assertDatasetsEqual(
+                        self._load(source, name, keys=['treatment', 'fever'],
+                                   predicates=[predicates.Equals('country_code', 'GB')]),
+                        expected_filtered, arenas)
+                    self.assertDatasetsEqual(self._load(source, name, auto_dictionary=True),
+                                             expected_auto, arenas)
+
+    def test_python_reader_batches(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            source = os.path.join(tempdir, 'readers.csv')
+            with open(source, 'w', newline='') as f:
+                f.write(reader_dataset)
+            batches = list(csv_readers.PythonReader().batches(source, None, [2, 0, 2], 20))
+            self.assertListEqual([len(b[0]) for b in batches], [20, 20, 10])
+            self.assertEqual(batches[0][0][3], 'two\nlines')
+            self.assertEqual(batches[0][1][1], ids[1])
+            self.assertListEqual(batches[0][0], batches[0][2])
+            batches = list(csv_readers.PythonReader().batches(source, None, [0], 20, 25))
+            self.assertListEqual([len(b[0]) for b in batches], [20, 5])
+
+    def test_string_column(self):
+        column = csv_readers.as_column(['b', '', 'a', 'b', '1.5'])
+        self.assertIs(csv_readers.as_column(column), column)
+        self.assertEqual(len(column), 5)
+        self.assertListEqual(column.take(np.asarray([4, 0])).strings(), ['1.5', 'b'])
+        dictionary = column.dictionary()
+        self.assertListEqual(dictionary.values, ['', '1.5', 'a', 'b'])
+        self.assertListEqual(list(dictionary), column.strings())
+        self.assertListEqual(list(column.arena()), column.strings())
+        with self.assertRaises(ValueError):
+            column.numbers(np.float32)
+        values, missing = column.take(np.asarray([1, 4])).numbers(np.float32)
+        self.assertEqual(values[1], 1.5)
+        self.assertListEqual(missing.tolist(), [True, False])
+
+    def test_choose_reader(self):
+        clock = [0.0]
+
+        def fake_reader(reader_name, seconds):
+            class FakeReader:
+                name = reader_name
+                seconds_ = seconds
+
+                @staticmethod
+                def available():
+                    return True
+            return FakeReader
+
+        def load(reader, sample_rows):
+            self.assertEqual(sample_rows, 100)
+            clock[0] += reader.seconds_
+
+        def choose(python, arrow, pandas):
+            readers = {r.name: r for r in (fake_reader('python', python),
+                                           fake_reader('arrow', arrow),
+                                           fake_reader('pandas', pandas))}
+            with mock.patch.dict(csv_readers.READERS, readers, clear=True),\
+                    mock.patch('csv_readers.time.time', lambda: clock[0]):
+                return csv_readers.choose_reader(load, 100).name
+
+        self.assertEqual(choose(4.0, 1.0, 2.0), 'arrow')
+        self.assertEqual(choose(4.0, 3.0, 2.0), 'pandas')
+        # the python reader is kept unless another is enough faster
+        self.assertEqual(choose(4.0, 3.5, 3.9), 'python')
+        self.assertEqual(choose(1.0, 2.0, 3.0), 'python')
+
+    def test_get_reader(self):
+        self.assertIsInstance(csv_readers.get_reader('python'), csv_readers.PythonReader)
+        self.assertIn(csv_readers.get_reader('auto').name, csv_readers.available_readers())
+        with self.assertRaises(ValueError):
+            csv_readers.get_reader('fortran')
@@ -11,7 +11,16 @@
 
 import unittest
 import io
+import os
+import tempfile
+
+import numpy as np
+
+import columnar_cache
+import data_schemas
 import dataset
+import dictionary_field
+import numpy_buffer
 
 small_dataset = ('id,patient_id,foo\n'
                  '0aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa,11111111111111111111111111111111,,\n'
@@ -81,3 +90,252 @@ class TestDataset(unittest.TestCase):
             values[i], values[pi] = values[pi], values[i]
 
         print(values)
+
+
+quoted_dataset = 'id,patient_id,notes,foo\n' +\
+                 ('0aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa,11111111111111111111111111111111,"a\nb",True\n'
+                  '07777777777777777777777777777777,33333333333333333333333333333333,"""c"",\nd\n",\n'
+                  '02222222222222222222222222222222,11111111111111111111111111111111,"e,f",False\n'
+                  '03333333333333333333333333333333,22222222222222222222222222222222,,True\n') * 25
+
+foo_descriptors = {'foo': data_schemas.FieldDesc('foo', {'': 0, 'False': 1, 'True': 2},
+                                                 ['', 'False', 'True'], np.uint8)}
+
+
+class QuotedSourceTestCase(unittest.TestCase):
+    """
+    Tests that load 'quoted_dataset' from a csv file in a temporary directory, which also holds
+    a cache directory for the tests that use one
+    """
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.tempdir.name, 'quoted.csv')
+        self.cache_dir = os.path.join(self.tempdir.name, 'cache')
+        with open(self.source, 'w') as f:
+            f.write(quoted_dataset)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def _load(self, **kwargs):
+        with open(self.source) as f:
+            return dataset.Dataset(f, foo_descriptors, **kwargs)
+
+
+class TestDatasetParallelLoad(QuotedSourceTestCase):
+
+    def test_parallel_load_matches_serial_load(self):
+        serial = self._load()
+        for workers in (2, 3, 8):
+            parallel = self._load(workers=workers)
+            self.assertEqual(serial.names_, parallel.names_)
+            self.assertEqual(serial.row_count(), parallel.row_count())
+            self.assertTrue(np.array_equal(serial.field_by_name('foo'),
+                                           parallel.field_by_name('foo')))
+            for k in ('id', 'patient_id', 'notes'):
+                self.assertListEqual(serial.field_by_name(k), parallel.field_by_name(k))
+
+    def test_parallel_load_with_keys(self):
+        parallel = self._load(keys=('notes', 'id'), workers=2)
+        self.assertEqual(parallel.names_, ('notes', 'id'))
+        self.assertListEqual(parallel.field_by_name('notes')[:4], ['a\nb', '"c",\nd\n', 'e,f', ''])
+
+    def test_preallocated_load_matches_load(self):
+        expected = self._load()
+        preallocated = self._load(preallocate=True, progress=True)
+        self.assertEqual(expected.row_count(), preallocated.row_count())
+        self.assertTrue(np.array_equal(expected.field_by_name('foo'),
+                                       preallocated.field_by_name('foo')))
+        self.assertListEqual(expected.field_by_name('notes'), preallocated.field_by_name('notes'))
+
+        stopped = self._load(preallocate=True, stop_after=9)
+        self.assertEqual(stopped.row_count(), 10)
+        self.assertEqual(len(stopped.field_by_name('foo')), 10)
+
+
+class TestDatasetLoadRows(QuotedSourceTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.expected = self._load()
+
+    def _check_rows(self, ds, rows):
+        self.assertListEqual(ds.index_.tolist(), rows)
+        self.assertListEqual(list(ds.field_by_name('notes')),
+                             [self.expected.field_by_name('notes')[r] for r in rows])
+        self.assertListEqual(ds.field_by_name('foo').tolist(),
+                             self.expected.field_by_name('foo')[rows].tolist())
+
+    def test_load_rows(self):
+        rows = [99, 1, 5, 1, 0, 42]
+        ds = self._load(keys=('notes', 'foo'), rows=rows)
+        self.assertEqual(ds.names_, ('notes', 'foo'))
+        self._check_rows(ds, rows)
+
+        ds = self._load(keys=('notes', 'foo'), rows=[])
+        self.assertEqual(ds.row_count(), 0)
+
+    def test_load_rows_from_sorted_cache(self):
+        ds = self._load(cache_dir=self.cache_dir)
+        ds.sort(('notes',))
+        columnar_cache.write(columnar_cache.cache_path_for(self.cache_dir, self.source),
+                             columnar_cache.fingerprint(os.path.abspath(self.source)),
+                             ds.names_, ds.names_, list(ds.fields_),
+                             dataset.Dataset._descriptor_signatures(foo_descriptors, ds.names_),
+                             index=ds.index_, sorted_by=ds.sorted_by_,
+                             options=columnar_cache.load_options())
+        rows = [7, 2, 64]
+        ds = self._load(keys=('notes', 'foo'), rows=rows, cache_dir=self.cache_dir)
+        self._check_rows(ds, rows)
+        self.assertIsNone(ds.sorted_by_)
+        # rows taken from the cache stay in a string arena
+        self.assertIsInstance(ds.field_by_name('notes'), numpy_buffer.StringArena)
+
+    def test_filter_keeps_string_arenas(self):
+        max_values = dictionary_field.AUTO_DICTIONARY_MAX_VALUES
+        dictionary_field.AUTO_DICTIONARY_MAX_VALUES = 2
+        try:
+            parsed = self._load(auto_dictionary=True, cache_dir=self.cache_dir)
+            cached = self._load(auto_dictionary=True, cache_dir=self.cache_dir)
+        finally:
+            dictionary_field.AUTO_DICTIONARY_MAX_VALUES = max_values
+        self.assertIsInstance(cached.field_by_name('notes'), columnar_cache.MappedStringField)
+
+        notes = self.expected.field_by_name('notes')
+        for ds in (parsed, cached):
+            self.assertIsInstance(ds.field_by_name('notes'), numpy_buffer.StringArena)
+            ds.sort(('notes', 'id'))
+            mask = np.arange(ds.row_count()) % 3 == 0
+            for child in (ds.filter(mask), ds.take([5, 0, 3])):
+                for k in ('id', 'notes'):
+                    self.assertIsInstance(child.field_by_name(k), numpy_buffer.StringArena)
+                self.assertListEqual(list(child.field_by_name('notes')),
+                                     [notes[r] for r in child.index_])
+
+
+class TestDatasetSort(QuotedSourceTestCase):
+
+    def _expected_order(self, ds, keys):
+        rows = [tuple(ds.value_from_fieldname(i, k) for k in keys) for i in range(ds.row_count())]
+        return sorted(range(len(rows)), key=lambda i: rows[i])
+
+    def test_sort_matches_python_sort(self):
+        s = io.StringIO(quoted_dataset.replace('"a\nb"', '\xe9'))
+        ds = dataset.Dataset(s, foo_descriptors)
+        unsorted_notes = list(ds.field_by_name('notes'))
+        expected = self._expected_order(ds, ('foo', 'notes', 'patient_id'))
+
+        ds.sort(('foo', 'notes', 'patient_id'))
+        self.assertListEqual(ds.index_.tolist(), expected)
+        self.assertListEqual(ds.field_by_name('notes'), [unsorted_notes[i] for i in expected])
+
+    def test_sort_twice(self):
+        s = io.StringIO(small_dataset)
+        ds = dataset.Dataset(s)
+        ds.sort(('patient_id', 'id'))
+        ds.sort(('id',))
+        self.assertListEqual(ds.field_by_name('id'),
+                             ['02222222222222222222222222222222',
+                              '07777777777777777777777777777777',
+                              '0aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa'])
+        # index_ still maps sorted rows to their rows in the source
+        self.assertListEqual(ds.index_.tolist(), [2, 1, 0])
+
+    def test_lazy_sort(self):
+        ds = self._load()
+        eager = self._load()
+        unsorted_notes = ds.field_by_name('notes')
+
+        ds.sort(('patient_id', 'id'))
+        ds.sort(('foo',))
+        eager.sort(('patient_id', 'id'), lazy=False)
+        eager.sort(('foo',), lazy=False)
+        self.assertIsInstance(ds.fields_, dataset.PermutedFields)
+        self.assertIsInstance(eager.fields_, list)
+        # fields that haven't been read are still unpermuted
+        self.assertIs(ds.fields_.fields_[ds.field_to_index('notes')], unsorted_notes)
+
+        self.assertListEqual(ds.index_.tolist(), eager.index_.tolist())
+        for ds_field, eager_field in zip(ds.fields_, eager.fields_):
+            self.assertListEqual(list(ds_field), list(eager_field))
+        self.assertListEqual(ds.field_by_name('notes'),
+                             [unsorted_notes[i] for i in ds.index_])
+
+    def test_sort_already_sorted(self):
+        s = io.StringIO(small_dataset)
+        ds = dataset.Dataset(s)
+        ds.sort(('patient_id', 'id'))
+        self.assertEqual(ds.sorted_by_, ('patient_id', 'id'))
+        sorted_fields = ds.fields_
+        ds.sort(('patient_id',))
+        self.assertIs(ds.fields_, sorted_fields)
+        self.assertEqual(ds.sorted_by_, ('patient_id', 'id'))
+
+        s = io.StringIO('id,foo\na,1\nb,1\nc,0\n')
+        ds = dataset.Dataset(s)
+        ds.sort(('id', 'foo'))
+        self.assertIsInstance(ds.fields_, list)
+        self.assertListEqual(ds.index_.tolist(), [0, 1, 2])
+        ds.sort(('foo', 'id'))
+        self.assertListEqual(ds.index_.tolist(), [2, 0, 1])
+        self.assertEqual(ds.sorted_by_, ('foo', 'id'))
+
+    def test_is_sorted(self):
+        first = np.asarray([0, 0, 1, 1])
+        self.assertTrue(dataset._is_sorted([first, np.asarray([3, 4, 0, 0])]))
+        self.assertFalse(dataset._is_sorted([first, np.asarray([3, 4, 1, 0])]))
+        self.assertFalse(dataset._is_sorted([np.asarray([b'b', b'a']), np.asarray([0, 1])]))
+        self.assertTrue(dataset._is_sorted([np.zeros(0)]))
+
+    def test_filter(self):
+        ds = self._load()
+        expected = [list(f) for f in ds.fields_]
+        ds.sort(('patient_id', 'id'))
+        mask = np.zeros(ds.row_count(), dtype=np.bool_)
+        mask[::2] = True
+        filtered = ds.filter(mask)
+        rows = ds.index_[mask].tolist()
+        self.assertListEqual(filtered.names_, ds.names_)
+        self.assertListEqual(filtered.index_.tolist(), rows)
+        self.assertEqual(filtered.sorted_by_, ('patient_id', 'id'))
+        self.assertIsInstance(filtered.fields_, list)
+        # the fields with pending permutations are left unpermuted in the parent
+        self.assertIsNotNone(ds.fields_.pending_[ds.field_to_index('notes')])
+        for f, e in zip(filtered.fields_, expected):
+            self.assertListEqual(list(f), [e[r] for r in rows])
+
+        taken = ds.take([2, 0])
+        self.assertListEqual(taken.index_.tolist(), ds.index_[[2, 0]].tolist())
+        self.assertIsNone(taken.sorted_by_)
+        self.assertListEqual(list(taken.field_by_name('id')),
+                             [expected[ds.field_to_index('id')][r] for r in taken.index_])
+
+
+class TestDatasetIterBatches(QuotedSourceTestCase):
+
+    def test_iter_batches(self):
+        expected = self._load()
+        with open(self.source) as f:
+            batches = list(dataset.Dataset.iter_batches(f, 30, keys=('notes', 'foo'),
+                                                        field_descriptors=foo_descriptors))
+        self.assertListEqual([b.row_count() for b in batches], [30, 30, 30, 10])
+        for b in batches:
+            self.assertEqual(b.names_, ('notes', 'foo'))
+            self.assertEqual(b.field_by_name('foo').dtype, np.uint8)
+            self.assertIsInstance(b.field_by_name('notes'), numpy_buffer.StringArena)
+        self.assertListEqual(np.concatenate([b.index_ for b in batches]).tolist(),
+                             list(range(100)))
+        self.assertListEqual(list(numpy_buffer.concatenate_strings(
+                                 [b.field_by_name('notes') for b in batches])),
+                             expected.field_by_name('notes'))
+        self.assertTrue(np.array_equal(np.concatenate([b.field_by_name('foo') for b in batches]),
+                                       expected.field_by_name('foo')))
+
+        # the strings of a batch take the space of their text rather than that of the longest
+        with open(self.source) as f:
+            batch = next(dataset.Dataset.iter_batches(f, 4, keys=('notes',)))
+        self.assertEqual(len(batch.field_by_name('notes').data_), len('a\nb"c",\nd\ne,f'))
+
+        for batch_rows in (0, -1):
+            with self.assertRaises(ValueError):
+                dataset.Dataset.iter_batches(io.StringIO(quoted_dataset), batch_rows)
@@ -0,0 +1,116 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import unittest
+
+import numpy as np
+
+import data_schemas
+import dataset
+import dictionary_field
+import numpy_buffer
+import utils
+
+versions_dataset = ('id,version,country_code\n'
+                    'a,0.1.4,GB\n'
+                    'b,0.1.3,US\n'
+                    'c,0.1.4,GB\n'
+                    'd,,SE\n')
+
+
+class TestDictionaryField(unittest.TestCase):
+
+    def test_dictionary_buffer(self):
+        values = ['b', 'a', '', 'b', 'c', 'a']
+        db = dictionary_field.DictionaryBuffer()
+        for v in values:
+            db.append(v)
+        field = db.finalise()
+
+        self.assertIsInstance(field, dictionary_field.DictionaryField)
+        self.assertListEqual(field.values, ['', 'a', 'b', 'c'])
+        self.assertEqual(field.codes.dtype, np.uint8)
+        self.assertListEqual(list(field), values)
+        self.assertEqual(field[4], 'c')
+        self.assertListEqual(list(field[1:3]), ['a', ''])
+        self.assertListEqual(list(field.take([5, 0])), ['a', 'b'])
+        self.assertListEqual(field.equals('a').tolist(), [False, True, False, False, False, True])
+        self.assertListEqual(field.isin(['c', 'x']).tolist(), [False] * 4 + [True, False])
+        self.assertListEqual(field.value_counts(), [('', 1), ('a', 2), ('b', 2), ('c', 1)])
+        # codes order in the same way as the strings
+        self.assertListEqual(np.argsort(field.codes, kind='stable').tolist(),
+                             sorted(range(len(values)), key=lambda i: values[i]))
+
+    def test_dictionary_buffer_falls_back_to_list(self):
+        db = dictionary_field.DictionaryBuffer(max_values=3, size=6)
+        for v in ['a', 'b', 'a', 'c', 'd', 'a']:
+            db.append(v)
+        field = db.finalise()
+        self.assertListEqual(field, ['a', 'b', 'a', 'c', 'd', 'a'])
+
+        db = dictionary_field.DictionaryBuffer(max_values=3, arena=True)
+        for v in ['a', 'b', 'a', 'c', 'd', 'a']:
+            db.append(v)
+        field = db.finalise()
+        self.assertIsInstance(field, numpy_buffer.StringArena)
+        self.assertListEqual(list(field), ['a', 'b', 'a', 'c', 'd', 'a'])
+
+    def test_extend(self):
+        field = dictionary_field.from_codes(['b', 'a', 'c'], np.asarray([0, 1, 0, 2]))
+        self.assertListEqual(field.values, ['a', 'b', 'c'])
+        self.assertListEqual(list(field), ['b', 'a', 'b', 'c'])
+
+        db = dictionary_field.DictionaryBuffer()
+        db.append('d')
+        db.extend(field)
+        db.extend(dictionary_field.from_codes(['a', 'e'], np.asarray([1, 0])))
+        result = db.finalise()
+        self.assertListEqual(result.values, ['a', 'b', 'c', 'd', 'e'])
+        self.assertListEqual(list(result), ['d', 'b', 'a', 'b', 'c', 'e', 'a'])
+
+        # the buffer falls back to strings once a batch takes it over 'max_values'
+        db = dictionary_field.DictionaryBuffer(max_values=3, arena=True)
+        db.extend(field)
+        self.assertTrue(db.is_dictionary())
+        db.extend(dictionary_field.from_codes(['d'], np.asarray([0])))
+        self.assertFalse(db.is_dictionary())
+        db.extend(numpy_buffer.concatenate_strings([['e', 'a']]))
+        result = db.finalise()
+        self.assertIsInstance(result, numpy_buffer.StringArena)
+        self.assertListEqual(list(result), ['b', 'a', 'b', 'c', 'd', 'e', 'a'])
+
+        # membership in a larger set of values is found for each distinct value
+        self.assertListEqual(field.isin({'b', 'x', 'y', 'z'}).tolist(),
+                             [True, False, True, False])
+
+    def test_concatenate(self):
+        first = dictionary_field.DictionaryField(np.asarray([1, 0], dtype=np.uint8), ['a', 'c'])
+        second = dictionary_field.DictionaryField(np.asarray([0, 1], dtype=np.uint8), ['b', 'c'])
+        field = dictionary_field.concatenate([first, second])
+        self.assertListEqual(field.values, ['a', 'b', 'c'])
+        self.assertListEqual(list(field), ['c', 'a', 'b', 'c'])
+        self.assertListEqual(dictionary_field.concatenate([first, second], 2), ['c', 'a', 'b', 'c'])
+
+    def test_dataset_dictionary_fields(self):
+        ds = dataset.Dataset(io.StringIO(versions_dataset),
+                             {'version': data_schemas.DictionaryFieldDesc('version')})
+        self.assertIsInstance(ds.field_by_name('version'), dictionary_field.DictionaryField)
+        self.assertIsInstance(ds.field_by_name('country_code'), list)
+
+        ds = dataset.Dataset(io.StringIO(versions_dataset), auto_dictionary=True)
+        self.assertIsInstance(ds.field_by_name('country_code'), dictionary_field.DictionaryField)
+        self.assertEqual(ds.value_from_fieldname(3, 'country_code'), 'SE')
+        self.assertListEqual(utils.build_histogram(ds.field_by_name('version')),
+                             [('', 1), ('0.1.3', 1), ('0.1.4', 2)])
+
+        ds.sort(('version', 'id'))
+        self.assertListEqual(list(ds.field_by_name('id')), ['d', 'b', 'a', 'c'])
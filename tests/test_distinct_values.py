@@ -0,0 +1,109 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import numpy as np
+
+import distinct_values
+from dictionary_field import DictionaryField
+from numeric_field import NumericField, to_numeric
+from processing.age_from_year_of_birth import CalculateAgeFromYearOfBirth
+from processing.temperature import ValidateTemperature1
+from processing.weight_height_bmi import ValidateHeight2
+from utils import valid_range_fac_inc
+
+
+def _dictionary_field(strings):
+    values = sorted(set(strings))
+    return DictionaryField(np.searchsorted(values, strings).astype(np.uint16), values)
+
+
+rng = np.random.RandomState(1234)
+yobs = [['', '1950', '1984.0', '2019', '1820', '1999'][i] for i in rng.randint(0, 6, 1000)]
+weights = [['', '12', '70', '70.5', '200', '1200', '3'][i] for i in rng.randint(0, 7, 1000)]
+heights = [['', '1.8', '6', '175', '5000', '20'][i] for i in rng.randint(0, 6, 1000)]
+bmis = [['', '22', '80'][i] for i in rng.randint(0, 3, 1000)]
+temperatures = [['', '36.6', '98.6', '0', '45', '37'][i] for i in rng.randint(0, 6, 1000)]
+
+
+class TestDistinctValues(unittest.TestCase):
+
+    def test_factorise(self):
+        fields = [['b', 'a', 'b', 'c'], _dictionary_field(['b', 'a', 'b', 'c']),
+                  np.array([2, 1, 2, 3]),
+                  NumericField(*to_numeric(['2', '', '2', '3'], np.float64))]
+        for f in fields:
+            codes, count = distinct_values.factorise(f)
+            self.assertEqual(codes[0], codes[2])
+            self.assertEqual(len(set(codes.tolist())), 3)
+            self.assertGreaterEqual(count, 3)
+        codes, count = distinct_values.factorise_rows(
+            (['a', 'a', 'b', 'a'], np.array([1, 2, 1, 1])))
+        self.assertListEqual(codes.tolist(), [0, 1, 2, 0])
+        self.assertEqual(count, 3)
+
+    def test_age(self):
+        for yob_field in (yobs, _dictionary_field(yobs)):
+            # flags in a list are cleaned row by row, rather than by distinct value
+            expected_ages = np.zeros(len(yobs), dtype=np.uint32)
+            expected_flags = [0x10 if i % 7 == 0 else 0 for i in range(len(yobs))]
+            fn = CalculateAgeFromYearOfBirth(0x1, 0x2, valid_range_fac_inc(0, 90), 2020)
+            fn(yob_field, expected_ages, expected_flags)
+            ages = np.zeros(len(yobs), dtype=np.uint32)
+            flags = np.zeros(len(yobs), dtype=np.uint32)
+            flags[::7] = 0x10
+            fn(yob_field, ages, flags)
+            self.assertListEqual(ages.tolist(), expected_ages.tolist())
+            self.assertListEqual(flags.tolist(), expected_flags)
+
+    def test_weight_height_bmi(self):
+        genders = ['0', '1'] * 500
+        ages = np.zeros(1000, dtype=np.uint32)
+        fn = ValidateHeight2(40, 200, 110, 220, 15, 55,
+                             0x1, 0x2, 0x4, 0x8, 0x10, 0x20, 0x40, 0x80)
+        for fields in ((weights, heights, bmis),
+                       [_dictionary_field(f) for f in (weights, heights, bmis)]):
+            # flags in a list are cleaned row by row, rather than by distinct value
+            expected_flags = [0] * 1000
+            expected = fn(genders, ages, *fields, expected_flags)
+            flags = np.zeros(1000, dtype=np.uint32)
+            results = fn(genders, ages, *fields, flags)
+            self.assertListEqual(flags.tolist(), expected_flags)
+            for r, e in zip(results, expected):
+                self.assertListEqual(r.tolist(), e.tolist())
+
+    def test_temperature(self):
+        fn = ValidateTemperature1(35.0, 42.0, 0x1, 0x2)
+        for field in (temperatures, NumericField(*to_numeric(temperatures, np.float64))):
+            expected_flags = np.zeros(1000, dtype=np.uint32)
+            expected = fn(field, expected_flags)
+            flags = np.zeros(1000, dtype=np.uint32)
+            result = distinct_values.apply_by_distinct(fn, field, flags)
+            self.assertListEqual(result.tolist(), expected.tolist())
+            self.assertListEqual(flags.tolist(), expected_flags.tolist())
+
+    def test_mostly_distinct(self):
+        calls = list()
+
+        def fn(values, flags):
+            calls.append(len(values))
+            flags[:] = np.asarray(values) % 3
+            return np.asarray(values) * 2
+
+        flags = np.zeros(10, dtype=np.uint32)
+        result = distinct_values.apply_by_distinct(fn, np.arange(10), flags)
+        self.assertListEqual(calls, [10])
+        self.assertListEqual(result.tolist(), [v * 2 for v in range(10)])
+        values = np.arange(100) % 4
+        result = distinct_values.apply_by_distinct(fn, values, np.zeros(100))
+        self.assertListEqual(calls, [10, 4])
+        self.assertListEqual(result.tolist(), (values * 2).tolist())
@@ -0,0 +1,87 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import csv
+import os
+import random
+import tempfile
+import unittest
+
+import numpy as np
+
+import columnar_cache
+import data_schemas
+import dataset
+import external_sort
+
+descriptors = {'patient_id': data_schemas.HexIdFieldDesc('patient_id'),
+               'foo': data_schemas.FieldDesc('foo', {'': 0, 'False': 1, 'True': 2},
+                                             ['', 'False', 'True'], np.uint8)}
+
+
+class TestExternalSort(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.tempdir.name, 'assessments.csv')
+        self.cache_dir = os.path.join(self.tempdir.name, 'cache')
+        rng = random.Random(1)
+        patient_ids = [f'{rng.getrandbits(128):032x}' for _ in range(200)]
+        with open(self.source, 'w', newline='') as f:
+            csvw = csv.writer(f)
+            csvw.writerow(['id', 'patient_id', 'updated_at', 'foo', 'notes'])
+            for i in range(3500):
+                csvw.writerow([f'{i:032x}', rng.choice(patient_ids),
+                               f'2020-04-{rng.randint(1, 30):02d}', rng.choice(['', 'False', 'True']),
+                               rng.choice(['', 'a,b', '"q"\n', '\xe9', f'note {i}'])])
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def _load(self, **kwargs):
+        with open(self.source) as f:
+            return dataset.Dataset(f, descriptors, **kwargs)
+
+    def test_sort_matches_in_memory_sort(self):
+        expected = self._load(auto_dictionary=True)
+        expected.sort(('patient_id', 'updated_at'))
+
+        external_sort.sort_to_cache(self.source, self.cache_dir, ('patient_id', 'updated_at'),
+                                    descriptors, memory_budget=1, auto_dictionary=True)
+        # the runs are removed once they have been merged
+        self.assertListEqual(os.listdir(self.cache_dir), [os.path.basename(
+            columnar_cache.cache_path_for(self.cache_dir, self.source))])
+        sorted_ds = self._load(cache_dir=self.cache_dir, auto_dictionary=True)
+
+        self.assertEqual(sorted_ds.sorted_by_, ('patient_id', 'updated_at'))
+        self.assertListEqual(sorted_ds.index_.tolist(), expected.index_.tolist())
+        for name in expected.names_:
+            self.assertListEqual(list(sorted_ds.field_by_name(name)),
+                                 list(expected.field_by_name(name)))
+        sorted_fields = sorted_ds.fields_
+        sorted_ds.sort(('patient_id',))
+        self.assertIs(sorted_ds.fields_, sorted_fields)
+
+    def test_sort_keys_subset(self):
+        keys = ('patient_id', 'updated_at', 'notes')
+        external_sort.sort_to_cache(self.source, self.cache_dir, ('updated_at', 'notes'),
+                                    descriptors, keys, memory_budget=1)
+        manifest = columnar_cache.read_manifest(
+            columnar_cache.cache_path_for(self.cache_dir, self.source))
+        self.assertListEqual([c['kind'] for c in manifest['columns']],
+                             ['hexid', 'strings', 'strings'])
+
+        sorted_ds = self._load(keys=keys, cache_dir=self.cache_dir)
+        expected = self._load(keys=keys)
+        expected.sort(('updated_at', 'notes'))
+        for name in keys:
+            self.assertListEqual(list(sorted_ds.field_by_name(name)),
+                                 list(expected.field_by_name(name)))
@@ -9,9 +9,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import tempfile
 import unittest
 
+import numpy as np
+
+import columnar_cache
 import filtered_field
+import numpy_buffer
 
 class TestFilteredIndex(unittest.TestCase):
 
@@ -34,3 +39,43 @@ class TestFilteredIndex(unittest.TestCase):
         ff = filtered_field.FilteredField(field, filter)
         for i in range(len(ff)):
             print(i, ff[i])
+
+    def test_filters(self):
+        field = np.arange(10)[::-1].copy()
+        by_index = filtered_field.FilteredField(field, np.asarray([1, 3, 4, 7, 8, 9]))
+        by_mask = filtered_field.FilteredField(field, np.isin(np.arange(10), [1, 3, 4, 7, 8, 9]))
+        for ff in (by_index, by_mask):
+            self.assertEqual(len(ff), 6)
+            self.assertEqual(ff[1], 6)
+            self.assertListEqual(ff[1:4].tolist(), [6, 5, 2])
+            self.assertListEqual(ff.take([5, 0]).tolist(), [0, 8])
+            self.assertListEqual(ff.materialise().tolist(), [8, 6, 5, 2, 1, 0])
+            self.assertListEqual(list(ff), [8, 6, 5, 2, 1, 0])
+        self.assertEqual(len(filtered_field.FilteredField(field, [])), 0)
+
+    def test_composed_filters(self):
+        field = numpy_buffer.StringBuffer()
+        field.extend(str(x) for x in range(10))
+        field = field.finalise()
+        ff = filtered_field.FilteredField(
+            filtered_field.FilteredField(field, [1, 3, 4, 7, 8, 9]), [0, 2, 5])
+        self.assertIs(ff.field, field)
+        self.assertListEqual(ff.filter.tolist(), [1, 4, 9])
+        materialised = ff.materialise()
+        self.assertIsInstance(materialised, numpy_buffer.StringArena)
+        self.assertListEqual(list(materialised), ['1', '4', '9'])
+        self.assertListEqual(filtered_field.FilteredField(['a', 'b', 'c'], [2, 0])[0:2], ['c', 'a'])
+
+    def test_cached_string_field(self):
+        strings = ['a', '', 'b,c', '\xe9'] * 5
+        with tempfile.TemporaryDirectory() as cache_path:
+            columnar_cache.write(cache_path, None, ['notes'], ['notes'], [strings], {})
+            field = columnar_cache.read_columns(
+                cache_path, columnar_cache.read_manifest(cache_path), ['notes'])[0]
+            self.assertIsInstance(field, columnar_cache.MappedStringField)
+            ff = filtered_field.FilteredField(field, np.arange(20) % 3 == 0)
+            for compacted in (ff.materialise(), ff.take([1, 0]), ff[2:5]):
+                self.assertIsInstance(compacted, numpy_buffer.StringArena)
+                self.assertNotIsInstance(compacted, columnar_cache.MappedStringField)
+            self.assertListEqual(list(ff.materialise()), strings[::3])
+            self.assertListEqual(list(ff.take([1, 0])), [strings[3], strings[0]])
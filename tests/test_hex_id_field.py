@@ -0,0 +1,114 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import unittest
+
+import numpy as np
+
+import data_schemas
+import dataset
+import hex_id_field
+import numpy_buffer
+import utils
+
+ids = ['ffffffffffffffff0000000000000001',
+       '0000000000000000ffffffffffffffff',
+       '00000000000000010000000000000000',
+       '0000000000000000ffffffffffffffff',
+       'a0b1c2d3e4f5a6b7c8d9e0f1a2b3c4d5']
+
+ids_dataset = ('id,patient_id\n'
+               '0aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa,11111111111111111111111111111111\n'
+               '07777777777777777777777777777777,33333333333333333333333333333333\n'
+               '02222222222222222222222222222222,11111111111111111111111111111111\n')
+
+
+def _build(values, size=None):
+    buffer = hex_id_field.HexIdBuffer(size)
+    for v in values:
+        buffer.append(v)
+    return buffer.finalise()
+
+
+class TestHexIdField(unittest.TestCase):
+
+    def test_hex_id_buffer(self):
+        field = _build(ids)
+        self.assertIsInstance(field, hex_id_field.HexIdField)
+        self.assertEqual(field.ids.dtype.itemsize, 16)
+        self.assertListEqual(list(field), ids)
+        self.assertEqual(field[4], ids[4])
+        self.assertListEqual(list(field[1:3]), ids[1:3])
+        self.assertListEqual(list(field.take([4, 0])), [ids[4], ids[0]])
+        self.assertListEqual(field.equals(ids[1]).tolist(), [False, True, False, True, False])
+        self.assertListEqual(field.equals('x').tolist(), [False] * 5)
+        # packed ids order in the same way as the strings
+        self.assertListEqual(np.argsort(field.ids, kind='stable').tolist(),
+                             sorted(range(len(ids)), key=lambda i: ids[i]))
+
+    def test_hex_id_buffer_falls_back_to_list(self):
+        values = ids[:2] + ['not an id'] + ids[2:]
+        self.assertListEqual(_build(values), values)
+        self.assertListEqual(_build(values, size=len(values)), values)
+        # upper case ids wouldn't round trip, so they aren't packed
+        self.assertListEqual(_build([ids[4].upper()]), [ids[4].upper()])
+
+    def test_extend(self):
+        arena = numpy_buffer.concatenate_strings([ids])
+        self.assertTrue(np.array_equal(hex_id_field.arena_to_ids(arena), _build(ids).ids))
+        for values in (ids[:2] + ['not an id'], [ids[4].upper()], [ids[0][:31] + 'g']):
+            self.assertIsNone(hex_id_field.arena_to_ids(numpy_buffer.concatenate_strings([values])))
+        # ids are packed together, and a batch with something else in it falls back to a list
+        buffer = hex_id_field.HexIdBuffer()
+        buffer.extend(arena)
+        buffer.append(ids[0])
+        self.assertListEqual(list(buffer.finalise()), ids + ids[:1])
+        buffer = hex_id_field.HexIdBuffer()
+        buffer.extend(arena)
+        buffer.extend(numpy_buffer.concatenate_strings([['not an id'] + ids]))
+        self.assertListEqual(buffer.finalise(), ids + ['not an id'] + ids)
+
+    def test_isin(self):
+        field = _build(ids)
+        expected = [False, True, False, True, True]
+        self.assertListEqual(hex_id_field.isin(field, [ids[1], ids[4], 'x']).tolist(), expected)
+        self.assertListEqual(hex_id_field.isin(field, _build([ids[4], ids[1]])).tolist(), expected)
+        self.assertListEqual(hex_id_field.isin(ids, _build([ids[4], ids[1]])).tolist(), expected)
+
+    def test_lookup(self):
+        keys = _build(ids)
+        values = [ids[3], 'ffffffffffffffffffffffffffffffff', ids[0], ids[4]]
+        expected = [3, -1, 0, 4]
+        self.assertListEqual(hex_id_field.lookup(keys, _build(values)).tolist(), expected)
+        self.assertListEqual(hex_id_field.lookup(ids, values).tolist(), expected)
+
+    def test_runs(self):
+        field = _build(sorted(ids))
+        self.assertListEqual(list(field.runs()), [(0, 1), (2, 2), (3, 3), (4, 4)])
+
+    def test_dataset_load(self):
+        descriptors = {'id': data_schemas.HexIdFieldDesc('id'),
+                       'patient_id': data_schemas.HexIdFieldDesc('patient_id')}
+        ds = dataset.Dataset(io.StringIO(ids_dataset), descriptors)
+        self.assertIsInstance(ds.field_by_name('id'), hex_id_field.HexIdField)
+        ds.sort(('patient_id', 'id'))
+        self.assertListEqual(list(ds.field_by_name('id')),
+                             ['02222222222222222222222222222222',
+                              '0aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa',
+                              '07777777777777777777777777777777'])
+
+        runs = list()
+        utils.iterate_over_patient_assessments2(
+            ds.field_by_name('patient_id'), None,
+            lambda cur_id, filter_status, start, end: runs.append((cur_id, start, end)))
+        self.assertListEqual(runs, [('11111111111111111111111111111111', 0, 1),
+                                    ('33333333333333333333333333333333', 2, 2)])
@@ -0,0 +1,130 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import unittest
+
+import columnar_cache
+import data_schemas
+import dataset
+import incremental_cache
+
+header = 'id,patient_id,updated_at,country_code,temperature\n'
+
+descriptors = {
+    'id': data_schemas.HexIdFieldDesc('id'),
+    'patient_id': data_schemas.HexIdFieldDesc('patient_id'),
+    'updated_at': data_schemas.TimestampFieldDesc('updated_at'),
+    'temperature': data_schemas.NumericFieldDesc('temperature'),
+}
+
+
+def _row(i, day=1, temperature=None):
+    return (f'{i:032x},{i % 7:032x},2020-04-{day:02d} 08:00:{i % 60:02d}.{i:06d}+00:00,'
+            f'{["GB", "US", "SE"][i % 3]},"{36 + i % 5 if temperature is None else temperature}"\n')
+
+
+class TestIncrementalCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tempdir.name, 'cache')
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def _write(self, name, rows):
+        path = os.path.join(self.tempdir.name, name)
+        with open(path, 'w') as f:
+            f.write(header + ''.join(rows))
+        return path
+
+    def _update(self, path, previous):
+        return incremental_cache.update_cache(
+            path, self.cache_dir, columnar_cache.cache_path_for(self.cache_dir, previous),
+            descriptors, auto_dictionary=True)
+
+    def assertCacheMatchesSource(self, path):
+        with open(path) as f:
+            expected = dataset.Dataset(f, descriptors, auto_dictionary=True)
+        manifest = columnar_cache.read_manifest(
+            columnar_cache.cache_path_for(self.cache_dir, os.path.abspath(path)))
+        self.assertEqual(manifest['source'], columnar_cache.fingerprint(path))
+        self.assertEqual(manifest['content'], columnar_cache.content_digest(path))
+        with open(path) as f:
+            cached = dataset.Dataset(f, descriptors, cache_dir=self.cache_dir,
+                                     auto_dictionary=True)
+        self.assertListEqual(cached.names_, expected.names_)
+        for c, e in zip(cached.fields_, expected.fields_):
+            self.assertListEqual(list(c), list(e))
+
+    def _cache(self, path):
+        with open(path) as f:
+            dataset.Dataset(f, descriptors, cache_dir=self.cache_dir, auto_dictionary=True)
+
+    def test_appended_rows(self):
+        previous = self._write('day1.csv', [_row(i) for i in range(100)])
+        self._cache(previous)
+        path = self._write('day2.csv', [_row(i) for i in range(130)])
+        self.assertEqual(self._update(path, previous), 30)
+        self.assertCacheMatchesSource(path)
+        # the cache is now valid, so nothing is parsed
+        self.assertEqual(self._update(path, previous), 0)
+
+    def test_appended_to_incremental_cache(self):
+        previous = self._write('day1.csv', [_row(i) for i in range(100)])
+        self._cache(previous)
+        day2 = self._write('day2.csv', [_row(i) for i in range(120)])
+        self.assertEqual(self._update(day2, previous), 20)
+        # the cache of day 2 was written incrementally, so it records the content of day 2
+        manifest = columnar_cache.read_manifest(columnar_cache.cache_path_for(self.cache_dir, day2))
+        path = self._write('day3.csv', [_row(i) for i in range(150)])
+        self.assertTrue(incremental_cache._is_prefix(path, manifest['content']))
+        self.assertEqual(self._update(path, day2), 30)
+        self.assertCacheMatchesSource(path)
+
+    def test_changed_rows(self):
+        previous = self._write('day1.csv', [_row(i) for i in range(100)])
+        self._cache(previous)
+        # rows are updated, deleted, inserted and reordered
+        rows = [_row(i, day=2, temperature='') if i % 10 == 0 else _row(i)
+                for i in range(100) if i % 17 != 0]
+        rows = rows[50:] + [_row(i) for i in range(100, 120)] + rows[:50]
+        path = self._write('day2.csv', rows)
+        self.assertEqual(self._update(path, previous), 20 + len([i for i in range(100)
+                                                                 if i % 10 == 0 and i % 17 != 0]))
+        self.assertCacheMatchesSource(path)
+
+    def test_overwritten_export(self):
+        path = self._write('assessments.csv', [_row(i) for i in range(100)])
+        self._cache(path)
+        os.remove(path)
+        self._write('assessments.csv', [_row(i) for i in range(120)])
+        self.assertEqual(self._update(path, path), 20)
+        self.assertCacheMatchesSource(path)
+        self.assertFalse(os.path.exists(
+            columnar_cache.cache_path_for(self.cache_dir, path) + '.incremental'))
+
+    def test_unusable_previous_cache(self):
+        path = self._write('day2.csv', [_row(i) for i in range(50)])
+        # no earlier cache
+        self.assertEqual(self._update(path, os.path.join(self.tempdir.name, 'day1.csv')), 50)
+        self.assertCacheMatchesSource(path)
+
+        # an earlier cache built with other descriptors
+        previous = self._write('day3.csv', [_row(i) for i in range(40)])
+        with open(previous) as f:
+            dataset.Dataset(f, {'temperature': data_schemas.NumericFieldDesc('temperature')},
+                            cache_dir=self.cache_dir)
+        path = self._write('day4.csv', [_row(i) for i in range(60)])
+        self.assertEqual(self._update(path, previous), 60)
+        self.assertCacheMatchesSource(path)
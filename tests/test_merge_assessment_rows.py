@@ -13,7 +13,7 @@ import unittest
 
 
 from processing.assessment_merge import MergeAssessmentRows
-from utils import concatenate_maybe_strs
+from utils import concatenate_maybe_strs, iterate_over_patient_assessments
 
 
 class MockDataset:
@@ -115,3 +115,22 @@ class TestMergeAssessmentRows(unittest.TestCase):
                               '2020-04-01 14:00:00', '2020-04-01 15:00:00'])
         self.assertListEqual(resulting_fields['treatment'],
                              ['', '"a,b"', '"c,d"', '"a,b","c,d"'])
+
+    def test_merge_fields_in_any_order(self):
+        # the patient id and update time are found by name rather than position
+        resulting_fields = {'updated_at': [None] * 3, 'treatment': [None] * 3,
+                            'patient_id': [None] * 3}
+        existing_field_indices = [('updated_at', 0), ('treatment', 1), ('patient_id', 2)]
+        source_fields = [['2020-04-01 08:00:00', '2020-04-01 12:00:00', '2020-04-02 09:00:00',
+                          '2020-04-01 13:00:00'],
+                         ['a', 'b', '', 'c'],
+                         ['za', 'za', 'za', 'zb']]
+        mar = MergeAssessmentRows([1], resulting_fields, dict(), existing_field_indices,
+                                  {'treatment': concatenate_maybe_strs})
+        iterate_over_patient_assessments(source_fields, [0] * 4, mar, 2)
+        self.assertEqual(mar.rfindex, 3)
+        self.assertListEqual(resulting_fields['patient_id'], ['za', 'za', 'zb'])
+        self.assertListEqual(resulting_fields['updated_at'],
+                             ['2020-04-01 12:00:00', '2020-04-02 09:00:00',
+                              '2020-04-01 13:00:00'])
+        self.assertListEqual(resulting_fields['treatment'], ['a,b', '', 'c'])
@@ -0,0 +1,131 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+import data_schemas
+import dataset
+import dictionary_field
+import external_sort
+import numeric_field
+from processing.temperature import ValidateTemperature1
+from processing.weight_height_bmi import ValidateHeight1, ValidateHeight2
+
+temperatures = ['', '36.6', '98.6', '0', '0.0', '45', '20.5', '', '37']
+
+numeric_dataset = 'id,temperature\n' +\
+                  ''.join(f'{i},{temperatures[i * 7 % len(temperatures)]}\n' for i in range(100))
+
+descriptors = {'temperature': data_schemas.NumericFieldDesc('temperature')}
+
+
+class TestNumericField(unittest.TestCase):
+
+    def test_to_numeric(self):
+        values, missing = numeric_field.to_numeric(temperatures, np.float64)
+        self.assertListEqual(missing.tolist(), [True] + [False] * 6 + [True, False])
+        self.assertListEqual(values[~missing].tolist(), [36.6, 98.6, 0, 0, 45, 20.5, 37])
+        self.assertTrue(np.isnan(values[missing]).all())
+        with self.assertRaises(ValueError):
+            numeric_field.to_numeric(['36.6', 'abc', '37'], np.float64)
+
+    def test_from_strings(self):
+        strings = temperatures * 3
+        for field in (strings, dictionary_field.DictionaryField(
+                np.asarray([sorted(set(strings)).index(s) for s in strings], dtype=np.uint8),
+                sorted(set(strings)))):
+            numeric = numeric_field.from_strings(field)
+            self.assertIsInstance(numeric, numeric_field.NumericField)
+            self.assertListEqual(list(numeric), ['' if s == '' else float(s) for s in strings])
+
+    def test_numeric_buffer(self):
+        for size in (None, 3, 1000):
+            buffer = numeric_field.NumericBuffer(np.float32, size)
+            for t in temperatures:
+                buffer.append(t)
+            field = buffer.finalise()
+            self.assertEqual(field.dtype, np.float32)
+            self.assertEqual(len(field), len(temperatures))
+            self.assertEqual(field[0], '')
+            self.assertAlmostEqual(field[1], 36.6, places=5)
+            self.assertListEqual(list(field.take([3, 0])), [0.0, ''])
+
+        buffer = numeric_field.NumericBuffer(np.float32)
+        buffer.append('1.5')
+        buffer.extend_values(*numeric_field.to_numeric(['', '2'], np.float64))
+        buffer.append('')
+        self.assertListEqual(list(buffer.finalise()), [1.5, '', 2.0, ''])
+
+    def test_dataset_load(self):
+        ds = dataset.Dataset(io.StringIO(numeric_dataset), descriptors)
+        temps = ds.field_by_name('temperature')
+        self.assertIsInstance(temps, numeric_field.NumericField)
+        self.assertEqual(temps.dtype, np.float64)
+        ds.sort(('temperature', 'id'))
+        temps = ds.field_by_name('temperature')
+        present = [t for t in temps if t != '']
+        # missing values sort first, then values in numeric order
+        self.assertListEqual(list(temps)[:len(temps) - len(present)],
+                             [''] * (len(temps) - len(present)))
+        self.assertListEqual(present, sorted(present))
+
+    def test_external_sort(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            source = os.path.join(tempdir, 'temperatures.csv')
+            with open(source, 'w') as f:
+                f.write(numeric_dataset)
+            external_sort.sort_to_cache(source, os.path.join(tempdir, 'cache'),
+                                        ('temperature', 'id'), descriptors, memory_budget=1)
+            with open(source) as f:
+                ds = dataset.Dataset(f, descriptors, cache_dir=os.path.join(tempdir, 'cache'))
+            expected = dataset.Dataset(io.StringIO(numeric_dataset), descriptors)
+            expected.sort(('temperature', 'id'))
+            self.assertListEqual(ds.index_.tolist(), expected.index_.tolist())
+            self.assertIsInstance(ds.field_by_name('temperature'), numeric_field.NumericField)
+            self.assertListEqual(list(ds.field_by_name('temperature')),
+                                 list(expected.field_by_name('temperature')))
+
+
+class TestNumericFunctors(unittest.TestCase):
+
+    def test_validate_temperature(self):
+        temps = temperatures
+        fn = ValidateTemperature1(35.0, 42.0, 0x1, 0x2)
+        expected_flags = np.zeros(len(temps), dtype=np.uint32)
+        expected = fn(temps, expected_flags)
+        flags = np.zeros_like(expected_flags)
+        result = fn(numeric_field.NumericField(*numeric_field.to_numeric(temps, np.float64)),
+                    flags)
+        self.assertListEqual(result.tolist(), expected.tolist())
+        self.assertListEqual(flags.tolist(), expected_flags.tolist())
+
+    def test_validate_height(self):
+        weights = ['', '70', '12', '200', '350', '500', '1000', '5', '80']
+        heights = ['170', '', '1.8', '6', '5000', '0', '175', '160', '300']
+        bmis = ['24', '', '10', '25', '90', '30', '', '15', '22']
+        numeric = [numeric_field.NumericField(*numeric_field.to_numeric(f, np.float64))
+                   for f in (weights, heights, bmis)]
+        for cls in (ValidateHeight1, ValidateHeight2):
+            fn = cls(40.0, 200.0, 110.0, 220.0, 15.0, 55.0,
+                     0x1, 0x2, 0x4, 0x8, 0x10, 0x20, 0x40, 0x80)
+            expected_flags = np.zeros(len(weights), dtype=np.uint32)
+            expected = fn(None, None, weights, heights, bmis, expected_flags)
+            expected = [e.copy() for e in expected]
+            flags = np.zeros_like(expected_flags)
+            result = fn(None, None, *numeric, flags)
+            for r, e in zip(result, expected):
+                self.assertListEqual(r.tolist(), e.tolist())
+            self.assertListEqual(flags.tolist(), expected_flags.tolist())
@@ -9,6 +9,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import csv
+import io
 import unittest
 
 import numpy as np
@@ -44,3 +46,103 @@ class TestNumpyBuffer(unittest.TestCase):
 
         expected = np.asarray([x for x in range(100)], dtype=np.uint32)
         self.assertTrue(np.array_equal(final, expected))
+
+    def test_fixed_size_buffer(self):
+        for size in (0, 50, 100, 150):
+            nb = numpy_buffer.FixedSizeBuffer(np.uint32, size)
+            for i in range(100):
+                nb.append(i)
+            final = nb.finalise()
+
+            expected = np.asarray([x for x in range(100)], dtype=np.uint32)
+            self.assertTrue(np.array_equal(final, expected))
+
+    def test_fixed_size_list_buffer(self):
+        for size in (0, 50, 100, 150):
+            nb = numpy_buffer.FixedSizeListBuffer(size)
+            for i in range(100):
+                nb.append(str(i))
+            final = nb.finalise()
+
+            self.assertListEqual(final, [str(x) for x in range(100)])
+
+    def test_column_builder(self):
+        for capacity in (None, 0, 10, 100, 1000):
+            cb = numpy_buffer.ColumnBuilder(np.int64, capacity)
+            for i in range(5000):
+                cb.append(i)
+            cb.extend(np.arange(5000, 6000))
+            cb.extend(range(6000, 6010))
+            cb.extend([6010, 6011])
+            cb.append(6012)
+            self.assertEqual(len(cb), 6013)
+            final = cb.finalise()
+            self.assertEqual(final.dtype, np.int64)
+            self.assertTrue(np.array_equal(final, np.arange(6013)))
+
+        cb = numpy_buffer.ColumnBuilder(np.uint8, 16)
+        cb.reserve(8)
+        cb.extend(np.ones(16, dtype=np.uint8))
+        self.assertEqual(len(cb.finalise()), 16)
+        self.assertEqual(len(numpy_buffer.ColumnBuilder(np.float64).finalise()), 0)
+
+        # views of the array taken while it is being built stay valid as it grows and is trimmed
+        cb = numpy_buffer.ColumnBuilder(np.int64)
+        cb.extend(np.arange(10))
+        view = cb.array_[:10]
+        cb.extend(np.arange(10, 1000))
+        self.assertListEqual(view.tolist(), list(range(10)))
+        view = cb.array_[:1000]
+        final = cb.finalise()
+        self.assertTrue(np.array_equal(final, np.arange(1000)))
+        self.assertTrue(np.array_equal(view, np.arange(1000)))
+
+    def test_string_arena(self):
+        strings = ['', 'a', 'fluids, paracetamol', '\xe9t\xe9', 'two\nlines', ''] * 20
+        sb = numpy_buffer.StringBuffer(10)
+        for s in strings[:50]:
+            sb.append(s)
+        sb.extend(strings[50:])
+        self.assertEqual(len(sb), len(strings))
+        arena = sb.finalise()
+        self.assertEqual(len(arena), len(strings))
+        self.assertListEqual(list(arena), strings)
+        self.assertEqual(arena[3], '\xe9t\xe9')
+        self.assertEqual(arena[-2], 'two\nlines')
+        self.assertListEqual(list(arena[2:9]), strings[2:9])
+        self.assertListEqual(list(arena[1::7]), strings[1::7])
+        self.assertListEqual(list(arena[5:5]), [])
+
+        indices = np.argsort(np.asarray(strings), kind='stable')
+        taken = arena.take(indices)
+        self.assertListEqual(list(taken), [strings[i] for i in indices])
+        self.assertListEqual(list(arena[10:20].copy()), strings[10:20])
+
+        concatenated = numpy_buffer.concatenate_strings([arena[:30], taken, arena[100:]])
+        self.assertListEqual(list(concatenated),
+                             strings[:30] + [strings[i] for i in indices] + strings[100:])
+        concatenated = numpy_buffer.concatenate_strings([arena[:30], ['x', 'y']])
+        self.assertListEqual(list(concatenated), strings[:30] + ['x', 'y'])
+        self.assertEqual(len(numpy_buffer.StringBuffer().finalise()), 0)
+
+    def test_string_buffer_extend(self):
+        buffer = numpy_buffer.StringBuffer()
+        buffer.append('a')
+        buffer.extend(numpy_buffer.concatenate_strings([['bc', '', '\xe9']])[1:])
+        buffer.extend(['d'])
+        self.assertListEqual(list(buffer.finalise()), ['a', '', '\xe9', 'd'])
+
+    def test_string_arena_csv_quoted(self):
+        strings = ['', 'a', 'fluids, paracetamol', '\xe9t\xe9', 'two\nlines', 'say "hi"', '"',
+                   'cr\r', 'plain'] * 3
+        sb = numpy_buffer.StringBuffer()
+        sb.extend(strings)
+        arena = sb.finalise()
+        expected = list()
+        for s in strings:
+            output = io.StringIO()
+            csv.writer(output).writerow([s, 'x'])
+            expected.append(output.getvalue()[:-len(',x\r\n')])
+        self.assertListEqual(list(arena.csv_quoted()), expected)
+        self.assertListEqual(list(arena[2:6].csv_quoted()), expected[2:6])
+        self.assertEqual(len(numpy_buffer.StringBuffer().finalise().csv_quoted()), 0)
@@ -0,0 +1,87 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+import columnar_cache
+import data_schemas
+import dataset
+import predicates
+
+patients_dataset = 'id,country_code,foo\n' +\
+                   ('0aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa,GB,True\n'
+                    '07777777777777777777777777777777,US,\n'
+                    '02222222222222222222222222222222,GB,False\n'
+                    '03333333333333333333333333333333,SE,True\n') * 10
+
+descriptors = {'id': data_schemas.HexIdFieldDesc('id'),
+               'foo': data_schemas.FieldDesc('foo', {'': 0, 'False': 1, 'True': 2},
+                                             ['', 'False', 'True'], np.uint8)}
+
+gb_ids = ['0aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa', '02222222222222222222222222222222'] * 10
+
+
+class TestPredicates(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.tempdir.name, 'patients.csv')
+        self.cache_dir = os.path.join(self.tempdir.name, 'cache')
+        with open(self.source, 'w') as f:
+            f.write(patients_dataset)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def _load(self, **kwargs):
+        with open(self.source) as f:
+            return dataset.Dataset(f, descriptors, keys=('id', 'foo'), **kwargs)
+
+    def test_equals(self):
+        for kwargs in ({}, {'workers': 2}, {'preallocate': True}):
+            ds = self._load(predicates=[predicates.Equals('country_code', 'GB')], **kwargs)
+            self.assertEqual(ds.row_count(), 20)
+            self.assertListEqual(list(ds.field_by_name('id')), gb_ids)
+            self.assertListEqual(ds.field_by_name('foo').tolist(), [2, 1] * 10)
+            # index_ holds the source row of each loaded row
+            self.assertListEqual(ds.index_.tolist(), [r for r in range(40) if r % 4 in (0, 2)])
+
+    def test_isin(self):
+        ds = dataset.Dataset(io.StringIO(patients_dataset),
+                             predicates=[predicates.IsIn('id', gb_ids[:2]),
+                                         predicates.IsIn('foo', ['True', ''])])
+        self.assertListEqual(ds.field_by_name('id'), gb_ids[:1] * 10)
+
+    def test_predicates_on_cached_fields(self):
+        cache_path = columnar_cache.cache_path_for(self.cache_dir, os.path.abspath(self.source))
+        with open(self.source) as f:
+            dataset.Dataset(f, descriptors, cache_dir=self.cache_dir)
+        manifest_mtime = os.path.getmtime(os.path.join(cache_path, columnar_cache.MANIFEST_NAME))
+
+        ds = self._load(cache_dir=self.cache_dir,
+                        predicates=[predicates.Equals('country_code', 'GB')])
+        self.assertListEqual(list(ds.field_by_name('id')), gb_ids)
+        self.assertListEqual(ds.field_by_name('foo').tolist(), [2, 1] * 10)
+        ds = self._load(cache_dir=self.cache_dir, predicates=[predicates.IsIn('id', gb_ids)])
+        self.assertListEqual(list(ds.field_by_name('id')), gb_ids)
+        self.assertListEqual(ds.index_.tolist(), [r for r in range(40) if r % 4 in (0, 2)])
+
+        # predicates on transformed fields are applied by parsing the source
+        ds = self._load(cache_dir=self.cache_dir, predicates=[predicates.Equals('foo', 'True')])
+        self.assertEqual(ds.row_count(), 20)
+        self.assertEqual(
+            os.path.getmtime(os.path.join(cache_path, columnar_cache.MANIFEST_NAME)),
+            manifest_mtime)
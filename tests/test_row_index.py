@@ -0,0 +1,66 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import csv
+import io
+import os
+import tempfile
+import unittest
+
+import row_index
+
+assessments = 'id,patient_id,notes\n' +\
+              ''.join(f'{i},p{i % 3},"{i}\n""{i}"",{i}"\n' for i in range(10)) +\
+              '10,p1,last'
+
+
+class TestRowIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.tempdir.name, 'assessments.csv')
+        with open(self.source, 'w') as f:
+            f.write(assessments)
+        self.rows = list(csv.reader(io.StringIO(assessments)))[1:]
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_read_rows(self):
+        index = row_index.build(self.source)
+        self.assertEqual(index.row_count(), 11)
+        rows = [10, 3, 0, 3, 9]
+        self.assertListEqual(list(index.read_rows(rows)), [self.rows[r] for r in rows])
+
+    def test_rows_for(self):
+        row_index.build(self.source, ('patient_id',))
+        index = row_index.read(self.source, ('patient_id',))
+        self.assertIsNotNone(index)
+        self.assertListEqual(index.rows_for('patient_id', 'p1').tolist(), [1, 4, 7, 10])
+        self.assertListEqual(index.rows_for('patient_id', 'p2').tolist(), [2, 5, 8])
+        self.assertListEqual(index.rows_for('patient_id', 'p3').tolist(), [])
+        self.assertIsNone(row_index.read(self.source, ('id',)))
+
+    def test_for_source(self):
+        self.assertIsNone(row_index.read(self.source))
+        index = row_index.for_source(self.source, ('patient_id',))
+        # adding a key keeps the keys that the index already has
+        index = row_index.for_source(self.source, ('id',))
+        self.assertListEqual(sorted(index.keys()), ['id', 'patient_id'])
+        self.assertListEqual(index.rows_for('id', '7').tolist(), [7])
+
+        # the index is rebuilt when the file changes
+        with open(self.source, 'a') as f:
+            f.write('\n11,p0,\n')
+        self.assertIsNone(row_index.read(self.source))
+        index = row_index.for_source(self.source, ('patient_id',))
+        self.assertEqual(index.row_count(), 12)
+        self.assertListEqual(index.rows_for('patient_id', 'p0').tolist(), [0, 3, 6, 9, 11])
@@ -0,0 +1,167 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+import data_schemas
+import dataset
+import external_sort
+import numpy_buffer
+import timestamp_field
+from processing.assessment_merge import CalculateMergedFieldCount, MergeAssessmentRows
+
+timestamps = ['2020-04-01 08:00:00.123456+00:00', '2020-04-01 08:00:00+00:00',
+              '2020-04-01 08:00:00.5+00:00', '2020-03-31 23:59:59.999999+00:00',
+              '2020-04-02 00:00:00', '2020-04-01 08:00:00.12+00:00']
+
+timestamp_dataset = 'id,updated_at\n' +\
+                    ''.join(f'{i},{timestamps[i * 7 % len(timestamps)]}\n' for i in range(100))
+
+descriptors = {'updated_at': data_schemas.TimestampFieldDesc('updated_at')}
+
+
+class TestTimestampField(unittest.TestCase):
+
+    def test_timestamp_buffer(self):
+        for size in (None, 3, 1000):
+            buffer = timestamp_field.TimestampBuffer(size)
+            for t in timestamps:
+                buffer.append(t)
+            field = buffer.finalise()
+            self.assertIsInstance(field, timestamp_field.TimestampField)
+            self.assertEqual(len(field), len(timestamps))
+            self.assertEqual(field[0], '2020-04-01 08:00:00.123456')
+            self.assertListEqual(list(field.take([4, 1])),
+                                 ['2020-04-02 00:00:00.000000', '2020-04-01 08:00:00.000000'])
+            self.assertListEqual(field.days.tolist(),
+                                 [18353, 18353, 18353, 18352, 18354, 18353])
+
+    def test_fallback_to_strings(self):
+        buffer = timestamp_field.TimestampBuffer()
+        values = timestamps + ['2020-04-01T08:00:00.25', 'not a timestamp'] + timestamps
+        for t in values:
+            buffer.append(t)
+        # the values converted before the fallback are the strings that were appended
+        self.assertListEqual(buffer.finalise(), values)
+
+        # parallel ranges that didn't fall back also give back their strings
+        s = io.StringIO(timestamp_dataset.replace(timestamps[4], 'soon'))
+        ds = dataset.Dataset(s, descriptors)
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'timestamps.csv')
+            with open(path, 'w') as f:
+                f.write(timestamp_dataset.replace('\n94,' + timestamps[4], '\n94,soon'))
+            with open(path) as f:
+                parallel = dataset.Dataset(f, descriptors, workers=4)
+        expected = [timestamps[i * 7 % len(timestamps)] for i in range(100)]
+        self.assertListEqual(ds.field_by_name('updated_at'),
+                             [e if e != timestamps[4] else 'soon' for e in expected])
+        self.assertListEqual(parallel.field_by_name('updated_at'),
+                             expected[:94] + ['soon'] + expected[95:])
+
+    def test_parse_arena(self):
+        values = timestamps + ['2020-04-01T08:00:00.25', '2020-04-01 08:00:00.123456']
+        buffer = timestamp_field.TimestampBuffer()
+        for t in values:
+            buffer.append(t)
+        expected = buffer.finalise()
+        parsed, formats = timestamp_field.parse_arena(numpy_buffer.concatenate_strings([values]))
+        self.assertTrue(np.array_equal(parsed, expected.timestamps))
+        self.assertListEqual(formats.tolist(), expected.formats.tolist())
+        for value in ('soon', '', '2020-04-01 08:00:00.', '2020-04-01 08:00:00.1234567',
+                      '2020-04-01 08:00:00+01:00', '2020-04-01_08:00:00', '2020-04-0a 08:00:00'):
+            self.assertIsNone(timestamp_field.parse_arena(
+                numpy_buffer.concatenate_strings([timestamps + [value]])))
+
+        # a batch with something else in it falls back to strings
+        buffer = timestamp_field.TimestampBuffer()
+        buffer.extend(numpy_buffer.concatenate_strings([timestamps]))
+        buffer.append(timestamps[0])
+        self.assertListEqual(buffer.finalise().source_strings(), timestamps + timestamps[:1])
+        buffer = timestamp_field.TimestampBuffer()
+        buffer.extend(numpy_buffer.concatenate_strings([timestamps]))
+        buffer.extend(numpy_buffer.concatenate_strings([['soon'] + timestamps]))
+        self.assertListEqual(buffer.finalise(), timestamps + ['soon'] + timestamps)
+
+    def test_sorts_as_strings(self):
+        ds = dataset.Dataset(io.StringIO(timestamp_dataset), descriptors)
+        self.assertIsInstance(ds.field_by_name('updated_at'), timestamp_field.TimestampField)
+        ds.sort(('updated_at', 'id'))
+        expected = dataset.Dataset(io.StringIO(timestamp_dataset))
+        expected.sort(('updated_at', 'id'))
+        self.assertListEqual(ds.index_.tolist(), expected.index_.tolist())
+
+    def test_to_strings(self):
+        field = timestamp_field.TimestampField(
+            np.array(['2020-04-01 08:00:00.987654'], dtype=timestamp_field.TIMESTAMP_DTYPE))
+        self.assertListEqual(timestamp_field.to_strings(field.timestamps, unit='s').tolist(),
+                             ['2020-04-01 08:00:00'])
+        self.assertListEqual(timestamp_field.to_strings(field.timestamps, unit='D').tolist(),
+                             ['2020-04-01'])
+
+    def test_external_sort(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            source = os.path.join(tempdir, 'timestamps.csv')
+            with open(source, 'w') as f:
+                f.write(timestamp_dataset)
+            external_sort.sort_to_cache(source, os.path.join(tempdir, 'cache'),
+                                        ('updated_at', 'id'), descriptors, memory_budget=1)
+            with open(source) as f:
+                ds = dataset.Dataset(f, descriptors, cache_dir=os.path.join(tempdir, 'cache'))
+            expected = dataset.Dataset(io.StringIO(timestamp_dataset), descriptors)
+            expected.sort(('updated_at', 'id'))
+            self.assertListEqual(ds.index_.tolist(), expected.index_.tolist())
+            updated_ats = ds.field_by_name('updated_at')
+            self.assertIsInstance(updated_ats, timestamp_field.TimestampField)
+            self.assertListEqual(list(updated_ats), list(expected.field_by_name('updated_at')))
+            self.assertListEqual(updated_ats.days.tolist(),
+                                 expected.field_by_name('updated_at').days.tolist())
+
+
+class TestTimestampMerge(unittest.TestCase):
+
+    def test_merged_field_count(self):
+        updated_ats = ['2020-04-01 08:00:00', '2020-04-01 12:00:00', '2020-04-02 09:00:00',
+                       '2020-04-03 13:00:00', '2020-04-03 14:00:00', '2020-04-03 15:00:00']
+        field = timestamp_field.TimestampField(
+            np.array(updated_ats, dtype=timestamp_field.TIMESTAMP_DTYPE))
+        for start, end in ((0, 2), (3, 5), (1, 4)):
+            expected = CalculateMergedFieldCount(updated_ats)
+            expected(None, None, start, end)
+            fn = CalculateMergedFieldCount(field)
+            fn(None, None, start, end)
+            self.assertEqual(fn.merged_row_count, expected.merged_row_count)
+
+    def test_merge_assessment_rows(self):
+        ids = ['aa', 'ab', 'ac', 'ad']
+        patient_ids = ['za', 'za', 'za', 'zb']
+        updated_ats = timestamp_field.TimestampField(
+            np.array(['2020-04-01 08:00:00', '2020-04-01 12:00:00', '2020-04-02 09:00:00',
+                      '2020-04-01 13:00:00'], dtype=timestamp_field.TIMESTAMP_DTYPE))
+        treatments = ['', 'x', '', 'y']
+        resulting_fields = {'id': [None] * 3, 'patient_id': [None] * 3,
+                            'updated_at': np.zeros(3, dtype=timestamp_field.TIMESTAMP_DTYPE),
+                            'treatment': [None] * 3}
+        mar = MergeAssessmentRows([4, 4], resulting_fields, dict(),
+                                  [('id', 0), ('patient_id', 1), ('updated_at', 3),
+                                   ('treatment', 4)], dict())
+        source_fields = [ids, patient_ids, None, updated_ats, treatments]
+        mar(source_fields, None, 0, 2)
+        mar(source_fields, None, 3, 3)
+        self.assertListEqual(resulting_fields['id'], ['ab', 'ac', 'ad'])
+        self.assertListEqual(
+            timestamp_field.to_strings(resulting_fields['updated_at'], unit='s').tolist(),
+            ['2020-04-01 12:00:00', '2020-04-02 09:00:00', '2020-04-01 13:00:00'])
@@ -11,7 +11,10 @@
 
 import unittest
 
-from utils import find_longest_sequence_of, to_escaped
+import numpy as np
+
+from utils import find_longest_sequence_of, to_escaped, flag_summary, count_flag_empty,\
+    count_flag_not_set, count_flag_set, to_csv_value
 
 class TestUtils(unittest.TestCase):
 
@@ -47,3 +50,28 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(to_escaped('a"b'), '"a""b"')
         self.assertEqual(to_escaped('"a","b"'), '"""a"",""b"""')
         self.assertEqual(to_escaped(',",'), '","","')
+
+    def test_flag_summary(self):
+        flags = [0, 0x1, 0x3, 0x8, 0x8, 0x100, 0x80000000, 0]
+        for status in (flags, np.asarray(flags, dtype=np.uint32)):
+            summary = flag_summary(status, {0x1: 'a', 0x2: 'b', 0x8: 'c', 0xffffffff: 'all'})
+            self.assertEqual(summary.row_count_, 8)
+            self.assertEqual(summary.unflagged_, 2)
+            self.assertListEqual(summary.bit_counts_[:4].tolist(), [2, 1, 0, 2])
+            self.assertEqual(summary.bit_counts_[31], 1)
+            self.assertListEqual(summary.exclusive_bit_counts_[:4].tolist(), [1, 0, 0, 2])
+            self.assertListEqual(summary.counts_by_desc(),
+                                 [('a', 2, 1), ('b', 1, 0), ('c', 2, 2), ('all', 6, None)])
+            self.assertEqual(count_flag_empty(status), 2)
+            self.assertEqual(count_flag_set(status, 0x9), 4)
+            self.assertEqual(count_flag_not_set(status, 0x9), 4)
+        self.assertEqual(flag_summary(np.zeros(0, dtype=np.uint32)).unflagged_, 0)
+
+    def test_to_csv_value(self):
+        import csv
+        from io import StringIO
+
+        values = [None, '', 'a', 'a,b', 'a"b', 'a\nb', 1, 2.5, np.float32(2.5), np.uint8(3), True]
+        s = StringIO()
+        csv.writer(s).writerow(values)
+        self.assertEqual(','.join(to_csv_value(v) for v in values) + '\r\n', s.getvalue())
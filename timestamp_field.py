@@ -0,0 +1,227 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+
+import numpy as np
+
+import numpy_buffer
+
+# Timestamps are exported as 'YYYY-MM-DD HH:MM:SS', with optional fractional seconds and a
+# '+00:00' offset. They are parsed to microseconds so that the parsed timestamps order in the
+# same way as the strings; sub-second precision is needed for that, as a patient's assessments
+# are ordered by updated_at within a day.
+TIMESTAMP_DTYPE = np.dtype('datetime64[us]')
+TIMESTAMP_PATTERN =\
+    re.compile(r'(\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}(?:\.\d{1,6})?)(?:\+00:00)?')
+# strings are converted to timestamps this many at a time as they are appended to a
+# TimestampBuffer
+CONVERT_BATCH_ROWS = 1 << 16
+# the form of the string that each timestamp was parsed from is recorded in a byte, so that the
+# string can be recovered: the length of the timestamp without its offset, whether it has the
+# '+00:00' offset and whether the date and time are separated by 'T'
+FORMAT_LENGTH_MASK = 0x1f
+FORMAT_OFFSET = 0x20
+FORMAT_T = 0x40
+UTC_OFFSET = np.frombuffer(b'+00:00', dtype=np.uint8)
+# the bytes of the shortest timestamp that TIMESTAMP_PATTERN matches: 'd' is any digit and 's'
+# is ' ' or 'T'. Longer timestamps continue with '.' and up to six digits
+TIMESTAMP_TEMPLATE = b'dddd-dd-ddsdd:dd:dd'
+
+
+def to_days(timestamps):
+    """
+    The day number, counted from 1970-01-01, of each of 'timestamps'
+    """
+    return timestamps.astype('datetime64[D]').view(np.int64).astype(np.int32)
+
+
+def to_strings(timestamps, unit='us'):
+    """
+    Format 'timestamps' in bulk as 'YYYY-MM-DD HH:MM:SS' strings, to the precision of 'unit'
+    ('D' gives 'YYYY-MM-DD')
+    """
+    strings = np.datetime_as_string(timestamps, unit=unit)
+    if unit == 'D':
+        return strings
+    return np.char.replace(strings, 'T', ' ')
+
+
+def is_timestamps(field):
+    return isinstance(field, np.ndarray) and field.dtype == TIMESTAMP_DTYPE
+
+
+class TimestampField:
+    """
+    A field of timestamps, parsed once into an array of datetime64[us] together with the int32
+    day number of each timestamp. The timestamps order in the same way as the strings, so
+    sorting and same-day tests can be done on the arrays. Reading a single entry gives the
+    timestamp in the form 'YYYY-MM-DD HH:MM:SS.ffffff'. A field built by TimestampBuffer also
+    records the form of the string that each timestamp was parsed from (see source_strings);
+    fields derived from it don't
+    """
+    def __init__(self, timestamps, days=None, formats=None):
+        self.timestamps = timestamps
+        self.days = to_days(timestamps) if days is None else days
+        self.formats = formats
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return TimestampField(self.timestamps[item], self.days[item])
+        return to_strings(self.timestamps[item]).item()
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __iter__(self):
+        for t in to_strings(self.timestamps).tolist():
+            yield t
+
+    def take(self, indices):
+        return TimestampField(self.timestamps[indices], self.days[indices])
+
+    def copy(self):
+        return TimestampField(self.timestamps.copy(), self.days.copy())
+
+    def sort_keys(self):
+        """
+        Keys in order of significance that sort this field in the same way as its strings
+        """
+        return self.timestamps.view(np.int64),
+
+    def source_strings(self):
+        """
+        A list of the strings that the timestamps were parsed from, if their forms were
+        recorded, and otherwise of the timestamps in the form that reading them gives
+        """
+        if self.formats is None:
+            return list(self)
+        strings = list()
+        for t, f in zip(np.datetime_as_string(self.timestamps, unit='us').tolist(),
+                        self.formats.tolist()):
+            t = t[:f & FORMAT_LENGTH_MASK]
+            if not f & FORMAT_T:
+                t = t[:10] + ' ' + t[11:]
+            strings.append(t + '+00:00' if f & FORMAT_OFFSET else t)
+        return strings
+
+
+def _template_matches(strings, length):
+    """
+    Whether each row of 'strings', a 2d array of the bytes of timestamps of 'length' characters,
+    has the form that TIMESTAMP_PATTERN matches
+    """
+    template = TIMESTAMP_TEMPLATE + (b'.' + b'd' * (length - len(TIMESTAMP_TEMPLATE) - 1)
+                                     if length > len(TIMESTAMP_TEMPLATE) else b'')
+    template = np.frombuffer(template, dtype=np.uint8)
+    is_digit = (strings >= ord('0')) & (strings <= ord('9'))
+    matches = np.where(template == ord('d'), is_digit, strings == template)
+    separators = template == ord('s')
+    matches[:, separators] = (strings[:, separators] == ord(' ')) |\
+        (strings[:, separators] == ord('T'))
+    return matches.all(axis=1)
+
+
+def parse_arena(arena):
+    """
+    Parse a numpy_buffer.StringArena of timestamp strings in bulk, giving the timestamps and the
+    form of each string as TimestampBuffer records it, or None if any of the strings isn't a
+    timestamp that TIMESTAMP_PATTERN matches
+    """
+    offsets, data = arena.encoded()
+    starts = offsets[:-1]
+    lengths = np.diff(offsets)
+    if ((lengths < len(TIMESTAMP_TEMPLATE)) | (lengths > 32)).any():
+        return None
+    has_offset = lengths >= len(TIMESTAMP_TEMPLATE) + len(UTC_OFFSET)
+    suffixes = data[(starts + lengths - len(UTC_OFFSET))[has_offset, None] +
+                    np.arange(len(UTC_OFFSET))]
+    has_offset[has_offset] = (suffixes == UTC_OFFSET).all(axis=1)
+    timestamp_lengths = lengths - len(UTC_OFFSET) * has_offset
+
+    timestamps = np.empty(len(lengths), dtype=TIMESTAMP_DTYPE)
+    formats = timestamp_lengths | (FORMAT_OFFSET * has_offset)
+    for length in np.unique(timestamp_lengths).tolist():
+        if length == len(TIMESTAMP_TEMPLATE) + 1 or length > len(TIMESTAMP_TEMPLATE) + 7:
+            return None
+        rows = np.flatnonzero(timestamp_lengths == length)
+        strings = data[starts[rows, None] + np.arange(length)]
+        if not _template_matches(strings, length).all():
+            return None
+        timestamps[rows] = strings.view(f'S{length}')[:, 0].astype(TIMESTAMP_DTYPE)
+        formats[rows[strings[:, 10] == ord('T')]] |= FORMAT_T
+    return timestamps, formats.astype(np.uint8)
+
+
+def concatenate(parts):
+    return TimestampField(np.concatenate([p.timestamps for p in parts]),
+                          np.concatenate([p.days for p in parts]))
+
+
+class TimestampBuffer:
+    """
+    Build a TimestampField from appended strings. The strings are held until CONVERT_BATCH_ROWS
+    of them have been appended and then converted together. If a value that isn't a timestamp
+    is appended, the buffer falls back to building a list of strings, in which the values
+    already converted are recovered as they were appended. If 'size' is given, the field is
+    allocated at that size up front and filled in place
+    """
+    def __init__(self, size=None):
+        self.pending_ = list()
+        self.timestamps_ = numpy_buffer.ColumnBuilder(TIMESTAMP_DTYPE, size)
+        self.formats_ = numpy_buffer.ColumnBuilder(np.uint8, size)
+        self.list_ = None
+
+    def append(self, value):
+        if self.list_ is None:
+            match = TIMESTAMP_PATTERN.fullmatch(value)
+            if match is not None:
+                timestamp = match.group(1)
+                self.pending_.append(timestamp)
+                self.formats_.append(len(timestamp) |
+                                     (FORMAT_OFFSET if len(value) > len(timestamp) else 0) |
+                                     (FORMAT_T if timestamp[10] == 'T' else 0))
+                if len(self.pending_) == CONVERT_BATCH_ROWS:
+                    self._convert()
+                return
+            self.list_ = self._finalise_timestamps().source_strings()
+        self.list_.append(value)
+
+    def extend(self, strings):
+        """
+        Append a numpy_buffer.StringArena of strings, which are converted together if they are
+        all timestamps
+        """
+        parsed = parse_arena(strings) if self.list_ is None else None
+        if parsed is None:
+            for v in strings:
+                self.append(v)
+            return
+        self._convert()
+        self.timestamps_.extend(parsed[0])
+        self.formats_.extend(parsed[1])
+
+    def _convert(self):
+        self.timestamps_.extend(np.array(self.pending_, dtype=TIMESTAMP_DTYPE))
+        self.pending_ = list()
+
+    def _finalise_timestamps(self):
+        self._convert()
+        timestamps = self.timestamps_.finalise()
+        formats = self.formats_.finalise()
+        self.timestamps_ = None
+        self.formats_ = None
+        return TimestampField(timestamps, formats=formats)
+
+    def finalise(self):
+        if self.list_ is not None:
+            return self.list_
+        return self._finalise_timestamps()
@@ -16,6 +16,9 @@ from io import StringIO
 import numpy as np
 # from numba import jit, prange
 
+from dictionary_field import DictionaryField
+from hex_id_field import HexIdField
+
 
 def validate_file_exists(file_name):
     import os
@@ -40,28 +43,82 @@ def find_longest_sequence_of(string, char):
     return longest
 
 
+# filter status arrays whose largest value is below this are counted with np.bincount rather
+# than np.unique
+BINCOUNT_MAX_VALUE = 1 << 16
+
+
+class FlagSummary:
+    """
+    The counts of the rows of a filter status array by flag, built from the number of rows with
+    each distinct status value, so that any flag or combination of flags can be counted without
+    another pass over the rows:
+     * bit_counts_[b]: the number of rows with bit b set
+     * exclusive_bit_counts_[b]: the number of rows with bit b and no other bit set
+     * unflagged_: the number of rows with no bits set
+    """
+    def __init__(self, values, counts, flag_descs=None):
+        self.values_ = values
+        self.counts_ = counts
+        self.flag_descs_ = flag_descs
+        self.row_count_ = int(counts.sum())
+        bits = np.unpackbits(values.astype('<u4').view(np.uint8).reshape(-1, 4), axis=1,
+                             bitorder='little').astype(np.int64)
+        self.bit_counts_ = counts @ bits
+        exclusive = bits.sum(axis=1) == 1
+        self.exclusive_bit_counts_ = counts[exclusive] @ bits[exclusive]
+        self.unflagged_ = int(counts[values == 0].sum())
+
+    def set_count(self, flag):
+        """
+        The number of rows with any of the bits of 'flag' set
+        """
+        return int(self.counts_[(self.values_ & np.uint32(flag)) != 0].sum())
+
+    def not_set_count(self, flag):
+        return self.row_count_ - self.set_count(flag)
+
+    def exclusive_count(self, flag):
+        """
+        The number of rows with any of the bits of 'flag' set and no bits outside of it
+        """
+        only_flag = (self.values_ != 0) & ((self.values_ & ~np.uint32(flag)) == 0)
+        return int(self.counts_[only_flag].sum())
+
+    def counts_by_desc(self):
+        """
+        A list of (description, set count, exclusive count) for each flag in 'flag_descs'.
+        The exclusive count is None for masks of more than one bit, such as 'all_flags'
+        """
+        return [(d, self.set_count(f), self.exclusive_count(f) if f & (f - 1) == 0 else None)
+                for f, d in self.flag_descs_.items()]
+
+
+def flag_summary(flags, flag_descs=None):
+    """
+    Summarise a filter status array in one vectorised pass over it (see FlagSummary).
+    'flag_descs' is a dictionary of flags to their descriptions, as for 'patient_flag_descs'
+    """
+    flags = np.asarray(flags)
+    if len(flags) > 0 and int(flags.max()) < BINCOUNT_MAX_VALUE:
+        counts = np.bincount(flags.astype(np.intp, copy=False))
+        values = np.flatnonzero(counts).astype(np.uint32)
+        counts = counts[values]
+    else:
+        values, counts = np.unique(flags.astype(np.uint32, copy=False), return_counts=True)
+    return FlagSummary(values, counts.astype(np.int64), flag_descs)
+
+
 def count_flag_empty(flags):
-    count = 0
-    for f in flags:
-        if f == 0:
-            count += 1
-    return count
+    return flag_summary(flags).unflagged_
 
 
 def count_flag_not_set(flags, flag_to_test):
-    count = 0
-    for f in flags:
-        if not (f & flag_to_test):
-            count += 1
-    return count
+    return flag_summary(flags).not_set_count(flag_to_test)
 
 
 def count_flag_set(flags, flag_to_test):
-    count = 0
-    for f in flags:
-        if f & flag_to_test:
-            count += 1
-    return count
+    return flag_summary(flags).set_count(flag_to_test)
 
 
 def timestamp_to_day(field):
@@ -72,6 +129,9 @@ def timestamp_to_day(field):
 
 def build_histogram(dataset, filtered_records=None, tx=None):
     # TODO: memory_efficiency: see build_histogram function
+    if filtered_records is None and tx is None and isinstance(dataset, DictionaryField):
+        # dictionary encoded fields can be counted on their codes
+        return [vc for vc in dataset.value_counts() if vc[1] > 0]
     histogram = defaultdict(int)
     for ir, r in enumerate(dataset):
         if not filtered_records or not filtered_records[ir]:
@@ -162,8 +222,17 @@ def valid_range_fac_inc(f_min, f_max, default_value=''):
     return inner_
 
 
-def iterate_over_patient_assessments(fields, filter_status, visitor):
-    patient_ids = fields[1]
+def iterate_over_patient_assessments(fields, filter_status, visitor, patient_id_index):
+    """
+    Call 'visitor' with 'fields' and the first and last row of each run of rows with the same
+    patient id, where the patient ids are 'fields[patient_id_index]'
+    """
+    patient_ids = fields[patient_id_index]
+    if isinstance(patient_ids, HexIdField):
+        if len(filter_status) > 1:
+            for cur_start, cur_end in patient_ids.runs():
+                visitor(fields, filter_status, cur_start, cur_end)
+        return
     cur_id = patient_ids[0]
     cur_start = 0
     cur_end = 0
@@ -184,6 +253,11 @@ def iterate_over_patient_assessments(fields, filter_status, visitor):
 
 
 def iterate_over_patient_assessments2(patient_ids, filter_status, visitor):
+    if isinstance(patient_ids, HexIdField):
+        if len(patient_ids) > 1:
+            for cur_start, cur_end in patient_ids.runs():
+                visitor(patient_ids[cur_start], filter_status, cur_start, cur_end)
+        return
     cur_id = patient_ids[0]
     cur_start = 0
     cur_end = 0
@@ -253,6 +327,18 @@ def list_to_escaped(strings):
     return s.getvalue()
 
 
+def to_csv_value(value):
+    """
+    'value' as csv.writer writes it with the default dialect
+    """
+    if value is None:
+        return ''
+    string = repr(value) if isinstance(value, float) else str(value)
+    if ',' in string or '"' in string or '\n' in string or '\r' in string:
+        return '"' + string.replace('"', '""') + '"'
+    return string
+
+
 def to_escaped(string, separator=',', delimiter='"'):
     comma = False
     quotes = False